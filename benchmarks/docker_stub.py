@@ -0,0 +1,129 @@
+"""In-memory stand-in for DockerClient, with a fixed latency per daemon round
+trip"""
+# pylint: disable=unused-argument
+import threading
+import time
+from types import SimpleNamespace as Bunch
+
+from miniboss.exceptions import DockerException
+
+
+class StubContainer:
+
+    def __init__(self, docker, name_prefix, service_name):
+        self._docker = docker
+        self.name = "{:s}-1234".format(name_prefix)
+        self.id = "{:s}-id".format(name_prefix)
+        self.service_name = service_name
+        self.status = 'running'
+        self.labels = {}
+
+    def stop(self, timeout):
+        self._docker.round_trip()
+        self.status = 'exited'
+
+    def remove(self):
+        self._docker.round_trip()
+        self._docker.forget(self)
+
+
+class StubDocker:
+    """Implements the methods of DockerClient that the service agents and the
+    service collection use. Every method that would talk to the daemon sleeps
+    for `latency` seconds; containers of the services in `failing` cannot be
+    started."""
+    # pylint: disable=too-many-public-methods
+
+    def __init__(self, latency=0.0, failing=()):
+        self.latency = latency
+        self.failing = set(failing)
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._containers = {}
+        self._created = {}
+
+    def round_trip(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def forget(self, container):
+        with self._lock:
+            self._containers.get(container.service_name, []).remove(container)
+
+    def create_network(self, network_name):
+        self.round_trip()
+        return Bunch(id="{:s}-id".format(network_name))
+
+    def remove_network(self, network_name):
+        self.round_trip()
+
+    def watch_events(self, group_name):
+        pass
+
+    def stop_watching(self):
+        pass
+
+    def index_containers(self, network):
+        self.round_trip()
+
+    def forget_containers(self):
+        pass
+
+    def invalidate_containers(self, service_name):
+        pass
+
+    def service_containers(self, service_name, network):
+        with self._lock:
+            return list(self._containers.get(service_name, []))
+
+    def prefetch_images(self, tags, parallelism=None):
+        pass
+
+    def stop_prefetching(self):
+        pass
+
+    def check_image(self, tag):
+        self.round_trip()
+        return "{:s}-id".format(tag)
+
+    def image_exists(self, tag):
+        self.round_trip()
+        return True
+
+    def exit_logs(self, container):
+        return None
+
+    def on_container_exit(self, container, callback):
+        pass
+
+    def _start(self, name_prefix, service):
+        self.round_trip()
+        if service.name in self.failing:
+            raise DockerException("Container of {:s} failed to start".format(service.name))
+        container = StubContainer(self, name_prefix, service.name)
+        with self._lock:
+            self._containers.setdefault(service.name, []).append(container)
+        return container
+
+    def run_service_on_network(self, name_prefix, service, network, fingerprint=None):
+        return self._start(name_prefix, service).name
+
+    def create_service_container(self, name_prefix, service, network, fingerprint=None,
+                                 image=None):
+        self.round_trip()
+        container_id = "{:s}-id".format(name_prefix)
+        self._created[container_id] = (name_prefix, service)
+        return container_id, "{:s}-1234".format(name_prefix)
+
+    def run_container(self, container_id, labels=None):
+        self._start(*self._created.pop(container_id))
+
+    def remove_container(self, container_id):
+        self.round_trip()
+        self._created.pop(container_id, None)
+
+    def wait_until_healthy(self, container_id, timeout):
+        self.round_trip()
+        return True
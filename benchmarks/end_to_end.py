@@ -0,0 +1,104 @@
+"""Benchmark of full start, restart, reload and stop runs against the fake Docker
+Engine used by the tests, with a fixed latency per API call. Run from the root
+of the repository with
+
+    python -m benchmarks.end_to_end --shape random --size 100 --latency 0.005
+
+As the services are defined as classes, which miniboss collects from the
+subclasses of Service, a single graph is benchmarked per invocation."""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+from miniboss import services, types
+from miniboss.services import Service
+from miniboss.types import Engine
+
+from benchmarks import graphs
+from tests.fake_engine import FakeEngine
+
+BUILD_DIR = "built"
+
+
+def define_services(shape, size):
+    """Define a service class per service in the graph. The image of the last
+    service is built, so that it can be reloaded. The classes have to be kept
+    referenced, as Service keeps track of its subclasses with weak
+    references."""
+    specs = graphs.generate(shape, size)
+    classes = []
+    for name, dependencies in specs:
+        fields = {'name': name, 'image': "synthetic:latest", 'dependencies': dependencies}
+        if name == specs[-1][0]:
+            fields['build_from'] = BUILD_DIR
+        classes.append(type(name.capitalize(), (Service,), fields))
+    return classes
+
+
+def _timed(engine, run):
+    engine.reset_calls()
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start, dict(engine.calls)
+
+
+@click.command()
+@click.option("--shape", type=click.Choice(graphs.SHAPES), default='random')
+@click.option("--size", type=int, default=100, help="Number of services")
+@click.option("--latency", type=float, default=0.0, help="Seconds every API call takes")
+@click.option("--parallelism", type=int, default=32,
+              help="Maximum number of services started or stopped at the same time")
+@click.option("--engine", "run_engine", type=click.Choice(Engine.ALL), default=Engine.THREADS)
+@click.option("--max-round-trips", type=float,
+              help="Fail if a run makes more API calls per service than this")
+@click.option("--verbose", is_flag=True, help="Print the calls per endpoint")
+def main(shape, size, latency, parallelism, run_engine, max_round_trips, verbose):
+    # pylint: disable=too-many-arguments, too-many-locals
+    logging.getLogger().setLevel(logging.WARNING)
+    types.set_group_name('benchmark')
+    classes = define_services(shape, size)
+    maindir = tempfile.mkdtemp(prefix="miniboss-benchmark-")
+    os.mkdir(os.path.join(maindir, BUILD_DIR))
+    with open(os.path.join(maindir, BUILD_DIR, "Dockerfile"), 'w', encoding='utf-8') as dockerfile:
+        dockerfile.write("FROM synthetic:latest\n")
+    engine = FakeEngine(latency).start()
+    # DockerClient connects to the daemon given in the environment
+    os.environ['DOCKER_HOST'] = engine.base_url
+    common = {'timeout': 5, 'parallelism': parallelism, 'engine': run_engine}
+    reloaded = classes[-1].name
+    runs = [
+        ("start", lambda: services.start_services(maindir, [], None, **common)),
+        ("restart", lambda: services.start_services(maindir, [], None, **common)),
+        ("reload", lambda: services.reload_service(maindir, reloaded, None, True, **common)),
+        ("stop", lambda: services.stop_services(maindir, [], None, True, **common)),
+    ]
+    exceeded = []
+    try:
+        click.echo("{:<8s} {:>10s} {:>12s} {:>12s}".format("run", "wall", "round trips",
+                                                           "per service"))
+        for name, run in runs:
+            wall, calls = _timed(engine, run)
+            round_trips = sum(calls.values())
+            click.echo("{:<8s} {:>10.3f} {:>12d} {:>12.2f}".format(name, wall, round_trips,
+                                                                   round_trips / size))
+            if verbose:
+                for endpoint, count in sorted(calls.items()):
+                    click.echo("    {:<32s} {:>8d}".format(endpoint, count))
+            if max_round_trips is not None and round_trips / size > max_round_trips:
+                exceeded.append(name)
+    finally:
+        engine.stop()
+        shutil.rmtree(maindir, ignore_errors=True)
+    if exceeded:
+        click.echo("More than {} API calls per service in: {:s}".format(
+            max_round_trips, ", ".join(exceeded)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
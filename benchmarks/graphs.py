@@ -0,0 +1,56 @@
+"""Synthetic service graphs for the benchmarks. The generators return the
+names of the services together with the names of their dependencies, in an
+order in which every service comes after its dependencies."""
+import random
+
+SHAPES = ['chain', 'fan', 'diamond', 'random']
+# Maximum number of dependencies of a service in a random graph
+RANDOM_MAX_DEPENDENCIES = 3
+
+
+def _name(index):
+    return "service{:d}".format(index)
+
+
+def chain(size):
+    """Every service depends on the previous one"""
+    return [(_name(i), [_name(i - 1)] if i else []) for i in range(size)]
+
+
+def fan(size):
+    """All services depend on a single root"""
+    return [(_name(i), [_name(0)] if i else []) for i in range(size)]
+
+
+def diamond(size):
+    """A root, a wide layer depending on it, and a sink depending on the whole
+    layer"""
+    if size < 3:
+        return chain(size)
+    middle = [(_name(i), [_name(0)]) for i in range(1, size - 1)]
+    sink = (_name(size - 1), [name for name, _ in middle])
+    return [(_name(0), [])] + middle + [sink]
+
+
+def random_dag(size, seed=0):
+    """Every service depends on up to RANDOM_MAX_DEPENDENCIES services defined
+    before it, chosen with a fixed seed so that runs are comparable"""
+    rng = random.Random(seed)
+    specs = []
+    for i in range(size):
+        count = rng.randint(0, min(i, RANDOM_MAX_DEPENDENCIES))
+        specs.append((_name(i), [_name(j) for j in sorted(rng.sample(range(i), count))]))
+    return specs
+
+
+def generate(shape, size):
+    generators = {'chain': chain, 'fan': fan, 'diamond': diamond, 'random': random_dag}
+    return generators[shape](size)
+
+
+def edge_count(specs):
+    return sum(len(dependencies) for _, dependencies in specs)
+
+
+def roots(specs):
+    return [name for name, dependencies in specs if not dependencies]
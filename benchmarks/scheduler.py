@@ -0,0 +1,204 @@
+"""Microbenchmarks of loading and scheduling synthetic service graphs against an
+in-memory Docker stand-in. Run from the root of the repository with
+
+    python -m benchmarks.scheduler --sizes 10,100,1000
+
+Results can be saved as a baseline with --save-baseline NAME, and later runs
+compared against it with --compare NAME."""
+import json
+import logging
+import pathlib
+import sys
+import time
+import tracemalloc
+
+import click
+
+from miniboss import docker_client, types
+from miniboss.services import Service, ServiceCollection, connect_services
+from miniboss.types import Options, Network, Engine
+
+from benchmarks import graphs
+from benchmarks.docker_stub import StubDocker
+
+BASELINE_DIR = pathlib.Path(__file__).parent / "baselines"
+# Timings below this many seconds are too noisy to be compared against a baseline
+MIN_COMPARED_SECONDS = 0.005
+# Metrics compared against a baseline; all of them are better when lower
+COMPARED_METRICS = ['connect_cpu', 'cycle_check_cpu', 'start_cpu', 'start_wall',
+                    'fail_cpu', 'stop_cpu', 'peak_memory_kb']
+
+
+class SyntheticService(Service):
+    name = "synthetic"
+    image = "synthetic:latest"
+
+    def __init__(self, name, dependencies):
+        self.name = name
+        self.dependencies = dependencies
+
+
+def _services(shape, size):
+    return [SyntheticService(name, dependencies)
+            for name, dependencies in graphs.generate(shape, size)]
+
+
+def _options(engine, parallelism):
+    return Options(network=Network(name='miniboss-benchmark', id=''),
+                   timeout=1,
+                   remove=True,
+                   run_dir='.',
+                   build=[],
+                   parallelism=parallelism,
+                   container_parallelism=parallelism,
+                   engine=engine)
+
+
+def _collection(services):
+    collection = ServiceCollection()
+    collection.all_by_name = connect_services(services)
+    return collection
+
+
+def _measured(func):
+    """Wall and CPU time of calling `func`. The CPU time is that of the whole
+    process; as the stand-in only sleeps, this is the time spent in miniboss."""
+    wall, cpu = time.perf_counter(), time.process_time()
+    func()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def _best(repeat, func):
+    # The minimum is the least disturbed by other processes
+    return min((func() for _ in range(repeat)), key=lambda timing: timing[1])
+
+
+def _run_lifecycle(shape, size, options, latency):
+    """Start and then stop all services, returning the timings of both"""
+    docker_client._the_docker = StubDocker(latency) # pylint: disable=protected-access
+    collection = _collection(_services(shape, size))
+    start = _measured(lambda: collection.start_all(options))
+    collection = _collection(_services(shape, size))
+    stop = _measured(lambda: collection.stop_all(options))
+    return start, stop
+
+
+def _run_failing(shape, size, options, latency):
+    """Start the services with all roots failing, so that the failure propagates
+    to every other service"""
+    failing = graphs.roots(graphs.generate(shape, size))
+    docker_client._the_docker = StubDocker(latency, failing=failing) # pylint: disable=protected-access
+    collection = _collection(_services(shape, size))
+    return _measured(lambda: collection.start_all(options))
+
+
+def _peak_memory(shape, size, options, latency):
+    """Peak memory allocated while loading and starting the services, in kB"""
+    docker_client._the_docker = StubDocker(latency) # pylint: disable=protected-access
+    tracemalloc.start()
+    try:
+        _collection(_services(shape, size)).start_all(options)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(shape, size, options, latency, repeat):
+    edges = graphs.edge_count(graphs.generate(shape, size))
+    connect_cpu = min(_measured(lambda: connect_services(_services(shape, size)))[1]
+                      for _ in range(repeat))
+    collection = _collection(_services(shape, size))
+    cycle_check_cpu = _best(repeat, lambda: _measured(collection.check_circular_dependencies))[1]
+    lifecycles = [_run_lifecycle(shape, size, options, latency) for _ in range(repeat)]
+    start_wall, start_cpu = min((start for start, _ in lifecycles), key=lambda x: x[1])
+    stop_cpu = min(stop[1] for _, stop in lifecycles)
+    fail_cpu = _best(repeat, lambda: _run_failing(shape, size, options, latency))[1]
+    return {'services': size,
+            'edges': edges,
+            'connect_cpu': connect_cpu,
+            'cycle_check_cpu': cycle_check_cpu,
+            'start_wall': start_wall,
+            'start_cpu': start_cpu,
+            # Scheduling overhead: CPU time of the start per dependency edge
+            'start_cpu_per_edge_us': start_cpu / max(edges, 1) * 1000000,
+            'fail_cpu': fail_cpu,
+            'stop_cpu': stop_cpu,
+            'peak_memory_kb': _peak_memory(shape, size, options, latency)}
+
+
+def _print_results(results):
+    header = "{:<16s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}"
+    click.echo(header.format("graph", "edges", "connect", "cycles", "start", "start cpu",
+                             "us/edge", "fail cpu", "stop cpu", "peak kB"))
+    row = ("{:<16s} {:>6d} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.1f} {:>10.4f} "
+           "{:>10.4f} {:>10.0f}")
+    for key, result in results.items():
+        click.echo(row.format(key, result['edges'], result['connect_cpu'],
+                              result['cycle_check_cpu'], result['start_wall'],
+                              result['start_cpu'], result['start_cpu_per_edge_us'],
+                              result['fail_cpu'], result['stop_cpu'],
+                              result['peak_memory_kb']))
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing the metrics that got worse by more than `tolerance`
+    compared to the baseline"""
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = baseline[key][metric], result[metric]
+            if not metric.endswith('_kb') and before < MIN_COMPARED_SECONDS:
+                continue
+            if after > before * (1 + tolerance):
+                regressions.append("{:s} {:s}: {:.4f} -> {:.4f} ({:+.0%})".format(
+                    key, metric, before, after, after / before - 1))
+    return regressions
+
+
+@click.command()
+@click.option("--shapes", default=",".join(graphs.SHAPES),
+              help="Comma-separated graph shapes, out of {}".format(", ".join(graphs.SHAPES)))
+@click.option("--sizes", default="10,100,1000", help="Comma-separated numbers of services")
+@click.option("--latency", type=float, default=0.0,
+              help="Seconds every Docker API call of the stand-in takes")
+@click.option("--parallelism", type=int, default=32,
+              help="Maximum number of services started or stopped at the same time")
+@click.option("--engine", type=click.Choice(Engine.ALL), default=Engine.THREADS)
+@click.option("--repeat", type=int, default=3, help="Runs per benchmark; the best one is kept")
+@click.option("--save-baseline", help="Save the results as a baseline with this name")
+@click.option("--compare", "compare_to", help="Compare the results to the baseline with this name")
+@click.option("--tolerance", type=float, default=0.25,
+              help="Relative slowdown tolerated when comparing to a baseline")
+def main(shapes, sizes, latency, parallelism, engine, repeat, save_baseline, compare_to,
+         tolerance):
+    # pylint: disable=too-many-arguments, too-many-locals
+    logging.getLogger().setLevel(logging.CRITICAL)
+    types.set_group_name('benchmark')
+    options = _options(engine, parallelism)
+    results = {}
+    for shape in shapes.split(","):
+        for size in [int(x) for x in sizes.split(",")]:
+            results["{:s}/{:d}".format(shape, size)] = benchmark(shape, size, options,
+                                                                 latency, repeat)
+    _print_results(results)
+    if save_baseline:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        path = BASELINE_DIR / "{:s}.json".format(save_baseline)
+        with open(path, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        click.echo("Saved baseline to {}".format(path))
+    if compare_to:
+        path = BASELINE_DIR / "{:s}.json".format(compare_to)
+        with open(path, 'r', encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), tolerance)
+        for line in regressions:
+            click.echo("Regression: {:s}".format(line))
+        if regressions:
+            sys.exit(1)
+        click.echo("No regressions compared to {}".format(path))
+
+
+if __name__ == "__main__":
+    main() # pylint: disable=no-value-for-parameter
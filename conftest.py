@@ -0,0 +1,3 @@
+# The tests and the benchmarks share the fake Docker engine in tests/fake_engine.
+# With this file at the root of the repository, pytest puts the root into
+# sys.path, so that `tests.fake_engine` can be imported however pytest is run.
@@ -2,3 +2,4 @@ from .main import cli
 from .services import Service
 from .context import Context
 from .types import set_group_name as group_name
+from .probes import TcpProbe, HttpProbe, ExecProbe, Backoff
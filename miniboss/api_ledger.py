@@ -0,0 +1,140 @@
+import contextlib
+import contextvars
+import functools
+import math
+import re
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import attr
+
+# Number of slowest calls listed in the summary
+SLOWEST_LISTED = 5
+
+# The service whose lifecycle the current thread or task is running. Calls
+# made outside of a lifecycle, like creating the network, are not attributed.
+_current_service = contextvars.ContextVar('miniboss_api_service', default=None)
+
+_VERSION_PREFIX = re.compile(r'^/v[\d.]+')
+# Ids and names of containers, networks and volumes cannot contain slashes,
+# image names can
+_OBJECT_PATHS = [
+    (re.compile(r'^/(containers|networks|volumes|exec)/(?!json$|create$|prune$)[^/]+'),
+     r'/\1/{id}'),
+    (re.compile(r'^/images/(?!json$|create$|prune$|search$|load$|get$)'
+                r'.+?(/json|/history|/push|/tag|/get)?$'),
+     r'/images/{name}\1'),
+]
+
+
+@attr.s(slots=True, frozen=True)
+class ApiCall:
+    endpoint = attr.ib()
+    # Seconds until the response headers arrived; the body of streamed
+    # responses, like events or pulls, is read afterwards
+    latency = attr.ib()
+    status = attr.ib()
+    # Sizes in bytes, None if unknown, as for chunked or streamed bodies
+    sent = attr.ib()
+    received = attr.ib()
+    service = attr.ib(default=None)
+
+
+def endpoint(method, url):
+    """The endpoint of a request, with the API version removed and object ids
+    and names replaced with placeholders, e.g. POST /containers/{id}/start"""
+    path = _VERSION_PREFIX.sub('', urlsplit(url).path)
+    for pattern, replacement in _OBJECT_PATHS:
+        path, replaced = pattern.subn(replacement, path)
+        if replaced:
+            break
+    return "{:s} {:s}".format(method, path)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a non-empty list of values"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+@contextlib.contextmanager
+def attributed_to(service_name):
+    """Attribute the API calls made within the block, also from threads of
+    the asyncio engine, to a service"""
+    token = _current_service.set(service_name)
+    try:
+        yield
+    finally:
+        _current_service.reset(token)
+
+
+def attributed(method):
+    """Attribute the API calls made by a service agent method to its service"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with attributed_to(self.service.name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _size(body):
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    if body is None:
+        return 0
+    return None
+
+
+def _content_length(response):
+    length = response.headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+
+class ApiLedger:
+    """Record of the Docker API calls made during a run. The calls are recorded
+    from a response hook of the requests session of the Docker library, so
+    that the ones made by the library's container objects are included."""
+
+    def __init__(self):
+        self.calls = []
+
+    def record(self, response, *args, **kwargs):
+        # pylint: disable=unused-argument
+        request = response.request
+        # Appending to a list is atomic, so no lock is needed for the threads
+        self.calls.append(ApiCall(endpoint=endpoint(request.method, request.url),
+                                  latency=response.elapsed.total_seconds(),
+                                  status=response.status_code,
+                                  sent=_size(request.body),
+                                  received=_content_length(response),
+                                  service=_current_service.get()))
+
+    def by_endpoint(self):
+        calls = defaultdict(list)
+        for call in self.calls:
+            calls[call.endpoint].append(call)
+        return calls
+
+    def slowest(self, count=SLOWEST_LISTED):
+        return sorted(self.calls, key=lambda call: call.latency, reverse=True)[:count]
+
+    def summary(self):
+        """Lines with the calls per endpoint, by number of calls, and the slowest
+        calls"""
+        total = sum(call.latency for call in self.calls)
+        lines = ["Docker API calls: {:d}, {:.3f}s in total".format(len(self.calls), total)]
+        by_endpoint = sorted(self.by_endpoint().items(), key=lambda item: (-len(item[1]), item[0]))
+        for name, calls in by_endpoint:
+            latencies = [call.latency for call in calls]
+            lines.append(("  {:s}: {:d} calls, p50 {:.1f}ms, p95 {:.1f}ms, "
+                          "{:d} bytes sent, {:d} received").format(
+                name, len(calls), percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                sum(call.sent for call in calls if call.sent is not None),
+                sum(call.received for call in calls if call.received is not None)))
+        if self.calls:
+            lines.append("Slowest calls:")
+        for call in self.slowest():
+            lines.append("  {:.1f}ms {:s} ({:s}), status {:d}".format(
+                call.latency * 1000, call.endpoint, call.service or "no service", call.status))
+        return lines
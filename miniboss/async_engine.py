@@ -0,0 +1,401 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from miniboss.api_ledger import attributed_to
+from miniboss.docker_client import DockerClient
+from miniboss.context import Context, ABORT_CHECK_INTERVAL
+from miniboss.graph import ServiceGraph
+from miniboss.probes import ProbeLoop
+from miniboss.service_agent import ServiceAgent, builds_image
+from miniboss.types import AgentStatus, RunCondition, Actions, Options, WaitFor
+
+logger = logging.getLogger(__name__)
+
+
+class _NoLimit:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def _async_limit(parallelism):
+    if parallelism is None:
+        return _NoLimit()
+    return asyncio.Semaphore(parallelism)
+
+
+class AsyncServiceAgent(ServiceAgent):
+    """Service agent that runs the lifecycle of a service as a coroutine. Lifecycle
+    hooks that are coroutine functions are awaited on the event loop; plain
+    ones, as well as the blocking Docker client calls, are run on the thread
+    pool of the context."""
+
+    async def in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # Unlike asyncio.to_thread, run_in_executor does not carry over the
+        # context variables, like the service the API calls are attributed to
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.context.thread_pool,
+                                          functools.partial(context.run, func, *args))
+
+    async def call_hook(self, hook):
+        if asyncio.iscoroutinefunction(hook):
+            return await hook()
+        return await self.in_thread(hook)
+
+    async def run_async(self):
+        self.run_condition.dispatched()
+        self.status = AgentStatus.IN_PROGRESS
+        try:
+            with attributed_to(self.service.name):
+                if self.action == Actions.START and self.resumed:
+                    self.resume()
+                elif self.action == Actions.START:
+                    await self.start_container_async()
+                elif self.action == Actions.STOP:
+                    await self.stop_container_async()
+        finally:
+            self.run_condition.finished()
+
+    async def _probe_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def callback(success):
+            loop.call_soon_threadsafe(future.set_result, success)
+        abort = ProbeLoop.get().submit(self.service.readiness, self.service,
+                                       self.container_name, self.options.timeout, callback)
+        DockerClient.get_client().on_container_exit(self.container_name, abort)
+        return await future
+
+    async def ping_async(self):
+        loop = asyncio.get_running_loop()
+        with self.run_condition.timed(RunCondition.PING):
+            if self.service.wait_for_healthy:
+                return await self.in_thread(self.wait_until_healthy)
+            if self.service.readiness is not None:
+                if await self._probe_async():
+                    logger.info("Readiness probe of service %s succeeded", self.service.name)
+                    self.run_condition.pinged()
+                    return True
+                await self.in_thread(self._log_ping_failure, "Readiness probe failed")
+                return False
+            client = DockerClient.get_client()
+            start = loop.time()
+            while loop.time() - start < self.options.timeout:
+                with self.run_condition.timed(RunCondition.PING_ATTEMPT, nested=True):
+                    pinged = await self.call_hook(self.service.ping)
+                if pinged:
+                    logger.info("Service %s pinged successfully", self.service.name)
+                    self.run_condition.pinged()
+                    return True
+                await self.in_thread(self._raise_if_exited, client)
+                await asyncio.sleep(0.1)
+        logger.error("Could not ping service with timeout of %d", self.options.timeout)
+        return False
+
+    async def _fail_async(self):
+        self.status = AgentStatus.FAILED
+        self.run_condition.fail()
+        self.context.service_failed(self.service)
+        if RunCondition.START in self.run_condition.actions:
+            await self.in_thread(self._remove_failed_container)
+
+    async def build_image_async(self):
+        async with self.context.build_slot, self.context.image_slot:
+            return await self.in_thread(self.build_image)
+
+    async def precreate_async(self):
+        with attributed_to(self.service.name):
+            client = DockerClient.get_client()
+            self.extrapolate_env()
+            existings = await self.in_thread(client.service_containers,
+                                             self.service.name,
+                                             self.options.network)
+            if existings:
+                return None
+            fingerprint = await self.check_image_async()
+            async with self.context.container_slot:
+                with self.run_condition.timed(RunCondition.CREATE):
+                    return await self.in_thread(client.create_service_container,
+                                                self.container_name_prefix,
+                                                self.service,
+                                                self.options.network,
+                                                fingerprint)
+
+    async def check_image_async(self):
+        if self.fingerprint is None:
+            client = DockerClient.get_client()
+            async with self.context.image_slot:
+                with self.run_condition.timed(RunCondition.PULL):
+                    image_id = await self.in_thread(client.check_image, self.service.image)
+            self._set_fingerprint(image_id)
+        return self.fingerprint
+
+    async def _wait_for_context_async(self):
+        """Counterpart of `_wait_for_context` that is woken up by a listener on the
+        context instead of blocking a thread"""
+        if not self.waits_for_context:
+            return
+        keys = Context.keys_used(self.service.env)
+        loop = asyncio.get_running_loop()
+        key_set = asyncio.Event()
+        def listener(key):
+            if key in keys:
+                loop.call_soon_threadsafe(key_set.set)
+        Context.add_listener(listener)
+        try:
+            deadline = loop.time() + self.options.timeout
+            while not (Context.keys_set(keys) or self.dependencies_finished()):
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self.context.context_failed:
+                    logger.error("Context keys for service %s were not set with timeout of %d",
+                                 self.service.name, self.options.timeout)
+                    return
+                key_set.clear()
+                try:
+                    await asyncio.wait_for(key_set.wait(), min(remaining, ABORT_CHECK_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            Context.remove_listener(listener)
+
+    async def _start_existing_async(self, existings):
+        if not any(existing.status == 'running' for existing in existings):
+            # Check the image here with the async limits, as it is needed for the
+            # reuse decision
+            await self.check_image_async()
+        existing = await self.in_thread(self._existing_to_start, existings)
+        if existing is None:
+            return
+        client = DockerClient.get_client()
+        async with self.context.container_slot:
+            with self.run_condition.timed(RunCondition.START):
+                await self.in_thread(client.run_container, existing.id,
+                                    existing.labels)
+        client.invalidate_containers(self.service.name)
+        self.context.service_progressed(self.service, WaitFor.STARTED)
+        if not await self.ping_async():
+            await self._fail_async()
+            return
+        self.context.service_progressed(self.service, WaitFor.PINGED)
+
+    async def run_image_async(self):
+        client = DockerClient.get_client()
+        await self._wait_for_context_async()
+        if self.precreation is not None:
+            try:
+                self.precreated = await self.precreation
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Could not create container of service %s in advance",
+                                 self.service.name)
+        self.extrapolate_env()
+        existings = []
+        if self.precreated is None:
+            existings = await self.in_thread(client.service_containers,
+                                             self.service.name,
+                                             self.options.network)
+        if existings:
+            await self._start_existing_async(existings)
+            if self.run_condition.state in [RunCondition.STARTED, RunCondition.RUNNING]:
+                return
+        logger.info("Creating new container for service %s", self.service.name)
+        snapshot = None
+        if self.service.snapshot:
+            await self.check_image_async()
+            snapshot = await self.in_thread(self._load_snapshot)
+        hook_keys = set()
+        if snapshot is None:
+            with self.run_condition.timed(RunCondition.PRE_START), Context.recording(hook_keys):
+                await self.call_hook(self.service.pre_start)
+            self._hook_ran('pre_start')
+            self.run_condition.pre_started()
+        fingerprint = await self.check_image_async()
+        async with self.context.container_slot:
+            with self.run_condition.timed(RunCondition.CREATE):
+                self.container_name = await self.in_thread(self._run_new_container,
+                                                           client, fingerprint, snapshot)
+        self.run_condition.started()
+        self.context.service_progressed(self.service, WaitFor.STARTED)
+        if not await self.ping_async():
+            await self._fail_async()
+            return
+        self.context.service_progressed(self.service, WaitFor.PINGED)
+        if snapshot is None:
+            with self.run_condition.timed(RunCondition.POST_START), Context.recording(hook_keys):
+                await self.call_hook(self.service.post_start)
+            self.run_condition.post_started()
+            self._hook_ran('post_start')
+            await self.in_thread(self._save_snapshot, hook_keys)
+
+    async def start_container_async(self):
+        try:
+            if builds_image(self.service, self.options):
+                self.service.image = await (self.image_build or self.build_image_async())
+            await self.run_image_async()
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Error starting service")
+            await self._fail_async()
+        if self.run_condition.state == RunCondition.RUNNING:
+            logger.info("Service %s started successfully", self.service.name)
+            self.status = AgentStatus.STARTED
+            self.context.service_started(self.service)
+
+    async def stop_container_async(self):
+        await self.in_thread(self._stop_container, self.options.remove)
+        self.status = AgentStatus.STOPPED
+        self.context.service_stopped(self.service)
+
+
+class AsyncRunningContext:
+    """Counterpart of `RunningContext` that runs the agents as coroutines on one
+    event loop. Only one context can run at a time, as agents share process state."""
+
+    def __init__(self, services_by_name, options: Options):
+        self.options = options
+        self.agent_set = {service: AsyncServiceAgent(service, options, self)
+                          for service in services_by_name.values()}
+        self.agents = dict(self.agent_set)
+        self.graph = ServiceGraph(self.agent_set.keys())
+        self.failed_services = []
+        self.processed_services = []
+        self.thread_pool = None
+        self.agent_slot = None
+        self.image_slot = None
+        self.container_slot = None
+        self.build_slot = None
+        self._finished = {}
+        # Events of the stages reached before the end of post_start, by service
+        self._progressed = {}
+
+    @property
+    def done(self):
+        return self.agent_set == {}
+
+    @property
+    def context_failed(self):
+        return self.failed_services != []
+
+    def _finish(self, service):
+        self.agent_set.pop(service, None)
+        self._finished[service].set()
+        # Agents waiting for earlier stages must not block either
+        for event in self._progressed[service].values():
+            event.set()
+
+    def _create_events(self):
+        self._finished = {service: asyncio.Event() for service in self.agent_set}
+        self._progressed = {service: {WaitFor.STARTED: asyncio.Event(),
+                                      WaitFor.PINGED: asyncio.Event()}
+                            for service in self.agent_set}
+
+    def _stage_event(self, service, stage):
+        if stage == WaitFor.POST_STARTED:
+            return self._finished[service]
+        return self._progressed[service][stage]
+
+    def service_failed(self, failed_service):
+        if failed_service not in self.agent_set:
+            return
+        self._finish(failed_service)
+        self.failed_services.append(failed_service)
+        for service in self.graph.transitive_dependants(failed_service):
+            if service in self.agent_set:
+                self._finish(service)
+                self.failed_services.append(service)
+
+    def service_progressed(self, service, stage):
+        self._progressed[service][stage].set()
+
+    def service_started(self, started_service):
+        if started_service not in self.agent_set:
+            # Registered as failed already, because a dependency failed after
+            # the service was started
+            return
+        self._finish(started_service)
+        self.processed_services.append(started_service)
+
+    def service_stopped(self, stopped_service):
+        self._finish(stopped_service)
+        self.processed_services.append(stopped_service)
+
+    async def _run_agent(self, agent, waits_for):
+        for event in waits_for:
+            await event.wait()
+        if agent.service not in self.agent_set:
+            return
+        # Like the threaded engine, no new agents are started once a service
+        # has failed. The agent is still marked as finished, so that the ones
+        # waiting for it do not block.
+        if self.context_failed:
+            self._finish(agent.service)
+            return
+        agent.run_condition.ready()
+        async with self.agent_slot:
+            await agent.run_async()
+
+    async def _run_all(self, action, waits_for):
+        self._create_events()
+        self.agent_slot = _async_limit(self.options.parallelism)
+        self.image_slot = _async_limit(self.options.image_parallelism)
+        self.container_slot = _async_limit(self.options.container_parallelism)
+        self.build_slot = _async_limit(self.options.build_parallelism)
+        # Every running agent uses at most one thread at a time, for a blocking
+        # hook or Docker call
+        max_workers = self.options.parallelism or max(len(self.agent_set), 1)
+        with ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix="miniboss-async") as thread_pool:
+            self.thread_pool = thread_pool
+            stages = self._schedule_stages() if action == Actions.START else []
+            coroutines = []
+            for agent in self.agent_set.values():
+                agent.action = action
+                coroutines.append(self._run_agent(agent, waits_for(agent)))
+            try:
+                await asyncio.gather(*coroutines)
+            finally:
+                await self._finish_stages(stages)
+
+    def _schedule_stages(self):
+        """Start building the images of the services that are built, and creating
+        the containers of the ones that do not depend on the context, right
+        away instead of when their dependencies are running"""
+        stages = []
+        for agent in self.agent_set.values():
+            if agent.resumed:
+                continue
+            if builds_image(agent.service, self.options):
+                agent.image_build = asyncio.ensure_future(agent.build_image_async())
+                stages.append(agent.image_build)
+            elif agent.can_precreate:
+                agent.precreation = asyncio.ensure_future(agent.precreate_async())
+                stages.append(agent.precreation)
+        return stages
+
+    async def _finish_stages(self, stages):
+        # Builds of services that were not started are not needed anymore.
+        # Container creations are waited for, as the containers would be left
+        # behind otherwise.
+        for agent in self.agents.values():
+            if agent.image_build is not None:
+                agent.image_build.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        for agent in self.agents.values():
+            try:
+                await agent.in_thread(agent.remove_precreated)
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Error removing container of service %s", agent.service.name)
+
+    async def start_all(self):
+        await self._run_all(Actions.START, lambda agent: [
+            self._stage_event(service, agent.dependency_stage(service))
+            for service in self.graph.dependencies[agent.service]])
+
+    async def stop_all(self):
+        await self._run_all(Actions.STOP, lambda agent: [
+            self._finished[service] for service in self.graph.dependants[agent.service]])
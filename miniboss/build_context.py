@@ -0,0 +1,154 @@
+import hashlib
+import os
+import stat
+import tarfile
+import tempfile
+
+from docker.utils.build import PatternMatcher
+
+from miniboss.exceptions import DockerException
+
+# Number of hex digits of the context digest used in image tags
+TAG_DIGEST_LENGTH = 16
+CHUNK_SIZE = 1024 * 1024
+# Spooled build contexts are kept in memory up to this size, in bytes
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+def read_dockerignore(build_dir):
+    """Patterns in the .dockerignore file of the build directory, parsed the same
+    way docker-py does it"""
+    path = os.path.join(build_dir, '.dockerignore')
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as dockerignore:
+        lines = [line.strip() for line in dockerignore.read().splitlines()]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def context_paths(build_dir, dockerfile):
+    """Paths relative to `build_dir` that are part of the build context, i.e. not
+    excluded by .dockerignore. The Dockerfile is always included. The
+    directory tree is walked lazily."""
+    patterns = read_dockerignore(build_dir) + ["!{:s}".format(dockerfile)]
+    return PatternMatcher(patterns).walk(build_dir)
+
+
+def _hash_file(digest, path):
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+
+def context_digest(build_dir, dockerfile):
+    """Hash of the build context and the Dockerfile. It changes if any file in the
+    context is added, removed, renamed, or changes contents or its executable
+    bit; timestamps are not taken into account."""
+    if not os.path.isdir(build_dir):
+        raise DockerException(
+            "Error building image: directory {:s} does not exist".format(build_dir))
+    digest = hashlib.sha256()
+    for relative in sorted(context_paths(build_dir, dockerfile)):
+        path = os.path.join(build_dir, relative)
+        mode = os.lstat(path).st_mode
+        digest.update(relative.encode('utf-8') + b'\0')
+        if stat.S_ISLNK(mode):
+            digest.update(b'link\0' + os.readlink(path).encode('utf-8'))
+        elif stat.S_ISDIR(mode):
+            digest.update(b'dir\0')
+        else:
+            digest.update(b'exec\0' if mode & stat.S_IXUSR else b'file\0')
+            _hash_file(digest, path)
+        digest.update(b'\0')
+    # The Dockerfile can be outside the build directory
+    dockerfile_path = os.path.join(build_dir, dockerfile)
+    if os.path.exists(dockerfile_path):
+        digest.update(b'dockerfile\0')
+        _hash_file(digest, dockerfile_path)
+    return digest.hexdigest()
+
+
+def context_dockerfile(build_dir, dockerfile):
+    """Path of the Dockerfile in the build context, and the path of a Dockerfile
+    outside the build directory that has to be added to the context, or None"""
+    path = os.path.join(build_dir, dockerfile)
+    relative = os.path.relpath(path, build_dir)
+    if relative.startswith('..'):
+        return ".dockerfile.{:s}".format(hashlib.sha256(path.encode('utf-8')).hexdigest()), path
+    return relative, None
+
+
+def _tar_info(path, name):
+    status = os.lstat(path)
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(status.st_mode)
+    info.mtime = int(status.st_mtime)
+    if stat.S_ISLNK(status.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+    elif stat.S_ISDIR(status.st_mode):
+        info.type = tarfile.DIRTYPE
+    else:
+        info.size = status.st_size
+    return info
+
+
+def _tar_member(path, name):
+    info = _tar_info(path, name)
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    if not info.isreg():
+        return
+    remaining = info.size
+    with open(path, 'rb') as infile:
+        while remaining > 0:
+            chunk = infile.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                raise DockerException(
+                    "Error building image: {:s} changed while sending it".format(path))
+            remaining -= len(chunk)
+            yield chunk
+    padding = info.size % tarfile.BLOCKSIZE
+    if padding:
+        yield tarfile.NUL * (tarfile.BLOCKSIZE - padding)
+
+
+def _tar_blocks(build_dir, dockerfile):
+    dockerfile_name, external = context_dockerfile(build_dir, dockerfile)
+    for relative in context_paths(build_dir, dockerfile):
+        yield from _tar_member(os.path.join(build_dir, relative), relative)
+    if external is not None:
+        yield from _tar_member(external, dockerfile_name)
+    # End of archive marker
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+def _chunks(blocks, chunk_size):
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def context_stream(build_dir, dockerfile, chunk_size=CHUNK_SIZE):
+    """The build context as an uncompressed tar archive, generated in chunks of
+    about `chunk_size` bytes while the build directory is walked. Files are
+    read only when their turn comes, so that memory use does not depend on the
+    size of the context."""
+    if not os.path.isdir(build_dir):
+        raise DockerException(
+            "Error building image: directory {:s} does not exist".format(build_dir))
+    return _chunks(_tar_blocks(build_dir, dockerfile), chunk_size)
+
+
+def spooled_context(build_dir, dockerfile):
+    """The build context written to a temporary file, which is kept in memory up
+    to SPOOL_MAX_SIZE bytes. Unlike the stream, its length is known up front."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) # pylint: disable=consider-using-with
+    for chunk in context_stream(build_dir, dockerfile):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
@@ -0,0 +1,81 @@
+import re
+import threading
+from collections import defaultdict
+
+LABEL_GROUP = "miniboss.group"
+LABEL_SERVICE = "miniboss.service"
+LABEL_FINGERPRINT = "miniboss.fingerprint"
+
+
+def service_of(summary, group_name):
+    """Name of the service a container belongs to, based on its labels, or None
+    if it is not a container of the group. The list API returns the labels of a
+    container in the `Labels` field."""
+    labels = summary.get('Labels') or {}
+    if LABEL_SERVICE in labels:
+        if labels.get(LABEL_GROUP) != group_name:
+            return None
+        return labels[LABEL_SERVICE]
+    # Containers created before labels were added are matched by their exact
+    # name, which has the format service-group-1234
+    pattern = r"/?(.+)-{:s}-\d{{4}}".format(re.escape(group_name))
+    for name in summary.get('Names') or []:
+        match = re.fullmatch(pattern, name)
+        if match:
+            return match.group(1)
+    return None
+
+
+class ContainerIndex:
+    """Snapshot of the containers connected to a network, taken with a single list
+    call and indexed by service name. The containers of a service are listed
+    again only if they changed after the snapshot was taken."""
+
+    def __init__(self, lib_client, group_name, network):
+        self.lib_client = lib_client
+        self.group_name = group_name
+        self.network = network
+        self.by_service = defaultdict(list)
+        self.stale = set()
+        self.lock = threading.Lock()
+
+    def _list(self, **filters):
+        # Docker accepts both network names and ids in the filter
+        filters['network'] = [self.network.id or self.network.name]
+        summaries = self.lib_client.api.containers(all=True, filters=filters)
+        by_service = defaultdict(list)
+        for summary in summaries:
+            service_name = service_of(summary, self.group_name)
+            if service_name is not None:
+                by_service[service_name].append(self._model(summary))
+        return by_service
+
+    def _model(self, summary):
+        # The list API returns summaries which are not complete inspect results;
+        # fill in the fields that the Container model needs for name and labels.
+        attrs = dict(summary)
+        names = summary.get('Names') or []
+        attrs['Name'] = names[0] if names else None
+        attrs['Config'] = {'Labels': summary.get('Labels') or {}}
+        return self.lib_client.containers.prepare_model(attrs)
+
+    def refresh(self):
+        by_service = self._list()
+        with self.lock:
+            self.by_service = by_service
+            self.stale.clear()
+
+    def invalidate(self, service_name):
+        """Mark the containers of a service as changed since the snapshot"""
+        with self.lock:
+            self.stale.add(service_name)
+
+    def lookup(self, service_name):
+        with self.lock:
+            if service_name not in self.stale:
+                return list(self.by_service[service_name])
+            self.stale.discard(service_name)
+        containers = self._list(name=["{:s}-{:s}-".format(service_name, self.group_name)])
+        with self.lock:
+            self.by_service[service_name] = containers[service_name]
+            return list(containers[service_name])
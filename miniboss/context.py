@@ -1,35 +1,249 @@
+import contextlib
+import contextvars
 import json
+import os
 import pathlib
 import logging
+import re
+import string
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    # Not available on Windows, where the files are not locked
+    fcntl = None
 
 from miniboss.exceptions import ContextError
 
 logger = logging.getLogger(__name__)
 
+# Interval in seconds at which waiting for context keys checks whether it
+# should be aborted
+ABORT_CHECK_INTERVAL = 0.1
+
+# Set of the keys set by the current thread or task, if they are recorded
+_recorded_keys = contextvars.ContextVar('miniboss_recorded_keys', default=None)
+
 
 class _Context(dict):
+    """Values shared between services, journaled to a locked file while attached,
+    which can be observed and waited for."""
     filename = ".miniboss-context"
+    journal_suffix = ".journal"
+    lock_suffix = ".lock"
+    # Number of journal entries written by this process after which the journal
+    # is compacted into the context file
+    compact_after = 100
 
-    def save_to(self, directory):
-        path = pathlib.Path(directory) / self.filename
-        with open(path, 'w') as context_file:
-            context_file.write(json.dumps(self))
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._directory = None
+        self._journal_entries = 0
+        # Keys set or removed by this process, which take precedence over the
+        # values in the files when saving
+        self._changed = set(self.keys())
+        # Keys set since the context was attached, i.e. during the current run,
+        # as opposed to the ones loaded from the previous one
+        self._written = set(self.keys())
+        self._lock = threading.RLock()
+        self._key_set = threading.Condition(self._lock)
+        self._listeners = []
 
-    def load_from(self, directory):
-        path = pathlib.Path(directory) / self.filename
+    def _path(self, directory, suffix=''):
+        return pathlib.Path(directory) / (self.filename + suffix)
+
+    @contextlib.contextmanager
+    def _locked(self, directory):
+        with self._lock, open(self._path(directory, self.lock_suffix), 'a',
+                                    encoding='utf-8') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, directory):
+        """The values in the context file with the journal applied"""
         try:
-            with open(path, 'r') as context_file:
-                new_data = json.load(context_file)
-            self.update(**new_data)
+            with open(self._path(directory), 'r', encoding='utf-8') as context_file:
+                values = json.load(context_file)
         except FileNotFoundError:
+            values = {}
+        try:
+            with open(self._path(directory, self.journal_suffix), 'r',
+                      encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last entry is incomplete if the process was killed
+                        # while writing it
+                        logger.warning("Ignoring incomplete context journal entry")
+                        continue
+                    if 'delete' in entry:
+                        values.pop(entry['delete'], None)
+                    else:
+                        values[entry['set']] = entry['value']
+        except FileNotFoundError:
+            pass
+        return values
+
+    def _append(self, line):
+        if self._directory is None:
+            return
+        with self._locked(self._directory):
+            with open(self._path(self._directory, self.journal_suffix), 'a',
+                      encoding='utf-8') as journal:
+                journal.write(line)
+                journal.flush()
+                os.fsync(journal.fileno())
+            self._journal_entries += 1
+            if self._journal_entries >= self.compact_after:
+                self._compact(self._directory)
+
+    @staticmethod
+    def _entry(entry):
+        """Journal line of an entry, raising ContextError if it contains a value that
+        cannot be saved"""
+        try:
+            return json.dumps(entry) + "\n"
+        except (TypeError, ValueError) as exc:
+            raise ContextError("Context value for key '{}' cannot be saved as JSON: {}".format(
+                entry.get('set'), exc)) from None
+
+    def __setitem__(self, key, value):
+        line = self._entry({'set': key, 'value': value})
+        with self._lock:
+            super().__setitem__(key, value)
+            self._changed.add(key)
+            self._written.add(key)
+            self._append(line)
+            self._key_set.notify_all()
+            listeners = list(self._listeners)
+        recorded = _recorded_keys.get()
+        if recorded is not None:
+            recorded.add(key)
+        for listener in listeners:
+            listener(key)
+
+    @contextlib.contextmanager
+    def recording(self, keys):
+        """Add the keys that are set within the block to the set `keys`. Only the
+        keys set by the current thread or task, or by code running in a copy of
+        its context, are recorded."""
+        # pylint: disable=no-self-use
+        token = _recorded_keys.set(keys)
+        try:
+            yield keys
+        finally:
+            _recorded_keys.reset(token)
+
+    def add_listener(self, callback):
+        """Call `callback` with the key whenever a value is set"""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners.remove(callback)
+
+    def keys_set(self, keys):
+        """Whether values were set for all of `keys` during the current run. Values
+        loaded from the context file of an earlier run do not count."""
+        with self._lock:
+            return all(key in self._written for key in keys)
+
+    def wait_for_keys(self, keys, timeout, abort=None):
+        """Block until values are set for all of `keys` during the current run,
+        returning True, or until `timeout` seconds have passed or `abort()`
+        returns True, in which case False is returned"""
+        deadline = time.monotonic() + timeout
+        with self._key_set:
+            while not self.keys_set(keys):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (abort is not None and abort()):
+                    return False
+                self._key_set.wait(min(remaining, ABORT_CHECK_INTERVAL))
+        return True
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self._changed.add(key)
+            self._append(self._entry({'delete': key}))
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key not in self:
+                return super().pop(key, *default)
+            value = self[key]
+            del self[key]
+            return value
+
+    def update(self, *args, **kwargs): # pylint: disable=arguments-differ
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    @contextlib.contextmanager
+    def attached(self, directory):
+        """Load the values from the directory, and persist every change there until
+        the end of the block"""
+        self.load_from(directory)
+        self._directory = directory
+        self._written.clear()
+        try:
+            yield self
+        finally:
+            self._directory = None
+
+    def _compact(self, directory):
+        values = self._read(directory)
+        for key in self._changed:
+            if key in self:
+                values[key] = dict.__getitem__(self, key)
+            else:
+                values.pop(key, None)
+        # Write to a temporary file and rename it, so that the context file is
+        # never left half written
+        path = self._path(directory)
+        temporary = path.with_name("{:s}.{:d}.tmp".format(path.name, os.getpid()))
+        with open(temporary, 'w', encoding='utf-8') as context_file:
+            context_file.write(json.dumps(values))
+            context_file.flush()
+            os.fsync(context_file.fileno())
+        os.replace(temporary, path)
+        self._path(directory, self.journal_suffix).unlink(missing_ok=True)
+        self._journal_entries = 0
+        # Values set by other processes are visible from now on
+        dict.update(self, values)
+
+    def save_to(self, directory):
+        with self._locked(directory):
+            self._compact(directory)
+
+    def load_from(self, directory):
+        path = self._path(directory)
+        if not (path.exists() or self._path(directory, self.journal_suffix).exists()):
             logger.info("No miniboss context file in %s", directory)
+            return
+        with self._locked(directory):
+            dict.update(self, self._read(directory))
 
     def remove_file(self, directory):
-        path = pathlib.Path(directory) / self.filename
-        try:
-            path.unlink()
-        except FileNotFoundError:
+        path = self._path(directory)
+        journal = self._path(directory, self.journal_suffix)
+        if not (path.exists() or journal.exists()):
             logger.info("No miniboss context file in %s", directory)
+            return
+        # The lock file is left in place, as other processes might be waiting
+        # for the lock on it
+        with self._locked(directory):
+            path.unlink(missing_ok=True)
+            journal.unlink(missing_ok=True)
 
     def extrapolate(self, env_value):
         if not hasattr(env_value, "format"):
@@ -47,12 +261,44 @@ class _Context(dict):
             raise ContextError("Only keyword argument extrapolation allowed, violating string: '{}'"
                                .format(env_value)) from None
 
+    @staticmethod
+    def uses_context(env_value):
+        """Whether a value refers to context keys, i.e. whether extrapolating it
+        can give a different result once services have set context values"""
+        if not isinstance(env_value, str):
+            return False
+        try:
+            return any(field is not None for _, field, _, _ in string.Formatter().parse(env_value))
+        except ValueError:
+            # Malformed strings fail when they are extrapolated
+            return True
+
+    @staticmethod
+    def placeholders(env_value):
+        """Context keys referred to in a value, i.e. the names of the fields in it
+        which are formatted by `extrapolate`"""
+        if not isinstance(env_value, str):
+            return set()
+        try:
+            fields = [field for _, field, _, _ in string.Formatter().parse(env_value)
+                      if field]
+        except ValueError:
+            return set()
+        # Only the key itself is needed for attribute and index access
+        return {re.split(r"[.\[]", field, maxsplit=1)[0] for field in fields}
+
+    def keys_used(self, a_dict):
+        """Context keys referred to in the values of a dict"""
+        return set().union(*[self.placeholders(value) for value in a_dict.values()])
+
     def extrapolate_values(self, a_dict):
         return {key: self.extrapolate(value) for key,value in a_dict.items()}
 
     def _reset(self):
         # Used only for testing
-        for key in list(self.keys()):
-            self.pop(key)
+        dict.clear(self)
+        self._changed.clear()
+        self._written.clear()
+        self._directory = None
 
 Context = _Context()
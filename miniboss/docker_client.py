@@ -1,23 +1,69 @@
+import hashlib
+import json
 import logging
+import os
 import random
+import threading
 import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor, wait
 
 import docker
 import docker.errors
 
+from miniboss import types
+from miniboss.build_context import context_dockerfile, context_stream, spooled_context
+from miniboss.containers import (ContainerIndex,
+                                 LABEL_GROUP,
+                                 LABEL_SERVICE,
+                                 LABEL_FINGERPRINT)
+from miniboss.events import ContainerEvents
 from miniboss.exceptions import DockerException, ContainerStartException
 from miniboss.types import Network
 
 logger = logging.getLogger(__name__)
 
 DIGITS = "0123456789"
+NANOSECONDS = 1000000000
+HEALTHCHECK_DURATIONS = ["interval", "timeout", "start_period"]
+# How long to wait for the start event of a container before inspecting it, in
+# seconds. The daemon emits the event before the start call returns.
+START_EVENT_TIMEOUT = 5
+# Number of images pulled at the same time while prefetching, if not limited
+# with the image parallelism option
+PREFETCH_PARALLELISM = 4
+# How long to wait for pulls that are being aborted at the end of a run, in
+# seconds
+PREFETCH_STOP_TIMEOUT = 5
 
 _the_docker = None
 
+
+def definition_fingerprint(service, image_id):
+    """Canonical hash of the parts of a service definition that end up in its
+    container, with the environment already extrapolated. `image_id` is the id of
+    the image the tag pointed to, so that changes behind the same tag are
+    detected as well."""
+    definition = {'image': service.image,
+                  'image_id': image_id,
+                  'env': {key: str(value) for key, value in service.env.items()},
+                  'ports': {str(key): value for key, value in service.ports.items()},
+                  'volumes': service.volumes,
+                  'stop_signal': service.stop_signal,
+                  'healthcheck': service.healthcheck}
+    encoded = json.dumps(definition, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
 class DockerClient:
+    # pylint: disable=too-many-public-methods
 
     def __init__(self, lib_client):
         self.lib_client = lib_client
+        self.events = None
+        self.containers = None
+        self.prefetches = {}
+        self._prefetch_pool = None
+        self._prefetch_stopped = threading.Event()
 
     @classmethod
     def get_client(cls):
@@ -26,6 +72,36 @@ class DockerClient:
             _the_docker = cls(docker.from_env())
         return _the_docker
 
+    def attach_ledger(self, ledger):
+        """Record every API call in the ledger until it is detached"""
+        self.lib_client.api.hooks['response'].append(ledger.record)
+
+    def detach_ledger(self, ledger):
+        self.lib_client.api.hooks['response'].remove(ledger.record)
+
+    def watch_events(self, group_name):
+        """Subscribe to the container events of a group for the duration of a run.
+        While subscribed, container starts, exits and health status changes are
+        followed through the events instead of sleeping and polling."""
+        self.events = ContainerEvents(self.lib_client, group_name)
+        self.events.start()
+
+    def stop_watching(self):
+        if self.events is not None:
+            self.events.stop()
+            self.events = None
+
+    def exit_logs(self, container):
+        """If the container is known to have exited since the start of the run,
+        return its logs, otherwise None"""
+        if self.events is None or not self.events.exited(container):
+            return None
+        return self.lib_client.api.logs(container).decode('utf-8')
+
+    def on_container_exit(self, container, callback):
+        if self.events is not None:
+            self.events.on_exit(container, callback)
+
     def create_network(self, network_name):
         existing = self.lib_client.networks.list(names=[network_name])
         if existing:
@@ -42,26 +118,70 @@ class DockerClient:
             logging.info("Removed network %s", network_name)
 
 
-    def existing_on_network(self, name, network: Network):
-        return self.lib_client.containers.list(all=True, filters={'network': network.id,
-                                                                  'name': name})
+    def index_containers(self, network: Network):
+        """Take a snapshot of the containers of the group on the network for the
+        duration of a run, so that services can look up their containers without
+        a list call each"""
+        self.containers = ContainerIndex(self.lib_client, types.group_name, network)
+        self.containers.refresh()
+
+    def forget_containers(self):
+        self.containers = None
 
-    def build_image(self, build_dir, dockerfile, image_tag):
+    def invalidate_containers(self, service_name):
+        """Mark the containers of a service as changed since the snapshot was taken"""
+        if self.containers is not None:
+            self.containers.invalidate(service_name)
+
+    def service_containers(self, service_name, network: Network):
+        """The containers of a service connected to the network"""
+        index = self.containers
+        if index is None or index.network.name != network.name:
+            index = ContainerIndex(self.lib_client, types.group_name, network)
+            index.invalidate(service_name)
+        return index.lookup(service_name)
+
+    def build_image(self, build_dir, dockerfile, image_tag, spool=False):
+        """Build an image, sending the build context while the build directory is
+        walked instead of archiving it first. If `spool` is true, the context is
+        written to a temporary file first, so that it can be sent with a
+        content length."""
+        dockerfile_name, _ = context_dockerfile(build_dir, dockerfile)
+        if spool:
+            context = spooled_context(build_dir, dockerfile)
+        else:
+            context = context_stream(build_dir, dockerfile)
         try:
-            self.lib_client.images.build(tag=image_tag, path=build_dir, dockerfile=dockerfile)
+            self.lib_client.images.build(tag=image_tag, fileobj=context, custom_context=True,
+                                         dockerfile=dockerfile_name)
         except docker.errors.BuildError as build_error:
             msg = "Error building image: {}".format(build_error.msg)
             raise DockerException(msg) from None
         except docker.errors.APIError as api_error:
             msg = "Error building image: {}".format(api_error.explanation)
             raise DockerException(msg) from None
+        finally:
+            context.close()
 
-    def run_container(self, container_id):
-        # The container should be already created but not in state running or starting
+    def run_container(self, container_id, labels=None):
+        """Start a container that was created but is not running. `labels` are
+        those of an existing container; if it does not have the group label,
+        it was created by an older version and is not in the events stream,
+        so it is inspected right away instead of waiting for its start
+        event."""
         self.lib_client.api.start(container_id)
+        if labels is not None and LABEL_GROUP not in labels:
+            self._check_running(container_id)
+            return
+        if self.events is not None:
+            self._wait_for_start_event(container_id)
+            return
         # Let's wait a little because the status of the container is
         # not set right away
         time.sleep(1)
+        self._check_running(container_id)
+
+    def _check_running(self, container_id):
         try:
             container = self.lib_client.containers.get(container_id)
         except docker.errors.NotFound:
@@ -71,18 +191,152 @@ class DockerClient:
         if container.status != 'running':
             logs = self.lib_client.api.logs(container.id).decode('utf-8')
             raise ContainerStartException(logs, container.name)
-        return container
 
-    def check_image(self, tag):
+    def _wait_for_start_event(self, container_id):
+        state = self.events.wait(container_id,
+                                 lambda state: state.running or state.exited,
+                                 START_EVENT_TIMEOUT)
+        if state is None or not (state.running or state.exited):
+            # The events stream was closed, or the event was lost
+            self._check_running(container_id)
+            return
+        if state.exited:
+            logs = self.lib_client.api.logs(container_id).decode('utf-8')
+            raise ContainerStartException(logs, state.name)
+
+    def _health_status(self, container_id):
+        state = self.lib_client.api.inspect_container(container_id)['State']
+        if 'Health' not in state:
+            raise DockerException(
+                "Container {:s} does not have a health check".format(container_id))
+        return state['Health']['Status']
+
+    def wait_until_healthy(self, container_id, timeout):
+        """Wait for the health status of a container to become healthy, returning
+        False if it becomes unhealthy or the timeout is reached. The health
+        status is followed with an event subscription instead of polling."""
+        if self.events is None:
+            return self._wait_for_health_event(container_id, timeout)
+        deadline = time.monotonic() + timeout
+        status = self._health_status(container_id)
+        if status in ('healthy', 'unhealthy'):
+            return status == 'healthy'
+        state = self.events.wait(container_id,
+                                 lambda state: state.exited or state.health in (
+                                     'healthy', 'unhealthy'),
+                                 timeout)
+        if state is not None and (state.exited or state.health in ('healthy', 'unhealthy')):
+            return state.health == 'healthy'
+        if self.events.closed:
+            return self._wait_for_health_event(container_id,
+                                               max(deadline - time.monotonic(), 0))
+        return False
+
+    def _wait_for_health_event(self, container_id, timeout):
+        events = self.lib_client.events(decode=True,
+                                        filters={'container': container_id,
+                                                 'event': 'health_status'})
+        timer = threading.Timer(timeout, events.close)
+        timer.start()
+        try:
+            status = self._health_status(container_id)
+            if status in ('healthy', 'unhealthy'):
+                return status == 'healthy'
+            for event in events:
+                # The status field of the event has the format "health_status: healthy"
+                status = event.get('status', '').split(':')[-1].strip()
+                if status in ('healthy', 'unhealthy'):
+                    return status == 'healthy'
+            return False
+        finally:
+            timer.cancel()
+            events.close()
+
+    def exec_in_container(self, container_name, command):
+        """Run `command` in a running container, returning its exit code"""
+        try:
+            container = self.lib_client.containers.get(container_name)
+        except docker.errors.NotFound:
+            raise DockerException(
+                "Could not find container {:s} to execute command in".format(
+                    container_name)) from None
+        result = container.exec_run(command)
+        return result.exit_code
+
+    def image_exists(self, tag):
         try:
             self.lib_client.images.get(tag)
+        except docker.errors.ImageNotFound:
+            return False
+        return True
+
+    def fingerprint(self, service):
+        try:
+            image_id = self.lib_client.images.get(service.image).id
+        except docker.errors.ImageNotFound:
+            image_id = None
+        return definition_fingerprint(service, image_id)
+
+    def prefetch_images(self, tags, parallelism=None):
+        """Make sure the images exist locally in the background, pulling the missing
+        ones concurrently in a bounded pool, while the services that do not need
+        them are being started"""
+        self._prefetch_stopped = threading.Event()
+        self._prefetch_pool = ThreadPoolExecutor(
+            max_workers=parallelism or PREFETCH_PARALLELISM,
+            thread_name_prefix="miniboss-prefetch")
+        self.prefetches = {tag: self._prefetch_pool.submit(self._fetch_image, tag,
+                                                           self._prefetch_stopped)
+                           for tag in sorted(set(tags))}
+
+    def stop_prefetching(self):
+        """Cancel the prefetches that have not started yet, and abort the pulls
+        that are running. The pulls stop at the next progress message from the
+        daemon; they are waited for at most PREFETCH_STOP_TIMEOUT seconds, so
+        that the process does not wait for them at exit."""
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.shutdown(wait=False, cancel_futures=True)
+            self._prefetch_stopped.set()
+            # Futures cancelled by the shutdown are never counted as done
+            running = [prefetch for prefetch in self.prefetches.values()
+                       if not prefetch.cancelled()]
+            _, not_done = wait(running, timeout=PREFETCH_STOP_TIMEOUT)
+            for tag, prefetch in self.prefetches.items():
+                if prefetch in not_done:
+                    logger.warning("Pull of image %s could not be aborted", tag)
+            self._prefetch_pool = None
+        self.prefetches = {}
+
+    def check_image(self, tag):
+        """Make sure the image exists locally, pulling it if necessary, and return
+        its id. If the image is being prefetched, wait for that instead."""
+        prefetch = self.prefetches.get(tag)
+        if prefetch is not None:
+            try:
+                return prefetch.result()
+            except (DockerException, CancelledError):
+                logger.info("Prefetching image %s failed, trying again", tag)
+        return self._fetch_image(tag)
+
+    def _fetch_image(self, tag, stopped=None):
+        """Return the id of an image, pulling it if it does not exist. The pull is
+        aborted if `stopped` is set while it is running."""
+        try:
+            return self.lib_client.images.get(tag).id
         except docker.errors.ImageNotFound:
             pass
-        else:
-            return
         logger.info("Image %s does not exist, will pull it", tag)
         try:
-            self.lib_client.images.pull(tag)
+            # The progress is followed instead of waiting for the pull to
+            # finish, so that it can be aborted by closing the stream
+            progress = self.lib_client.api.pull(tag, stream=True, decode=True)
+            try:
+                for _ in progress:
+                    if stopped is not None and stopped.is_set():
+                        raise CancelledError()
+            finally:
+                progress.close()
+            return self.lib_client.images.get(tag).id
         except docker.errors.APIError as api_error:
             raise DockerException("Could not pull image {} due to API error: {}".format(
                 tag, api_error.explanation)) from None
@@ -91,17 +345,38 @@ class DockerClient:
     def run_service_on_network(self,
                                name_prefix,
                                service,  # service: services.Service
-                               network: Network):
+                               network: Network,
+                               fingerprint=None):
+        container_id, container_name = self.create_service_container(name_prefix, service,
+                                                                     network, fingerprint)
+        self.run_container(container_id)
+        logger.info("Started container id %s for service %s", container_id, service.name)
+        return container_name
+
+    def create_service_container(self,
+                                 name_prefix,
+                                 service,  # service: services.Service
+                                 network: Network,
+                                 fingerprint=None,
+                                 image=None):
+        """Create the container of a service without starting it, returning its id
+        and name. `image` can be used instead of the image of the service, e.g.
+        the image of a snapshot."""
         container_name = "{:s}-{:s}".format(name_prefix, ''.join(random.sample(DIGITS, 4)))
         networking_config = self.lib_client.api.create_networking_config({
             network.name: self.lib_client.api.create_endpoint_config(aliases=[service.name]),
         })
         host_config=self.lib_client.api.create_host_config(port_bindings=service.ports,
                                                            binds=service.volumes)
-        self.check_image(service.image)
+        healthcheck = None
+        if service.healthcheck:
+            # Durations are specified in seconds, but docker expects nanoseconds
+            healthcheck = {key: (int(value * NANOSECONDS)
+                                 if key in HEALTHCHECK_DURATIONS else value)
+                           for key, value in service.healthcheck.items()}
         try:
             container = self.lib_client.api.create_container(
-                service.image,
+                image or service.image,
                 detach=True,
                 name=container_name,
                 ports=list(service.ports.keys()),
@@ -109,10 +384,44 @@ class DockerClient:
                 host_config=host_config,
                 networking_config=networking_config,
                 volumes=service.volume_def_to_binds(),
-                stop_signal=service.stop_signal)
+                stop_signal=service.stop_signal,
+                healthcheck=healthcheck,
+                labels={LABEL_GROUP: types.group_name,
+                        LABEL_SERVICE: service.name,
+                        LABEL_FINGERPRINT: fingerprint or self.fingerprint(service)})
         except docker.errors.ImageNotFound:
-            msg = "Image {:s} could not be found; please make sure it exists".format(service.image)
+            msg = "Image {:s} could not be found; please make sure it exists".format(
+                image or service.image)
             raise DockerException(msg) from None
-        container = self.run_container(container.get('Id'))
-        logger.info("Started container id %s for service %s", container.id, service.name)
-        return container_name
+        self.invalidate_containers(service.name)
+        return container.get('Id'), container_name
+
+    def remove_container(self, container_id):
+        self.lib_client.api.remove_container(container_id)
+
+    def volume_paths(self, container_name):
+        """Paths in the container on which volumes are mounted, excluding bind mounts"""
+        mounts = self.lib_client.api.inspect_container(container_name).get('Mounts') or []
+        return sorted(mount['Destination'] for mount in mounts if mount.get('Type') == 'volume')
+
+    def pause_container(self, container_name):
+        self.lib_client.api.pause(container_name)
+
+    def unpause_container(self, container_name):
+        self.lib_client.api.unpause(container_name)
+
+    def export_path(self, container_name, path, outfile):
+        """Write a path in the container to `outfile` as a tar archive"""
+        stream, _ = self.lib_client.api.get_archive(container_name, path)
+        for chunk in stream:
+            outfile.write(chunk)
+
+    def import_path(self, container_id, path, infile):
+        """Extract a tar archive of `path` created with `export_path` into a container"""
+        self.lib_client.api.put_archive(container_id, os.path.dirname(path.rstrip('/')) or '/',
+                                        infile)
+
+    def commit_container(self, container_name, repository, tag):
+        """Commit the container to an image, returning the tag of the image"""
+        self.lib_client.api.commit(container_name, repository=repository, tag=tag)
+        return "{:s}:{:s}".format(repository, tag)
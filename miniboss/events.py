@@ -0,0 +1,120 @@
+import logging
+import threading
+from collections import defaultdict
+
+from miniboss.containers import LABEL_GROUP
+
+logger = logging.getLogger(__name__)
+
+
+class ContainerState:
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.id = None
+        self.name = None
+        self.running = False
+        self.exited = False
+        self.exit_code = None
+        self.oom_killed = False
+        self.health = None
+
+
+class ContainerEvents:
+    """Subscription to the Docker events of the containers of a group for a run"""
+
+    def __init__(self, lib_client, group_name):
+        self.lib_client = lib_client
+        self.group_name = group_name
+        self.condition = threading.Condition()
+        self.states = {}
+        self.exit_callbacks = defaultdict(list)
+        self.closed = False
+        self._stream = None
+        self._thread = None
+
+    def start(self):
+        filters = {'type': 'container',
+                   'label': ["{:s}={:s}".format(LABEL_GROUP, self.group_name)]}
+        self._stream = self.lib_client.events(decode=True, filters=filters)
+        self._thread = threading.Thread(target=self._run, name="miniboss-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.close()
+
+    def _run(self):
+        try:
+            for event in self._stream:
+                self.process(event)
+        except Exception: # pylint: disable=broad-except
+            # Closing the stream from another thread ends up here
+            logger.debug("Docker events stream closed")
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def _state_for(self, container_id, name):
+        state = self.states.get(container_id) or self.states.get(name)
+        if state is None:
+            state = ContainerState()
+        state.id = container_id
+        state.name = name
+        self.states[container_id] = self.states[name] = state
+        return state
+
+    def process(self, event):
+        actor = event.get('Actor', {})
+        # The labels of the container are included in the attributes
+        attributes = actor.get('Attributes', {})
+        if attributes.get(LABEL_GROUP) != self.group_name:
+            return
+        name = attributes.get('name', '')
+        action = event.get('Action') or event.get('status', '')
+        callbacks = []
+        with self.condition:
+            state = self._state_for(actor.get('ID'), name)
+            if action == 'start':
+                state.running = True
+                state.exited = False
+                state.health = None
+            elif action == 'die':
+                state.running = False
+                state.exited = True
+                state.exit_code = attributes.get('exitCode')
+                callbacks = self.exit_callbacks.pop(state.id, []) + \
+                    self.exit_callbacks.pop(state.name, [])
+            elif action == 'oom':
+                state.oom_killed = True
+            elif action.startswith('health_status'):
+                state.health = action.split(':')[-1].strip()
+            self.condition.notify_all()
+        for callback in callbacks:
+            callback()
+
+    def wait(self, container, predicate, timeout):
+        """Wait until `predicate` is true for the state of `container`, returning
+        the state, or None if the timeout is reached first"""
+        def satisfied():
+            state = self.states.get(container)
+            return self.closed or (state is not None and predicate(state))
+        with self.condition:
+            if not self.condition.wait_for(satisfied, timeout):
+                return None
+            return self.states.get(container)
+
+    def exited(self, container):
+        with self.condition:
+            state = self.states.get(container)
+            return state is not None and state.exited
+
+    def on_exit(self, container, callback):
+        """Call `callback` once the container exits; right away if it already did"""
+        with self.condition:
+            state = self.states.get(container)
+            if state is None or not state.exited:
+                self.exit_callbacks[container].append(callback)
+                return
+        callback()
@@ -0,0 +1,99 @@
+import abc
+import contextlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from miniboss.types import Options
+
+logger = logging.getLogger(__name__)
+
+
+def _limit(parallelism):
+    if parallelism is None:
+        return contextlib.nullcontext()
+    return threading.BoundedSemaphore(parallelism)
+
+
+class AgentExecutor(abc.ABC):
+    """Base class for the ways agents are run, carrying the image and container limits"""
+
+    def __init__(self, image_parallelism=None, container_parallelism=None):
+        self.image_slot = _limit(image_parallelism)
+        self.container_slot = _limit(container_parallelism)
+
+    def reserve(self):
+        """Block until there is capacity to run another agent. The reservation is
+        released when the function submitted next finishes, or with `release` if
+        nothing is submitted."""
+
+    def release(self):
+        pass
+
+    @abc.abstractmethod
+    def submit(self, func):
+        """Run `func` without waiting for it to finish"""
+
+    @abc.abstractmethod
+    def shutdown(self):
+        """Wait for all submitted work to finish."""
+
+
+class ThreadPerAgentExecutor(AgentExecutor):
+    """Run each agent in a new thread of its own, without a limit on how many run
+    at the same time."""
+
+    def __init__(self, image_parallelism=None, container_parallelism=None):
+        super().__init__(image_parallelism, container_parallelism)
+        self.threads = []
+
+    def submit(self, func):
+        thread = threading.Thread(target=func)
+        self.threads.append(thread)
+        thread.start()
+
+    def shutdown(self):
+        for thread in self.threads:
+            thread.join()
+
+
+class PoolExecutor(AgentExecutor):
+    """Run agents as tasks on a pool of at most `parallelism` threads. Agents should
+    be submitted only after a call to `reserve`, so that they are not queued in
+    the pool, and the order of dispatch is the order in which they run."""
+
+    def __init__(self, parallelism, image_parallelism=None, container_parallelism=None):
+        super().__init__(image_parallelism, container_parallelism)
+        self.pool = ThreadPoolExecutor(max_workers=parallelism,
+                                       thread_name_prefix="miniboss-agent")
+        self.capacity = threading.BoundedSemaphore(parallelism)
+
+    def reserve(self):
+        # Released by the submitted task, or by release
+        self.capacity.acquire() # pylint: disable=consider-using-with
+
+    def release(self):
+        self.capacity.release()
+
+    def submit(self, func):
+        def run_and_release():
+            try:
+                func()
+            except Exception: # pylint: disable=broad-except
+                # The future of the task is discarded, so the exception would be lost
+                logger.exception("Error running service agent")
+            finally:
+                self.release()
+        self.pool.submit(run_and_release)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+def get_executor(options: Options):
+    if options.parallelism is None:
+        return ThreadPerAgentExecutor(options.image_parallelism,
+                                      options.container_parallelism)
+    return PoolExecutor(options.parallelism,
+                        options.image_parallelism,
+                        options.container_parallelism)
@@ -0,0 +1,148 @@
+from collections import deque
+
+from miniboss.exceptions import ServiceLoadError
+
+
+class ServiceGraph:
+    """Dependency graph of a set of services, stored as adjacency sets. Edges to
+    services that are not part of the set are ignored. All queries are linear in
+    the number of services and dependencies."""
+
+    def __init__(self, services):
+        self.services = list(services)
+        # Dicts with None values are used as insertion-ordered sets, so that the
+        # results don't depend on hash randomization
+        self.dependencies = {service: {} for service in self.services}
+        self.dependants = {service: {} for service in self.services}
+        for service in self.services:
+            for dependency in service.dependencies:
+                if dependency in self.dependencies:
+                    self.dependencies[service][dependency] = None
+                    self.dependants[dependency][service] = None
+
+    def __len__(self):
+        return len(self.services)
+
+    def _closure(self, roots, edges):
+        seen = set(roots)
+        queue = deque(roots)
+        ordered = []
+        while queue:
+            service = queue.popleft()
+            for other in edges[service]:
+                if other not in seen:
+                    seen.add(other)
+                    ordered.append(other)
+                    queue.append(other)
+        return ordered
+
+    def transitive_dependants(self, *roots):
+        """All services that depend directly or indirectly on any of `roots`, in
+        breadth-first order, not including the roots themselves."""
+        return self._closure(roots, self.dependants)
+
+    def transitive_dependencies(self, *roots):
+        """All services any of `roots` depend on directly or indirectly, in
+        breadth-first order, not including the roots themselves."""
+        return self._closure(roots, self.dependencies)
+
+    def layers(self):
+        """Group the services into waves using Kahn's algorithm: the first layer
+        contains the services without dependencies, and every following one the
+        services whose dependencies are all in earlier layers. Raises
+        ServiceLoadError if there are circular dependencies."""
+        in_degree = {service: len(deps) for service, deps in self.dependencies.items()}
+        current = [service for service in self.services if in_degree[service] == 0]
+        layers = []
+        placed = 0
+        while current:
+            layers.append(current)
+            placed += len(current)
+            following = []
+            for service in current:
+                for dependant in self.dependants[service]:
+                    in_degree[dependant] -= 1
+                    if in_degree[dependant] == 0:
+                        following.append(dependant)
+            current = following
+        if placed != len(self.services):
+            self.check_acyclic()
+        return layers
+
+    def strongly_connected_components(self):
+        """Tarjan's algorithm, implemented iteratively so that long dependency
+        chains do not hit the recursion limit."""
+        # pylint: disable=too-many-locals
+        index_of = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        components = []
+        counter = 0
+        for root in self.services:
+            if root in index_of:
+                continue
+            work = [(root, iter(self.dependencies[root]))]
+            index_of[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                service, children = work[-1]
+                child = next(children, None)
+                if child is not None:
+                    if child not in index_of:
+                        index_of[child] = lowlink[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(self.dependencies[child])))
+                    elif child in on_stack:
+                        lowlink[service] = min(lowlink[service], index_of[child])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[service])
+                if lowlink[service] == index_of[service]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member is service:
+                            break
+                    components.append(component)
+        return components
+
+    def _cycle_in(self, component):
+        """Return a cycle through the members of a strongly connected component as a
+        list of services, starting and ending with the same one."""
+        members = set(component)
+        start = component[0]
+        parents = {}
+        queue = deque([start])
+        while queue:
+            service = queue.popleft()
+            for dependency in self.dependencies[service]:
+                if dependency is start:
+                    path = [service]
+                    while path[-1] is not start:
+                        path.append(parents[path[-1]])
+                    path.reverse()
+                    return path + [start]
+                if dependency in members and dependency not in parents:
+                    parents[dependency] = service
+                    queue.append(dependency)
+        return [start, start]
+
+    def cycles(self):
+        return [self._cycle_in(component)
+                for component in self.strongly_connected_components()
+                if len(component) > 1 or component[0] in self.dependencies[component[0]]]
+
+    def check_acyclic(self):
+        cycles = self.cycles()
+        if cycles:
+            raise ServiceLoadError("Circular dependency detected: {:s}".format(
+                "; ".join(" -> ".join(service.name for service in cycle) for cycle in cycles)))
@@ -0,0 +1,74 @@
+import json
+import pathlib
+import logging
+
+from miniboss.types import RunCondition
+
+logger = logging.getLogger(__name__)
+
+# Assumed start duration for services without a recorded history, so that
+# services with long dependency chains are preferred even on the first run
+DEFAULT_DURATION = 1.0
+
+
+class StartHistory:
+    """Durations of the phases (pull, build, create, ping, post-start etc.) the
+    services went through the last time they were started, persisted in a file
+    in the main directory."""
+    filename = ".miniboss-history"
+
+    def __init__(self, durations=None):
+        self.durations = durations or {}
+
+    @classmethod
+    def load_from(cls, directory):
+        path = pathlib.Path(directory) / cls.filename
+        try:
+            with open(path, 'r') as history_file:
+                return cls(json.load(history_file))
+        except FileNotFoundError:
+            logger.info("No miniboss history file in %s", directory)
+        except ValueError:
+            logger.warning("Could not parse miniboss history file in %s, ignoring it",
+                           directory)
+        return cls()
+
+    def save_to(self, directory):
+        path = pathlib.Path(directory) / self.filename
+        with open(path, 'w') as history_file:
+            history_file.write(json.dumps(self.durations))
+
+    def record(self, service_name, run_condition: RunCondition):
+        """Record the phase durations of a service that was started. Services that
+        were already running did not go through any phases, and the history of
+        these is not updated."""
+        if run_condition.state != RunCondition.RUNNING or not run_condition.durations:
+            return
+        self.durations[service_name] = dict(run_condition.durations)
+
+    def duration(self, service_name):
+        if service_name not in self.durations:
+            return DEFAULT_DURATION
+        return sum(self.durations[service_name].values())
+
+    def critical_paths(self, services):
+        """Return a dict mapping each of the services to the length (in seconds) of
+        the longest chain of dependants starting with it, including itself.
+        Dependants not among `services` are ignored."""
+        services = list(services)
+        included = set(services)
+        paths = {}
+        for root in services:
+            stack = [(root, False)]
+            while stack:
+                service, expanded = stack.pop()
+                if service in paths:
+                    continue
+                dependants = [x for x in service.dependants if x in included]
+                if expanded:
+                    longest = max((paths[x] for x in dependants), default=0)
+                    paths[service] = self.duration(service.name) + longest
+                    continue
+                stack.append((service, True))
+                stack.extend((x, False) for x in dependants if x not in paths)
+        return paths
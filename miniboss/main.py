@@ -3,11 +3,26 @@ import click
 
 from miniboss import services
 from miniboss.exceptions import MinibossCLIError
+from miniboss.trace import TraceFormat
+from miniboss.types import Engine
 
 @click.group()
 def cli():
     pass
 
+def trace_options(command):
+    """Add the options for writing a trace of the run to a command"""
+    command = click.option("--trace-format", type=click.Choice(TraceFormat.ALL),
+                           default=TraceFormat.CHROME,
+                           help="Format of the trace (Chrome trace or OTLP JSON)")(command)
+    return click.option("--trace", type=click.Path(dir_okay=False, writable=True),
+                        help="Write a trace of the service lifecycles to this file")(command)
+
+def api_stats_option(command):
+    return click.option("--api-stats", is_flag=True, default=False,
+                        help=("Log the Docker API calls by endpoint and the slowest ones "
+                              "at the end of the run"))(command)
+
 def get_main_directory():
     """Return the path to the directory where the main script is located. If the cli
     function is being called from a Python shell, this function will raise an
@@ -23,9 +38,50 @@ def get_main_directory():
 @click.option("--exclude", help="Names of services to exclude (comma-separated)")
 @click.option("--network-name", help="Network name (generated from group name if not specified)")
 @click.option("--timeout", type=int, default=300, help="Timeout for starting a service (seconds)")
-def start(exclude, network_name, timeout):
+@click.option("--parallelism", type=click.IntRange(min=1),
+              help=("Maximum number of services processed at the same time "
+                    "(unlimited if not specified)"))
+@click.option("--image-parallelism", type=click.IntRange(min=1),
+              help="Maximum number of image builds and pulls at the same time")
+@click.option("--container-parallelism", type=click.IntRange(min=1),
+              help="Maximum number of container starts at the same time")
+@click.option("--build-parallelism", type=click.IntRange(min=1),
+              help=("Maximum number of image builds at the same time "
+                    "(unlimited if not specified)"))
+@click.option("--engine", type=click.Choice(Engine.ALL), default=Engine.THREADS,
+              help="Execution engine for the service lifecycles")
+@click.option("--resume", is_flag=True, default=False,
+              help="Skip the services that are still running since the last start")
+@click.option("--report", type=click.Path(dir_okay=False, writable=True),
+              help="Write the timings of the start as JSON to this file")
+@trace_options
+@api_stats_option
+# pylint: disable=too-many-arguments
+def start(exclude, network_name, timeout, parallelism, image_parallelism, container_parallelism,
+          build_parallelism, engine, resume, report, trace, trace_format, api_stats):
+    exclude = exclude.split(",") if exclude else []
+    services.start_services(get_main_directory(), exclude, network_name, timeout,
+                            parallelism=parallelism,
+                            image_parallelism=image_parallelism,
+                            build_parallelism=build_parallelism,
+                            container_parallelism=container_parallelism,
+                            engine=engine,
+                            resume=resume,
+                            report=report,
+                            trace=trace,
+                            trace_format=trace_format,
+                            api_stats=api_stats)
+
+
+@cli.command()
+@click.option("--exclude", help="Names of services to exclude (comma-separated)")
+@click.option("--parallelism", type=click.IntRange(min=1),
+              help="Maximum number of services processed at the same time")
+def plan(exclude, parallelism):
+    """Show the order in which the services are started, without starting them"""
     exclude = exclude.split(",") if exclude else []
-    services.start_services(get_main_directory(), exclude, network_name, timeout)
+    for line in services.plan_services(get_main_directory(), exclude, parallelism):
+        click.echo(line)
 
 
 @cli.command()
@@ -33,14 +89,49 @@ def start(exclude, network_name, timeout):
 @click.option("--network-name", help="Network name (generated from group name if not specified)")
 @click.option("--remove", is_flag=True, default=False, help="Remove container images and network")
 @click.option("--timeout", type=int, default=50, help="Timeout for stopping a service (seconds)")
-def stop(exclude, network_name, remove, timeout):
+@click.option("--parallelism", type=click.IntRange(min=1),
+              help=("Maximum number of services processed at the same time "
+                    "(unlimited if not specified)"))
+@click.option("--engine", type=click.Choice(Engine.ALL), default=Engine.THREADS,
+              help="Execution engine for the service lifecycles")
+@trace_options
+@api_stats_option
+# pylint: disable=too-many-arguments
+def stop(exclude, network_name, remove, timeout, parallelism, engine, trace, trace_format,
+         api_stats):
     exclude = exclude.split(",") if exclude else []
-    services.stop_services(get_main_directory(), exclude, network_name, remove, timeout)
+    services.stop_services(get_main_directory(), exclude, network_name, remove, timeout,
+                           parallelism=parallelism, engine=engine,
+                           trace=trace, trace_format=trace_format, api_stats=api_stats)
 
 @cli.command()
 @click.option("--network-name", help="Network name (generated from group name if not specified)")
 @click.option("--timeout", type=int, default=50, help="Timeout for stopping a service (seconds)")
 @click.option("--remove", is_flag=True, default=False, help="Remove stopped container")
+@click.option("--parallelism", type=click.IntRange(min=1),
+              help=("Maximum number of services processed at the same time "
+                    "(unlimited if not specified)"))
+@click.option("--image-parallelism", type=click.IntRange(min=1),
+              help="Maximum number of image builds and pulls at the same time")
+@click.option("--container-parallelism", type=click.IntRange(min=1),
+              help="Maximum number of container starts at the same time")
+@click.option("--build-parallelism", type=click.IntRange(min=1),
+              help=("Maximum number of image builds at the same time "
+                    "(unlimited if not specified)"))
+@click.option("--engine", type=click.Choice(Engine.ALL), default=Engine.THREADS,
+              help="Execution engine for the service lifecycles")
 @click.argument('service')
-def reload(service, network_name, timeout, remove):
-    services.reload_service(get_main_directory(), service, network_name, remove, timeout)
+@trace_options
+@api_stats_option
+# pylint: disable=too-many-arguments
+def reload(service, network_name, timeout, remove, parallelism, image_parallelism,
+           container_parallelism, build_parallelism, engine, trace, trace_format, api_stats):
+    services.reload_service(get_main_directory(), service, network_name, remove, timeout,
+                            parallelism=parallelism,
+                            image_parallelism=image_parallelism,
+                            build_parallelism=build_parallelism,
+                            container_parallelism=container_parallelism,
+                            engine=engine,
+                            trace=trace,
+                            trace_format=trace_format,
+                            api_stats=api_stats)
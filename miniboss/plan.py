@@ -0,0 +1,137 @@
+import heapq
+import itertools
+
+from miniboss.graph import ServiceGraph
+
+# Number of services with the most slack that are listed
+SLACK_LISTED = 5
+
+
+class Plan:
+    """Analysis of the order in which a set of services is started, based on the
+    expected start duration of every service. The durations of builds and
+    pulls that run ahead of the dependency order are not taken into account
+    separately."""
+
+    def __init__(self, services, durations):
+        # durations: dict mapping services to expected durations in seconds
+        self.graph = ServiceGraph(services)
+        self.durations = durations
+        self.waves = self.graph.layers()
+        self.earliest_start = {}
+        self.earliest_finish = {}
+        for service in itertools.chain.from_iterable(self.waves):
+            self.earliest_start[service] = max(
+                (self.earliest_finish[x] for x in self.graph.dependencies[service]), default=0)
+            self.earliest_finish[service] = self.earliest_start[service] + durations[service]
+        self.wall_time = max(self.earliest_finish.values(), default=0)
+        self.latest_start = {}
+        # Longest chain of dependants starting with each service, including itself
+        self.tail = {}
+        for service in reversed(list(itertools.chain.from_iterable(self.waves))):
+            dependants = self.graph.dependants[service]
+            latest_finish = min((self.latest_start[x] for x in dependants),
+                                default=self.wall_time)
+            self.latest_start[service] = latest_finish - durations[service]
+            self.tail[service] = durations[service] + max((self.tail[x] for x in dependants),
+                                                          default=0)
+
+    def slack(self, service):
+        """How much later the service could finish without delaying the start"""
+        return self.latest_start[service] - self.earliest_start[service]
+
+    def critical_path(self):
+        """The chain of dependencies that determines the wall time, in start order"""
+        if not self.earliest_finish:
+            return []
+        service = max(self.earliest_finish, key=self.earliest_finish.get)
+        path = [service]
+        while self.graph.dependencies[service]:
+            service = max(self.graph.dependencies[service], key=self.earliest_finish.get)
+            path.append(service)
+        return list(reversed(path))
+
+    def most_slack(self, count=SLACK_LISTED):
+        services = sorted(self.earliest_start, key=self.slack, reverse=True)
+        return [service for service in services[:count] if self.slack(service) > 0]
+
+    def minimum_wall_time(self, parallelism=None):
+        """Lower bound of the wall time if at most `parallelism` services are
+        started at the same time"""
+        if parallelism is None:
+            return self.wall_time
+        return max(self.wall_time, sum(self.durations.values()) / parallelism)
+
+    def scheduled_wall_time(self, parallelism=None):
+        """Wall time if at most `parallelism` services are started at the same
+        time, and the ready services with the longest chains of dependants are
+        started first, as miniboss does"""
+        open_dependencies = {service: len(self.graph.dependencies[service])
+                             for service in self.earliest_start}
+        sequence = itertools.count()
+        ready = [(-self.tail[service], next(sequence), service)
+                 for service, count in open_dependencies.items() if count == 0]
+        heapq.heapify(ready)
+        running = []
+        now = 0
+        while ready or running:
+            while ready and (parallelism is None or len(running) < parallelism):
+                _, _, service = heapq.heappop(ready)
+                heapq.heappush(running, (now + self.durations[service], next(sequence), service))
+            now, _, service = heapq.heappop(running)
+            for dependant in self.graph.dependants[service]:
+                open_dependencies[dependant] -= 1
+                if open_dependencies[dependant] == 0:
+                    heapq.heappush(ready, (-self.tail[dependant], next(sequence), dependant))
+        return now
+
+    def describe(self, parallelism=None, timed=True):
+        """Lines describing the plan. Without timings, only the waves are
+        described."""
+        lines = ["Wave {:d}: {:s}".format(index, ", ".join(service.name for service in wave))
+                 for index, wave in enumerate(self.waves, start=1)]
+        if not timed:
+            lines.append("No recorded timings; start the services to record them")
+            return lines
+        lines.append("Expected critical path ({:.1f}s): {:s}".format(
+            self.wall_time, " -> ".join(service.name for service in self.critical_path())))
+        slack = ", ".join("{:s} ({:.1f}s)".format(service.name, self.slack(service))
+                          for service in self.most_slack())
+        lines.append("Most slack: {:s}".format(slack or "none"))
+        lines.append("Minimum wall time with parallelism {}: {:.1f}s, {:.1f}s as scheduled"
+                     .format(parallelism or "unlimited",
+                             self.minimum_wall_time(parallelism),
+                             self.scheduled_wall_time(parallelism)))
+        return lines
+
+
+def gating_dependency(service, agents_by_service):
+    """The dependency that finished last before the service could be started,
+    i.e. the one that held it up, or None if it did not wait for any"""
+    ready_at = agents_by_service[service].run_condition.ready_at
+    if ready_at is None:
+        return None
+    finished = [(other.run_condition.finished_at, dependency)
+                for dependency in service.dependencies
+                for other in [agents_by_service.get(dependency)]
+                if other is not None and other.run_condition.finished_at is not None
+                and other.run_condition.finished_at <= ready_at]
+    if not finished:
+        return None
+    return max(finished, key=lambda pair: pair[0])[1]
+
+
+def gating_path(agents_by_service):
+    """The chain of dependencies that actually gated a run, ending with the
+    service that finished last, in start order"""
+    finished = {service: agent for service, agent in agents_by_service.items()
+                if agent.run_condition.finished_at is not None}
+    if not finished:
+        return []
+    service = max(finished, key=lambda x: finished[x].run_condition.finished_at)
+    path = [service]
+    while True:
+        service = gating_dependency(service, agents_by_service)
+        if service is None:
+            return list(reversed(path))
+        path.append(service)
@@ -0,0 +1,382 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+from attr.validators import instance_of, deep_iterable
+
+from miniboss.docker_client import DockerClient
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(kw_only=True, frozen=True)
+class Backoff:
+    """Exponential backoff with jitter between the attempts of a readiness
+    probe. The delay starts with `initial` seconds, is multiplied by `factor`
+    after every attempt up to `maximum`, and randomized by +/- `jitter` times
+    its value."""
+    initial = attr.ib(default=0.1, validator=instance_of((int, float)))
+    maximum = attr.ib(default=2.0, validator=instance_of((int, float)))
+    factor = attr.ib(default=2.0, validator=instance_of((int, float)))
+    jitter = attr.ib(default=0.1, validator=instance_of((int, float)))
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            yield delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay = min(delay * self.factor, self.maximum)
+
+
+def published_address(host, port, ports):
+    """The address at which a container port is reachable from the host. `ports`
+    are the port bindings of a service, which can be in any of the formats
+    docker-py accepts: a host port, a (host ip, host port) tuple, a (host ip,)
+    tuple, or a list of these."""
+    binding = ports.get(port)
+    if isinstance(binding, list):
+        binding = binding[0] if binding else None
+    if isinstance(binding, tuple):
+        # A (host ip,) binding publishes on a random port, which we can't know
+        if len(binding) < 2:
+            return (host, port)
+        host_ip, host_port = binding[0], binding[1]
+        if host_ip and host_ip not in ('0.0.0.0', '::'):
+            host = host_ip
+        return (host, int(host_port))
+    if binding is None:
+        return (host, port)
+    return (host, int(binding))
+
+
+class Probe:
+    """Base class for declarative readiness probes, which are set as the
+    `readiness` field of a service and used instead of its `ping` method."""
+    backoff = Backoff()
+    # Maximum duration of a single attempt, in seconds
+    attempt_timeout = 2.0
+
+
+@attr.s(frozen=True)
+class TcpProbe(Probe):
+    """Ready when a TCP connection to `port` stays open for `settle` seconds or
+    receives data; the host port is used if `port` is published. docker-proxy
+    accepts connections before the container listens, so prefer `HttpProbe` or
+    `ExecProbe` for services that accept connections before they can serve them."""
+    port = attr.ib(validator=instance_of(int))
+    host = attr.ib(default="localhost", kw_only=True, validator=instance_of(str))
+    settle = attr.ib(default=0.2, kw_only=True, validator=instance_of((int, float)))
+    backoff = attr.ib(default=Backoff(), kw_only=True, validator=instance_of(Backoff))
+
+    def address(self, service):
+        return published_address(self.host, self.port, service.ports)
+
+    def request(self):
+        # pylint: disable=no-self-use
+        return None
+
+    def check_response(self, data):
+        """Return None while nothing was received; a connection closed without
+        data counts as a failure"""
+        # pylint: disable=no-self-use
+        return True if data else None
+
+
+@attr.s(frozen=True)
+class HttpProbe(Probe):
+    """Ready when a GET request to `path` returns a status code below 400."""
+    path = attr.ib(validator=instance_of(str))
+    port = attr.ib(default=80, kw_only=True, validator=instance_of(int))
+    host = attr.ib(default="localhost", kw_only=True, validator=instance_of(str))
+    backoff = attr.ib(default=Backoff(), kw_only=True, validator=instance_of(Backoff))
+
+    def address(self, service):
+        return published_address(self.host, self.port, service.ports)
+
+    def request(self):
+        return "GET {:s} HTTP/1.0\r\nHost: {:s}\r\n\r\n".format(self.path, self.host).encode()
+
+    def check_response(self, data):
+        """Return None if more data is needed to decide, otherwise whether the
+        response status signals success"""
+        # pylint: disable=no-self-use
+        if b"\r\n" not in data:
+            return None
+        status_line = data.split(b"\r\n", 1)[0].split()
+        try:
+            return len(status_line) > 1 and int(status_line[1]) < 400
+        except ValueError:
+            return False
+
+
+@attr.s(frozen=True)
+class ExecProbe(Probe):
+    """Ready when `command` exits with code 0 inside the service container."""
+    command = attr.ib(validator=deep_iterable(member_validator=instance_of(str)))
+    backoff = attr.ib(default=Backoff(), kw_only=True, validator=instance_of(Backoff))
+
+    def run(self, container_name):
+        client = DockerClient.get_client()
+        return client.exec_in_container(container_name, list(self.command)) == 0
+
+
+def _resolve(host, port):
+    # Docker publishes ports on IPv4 in any case, so prefer it to IPv6
+    addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses.sort(key=lambda address: address[0] != socket.AF_INET)
+    family, _, _, _, sockaddr = addresses[0]
+    return family, sockaddr
+
+
+class _Check:
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+    def __init__(self, probe, service, container_name, deadline, callback):
+        self.probe = probe
+        self.service = service
+        self.container_name = container_name
+        self.deadline = deadline
+        self.callback = callback
+        self.sockaddr = None
+        self.family = socket.AF_INET
+        self.delays = probe.backoff.delays()
+        self.attempt = 0
+        self.attempts_made = 0
+        self.sock = None
+        self.outgoing = b""
+        self.incoming = b""
+        self.done = False
+        # Context of the agent, so that the API calls of exec probes are
+        # attributed to its service
+        self.context = contextvars.copy_context()
+
+
+class ProbeLoop:
+    """A single thread that drives the readiness probes of all services, using
+    non-blocking sockets multiplexed with a selector. Exec probes, which need a
+    blocking call to the Docker daemon, are run on a small shared thread pool."""
+    _instance = None
+    _instance_lock = threading.Lock()
+    exec_workers = 4
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._exec_pool = ThreadPoolExecutor(max_workers=self.exec_workers,
+                                             thread_name_prefix="miniboss-probe")
+        self._thread = threading.Thread(target=self._run, name="miniboss-probes", daemon=True)
+        self._thread.start()
+
+    # Public interface, to be called from any thread
+
+    def submit(self, probe, service, container_name, timeout, callback):
+        """Start checking `probe` for `service`, calling `callback` with True once it
+        succeeds, or with False if it does not within `timeout` seconds. The
+        callback is called on the probe loop thread and should return quickly.
+        Returns a function that can be called to abort the check, e.g. when the
+        container exits."""
+        check = _Check(probe, service, container_name, time.monotonic() + timeout, callback)
+        if not isinstance(probe, ExecProbe):
+            # Resolve the address on the calling thread, so that name lookups
+            # don't block the loop
+            try:
+                check.family, check.sockaddr = _resolve(*probe.address(service))
+            except (OSError, TypeError, ValueError) as exc:
+                logger.error("Could not resolve the address of readiness probe for %s: %s",
+                             service.name, exc)
+        def start():
+            self._schedule(check.deadline, lambda: self._abort(check))
+            self._start_attempt(check)
+        self._post(start)
+        return lambda: self._post(lambda: self._abort(check))
+
+    def check(self, probe, service, container_name, timeout, on_submit=None):
+        """Blocking variant of `submit` that returns whether the probe succeeded.
+        `on_submit` is called with the abort function of the check."""
+        finished = threading.Event()
+        result = []
+        def callback(success):
+            result.append(success)
+            finished.set()
+        abort = self.submit(probe, service, container_name, timeout, callback)
+        if on_submit is not None:
+            on_submit(abort)
+        # The loop finishes the check at its deadline; the margin is only a
+        # backstop in case it does not
+        if not finished.wait(timeout + probe.attempt_timeout):
+            abort()
+            return False
+        return result[0]
+
+    # Internals, running on the loop thread
+
+    def _post(self, func):
+        with self._pending_lock:
+            self._pending.append(func)
+        self._wakeup_write.send(b"\0")
+
+    def _schedule(self, when, func):
+        heapq.heappush(self._timers, (when, next(self._sequence), func))
+
+    def _call(self, func, *args):
+        # An error in a single check should never stop the loop thread, which
+        # is shared by all of them
+        try:
+            func(*args)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Error in readiness probe loop")
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    self._drain_pending()
+                else:
+                    self._call(self._on_socket_ready, key.data)
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, func = heapq.heappop(self._timers)
+                self._call(func)
+
+    def _drain_pending(self):
+        try:
+            while self._wakeup_read.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        for func in pending:
+            self._call(func)
+
+    def _finish(self, check, success):
+        check.done = True
+        if not success:
+            logger.info("Readiness probe for %s failed after %d attempts",
+                        check.service.name, check.attempts_made)
+        self._call(check.callback, success)
+
+    def _start_attempt(self, check):
+        if check.done:
+            return
+        if time.monotonic() >= check.deadline:
+            self._finish(check, False)
+            return
+        check.attempt += 1
+        check.attempts_made += 1
+        attempt = check.attempt
+        self._schedule(time.monotonic() + check.probe.attempt_timeout,
+                       lambda: self._attempt_finished(check, attempt, False))
+        if isinstance(check.probe, ExecProbe):
+            # Attempts can overlap if one times out, and a context can be
+            # entered by only one thread at a time
+            future = self._exec_pool.submit(check.context.copy().run, check.probe.run,
+                                            check.container_name)
+            def exec_done(future):
+                success = future.exception() is None and future.result()
+                self._post(lambda: self._attempt_finished(check, attempt, success))
+            future.add_done_callback(exec_done)
+            return
+        try:
+            if check.sockaddr is None:
+                raise OSError("Address of probe could not be resolved")
+            check.sock = socket.socket(check.family, socket.SOCK_STREAM)
+            check.sock.setblocking(False)
+            check.outgoing = check.probe.request() or b""
+            check.incoming = b""
+            check.sock.connect_ex(check.sockaddr)
+            self.selector.register(check.sock, selectors.EVENT_WRITE, check)
+        except Exception: # pylint: disable=broad-except
+            logger.debug("Readiness probe attempt for %s failed", check.service.name,
+                         exc_info=True)
+            self._attempt_finished(check, attempt, False)
+
+    def _on_socket_ready(self, check):
+        sock = check.sock
+        attempt = check.attempt
+        try:
+            if self.selector.get_key(sock).events & selectors.EVENT_WRITE:
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    self._attempt_finished(check, attempt, False)
+                    return
+                if check.outgoing:
+                    sent = sock.send(check.outgoing)
+                    check.outgoing = check.outgoing[sent:]
+                    if not check.outgoing:
+                        self.selector.modify(sock, selectors.EVENT_READ, check)
+                    return
+                if check.probe.request() is None:
+                    # The connection might have been accepted by docker-proxy,
+                    # which closes it if nothing listens in the container, so
+                    # it has to stay open for a while
+                    self.selector.modify(sock, selectors.EVENT_READ, check)
+                    self._schedule(time.monotonic() + check.probe.settle,
+                                   lambda: self._attempt_finished(check, attempt, True))
+                    return
+                self.selector.modify(sock, selectors.EVENT_READ, check)
+                return
+            data = sock.recv(4096)
+            check.incoming += data
+            result = check.probe.check_response(check.incoming)
+            if result is None and not data:
+                result = False
+            if result is not None:
+                self._attempt_finished(check, attempt, result)
+        except OSError:
+            self._attempt_finished(check, attempt, False)
+
+    def _abort(self, check):
+        if check.done:
+            return
+        self._close(check)
+        self._finish(check, False)
+
+    def _close(self, check):
+        if check.sock is not None:
+            try:
+                self.selector.unregister(check.sock)
+            except (KeyError, ValueError):
+                # The socket was not registered yet
+                pass
+            check.sock.close()
+            check.sock = None
+
+    def _attempt_finished(self, check, attempt, success):
+        if check.done or attempt != check.attempt:
+            # Result of an attempt that already timed out
+            return
+        check.attempt += 1
+        self._close(check)
+        if success:
+            self._finish(check, True)
+            return
+        remaining = check.deadline - time.monotonic()
+        if remaining <= 0:
+            self._finish(check, False)
+            return
+        delay = min(next(check.delays), remaining)
+        self._schedule(time.monotonic() + delay, lambda: self._start_attempt(check))
@@ -0,0 +1,41 @@
+import json
+import logging
+
+from miniboss.plan import gating_dependency
+
+logger = logging.getLogger(__name__)
+
+
+def _relative(timestamp, origin):
+    if timestamp is None:
+        return None
+    return timestamp - origin
+
+
+def run_report(agents, started_at, ended_at):
+    """Timings of a run as a JSON-serializable dict, in seconds since its start"""
+    services = {}
+    for service, agent in agents.items():
+        run_condition = agent.run_condition
+        gated_by = gating_dependency(service, agents)
+        services[service.name] = {
+            'state': run_condition.state,
+            'phases': dict(run_condition.durations),
+            'timeline': [{'phase': phase,
+                          'start': start - started_at,
+                          'end': end - started_at}
+                         for phase, start, end in sorted(run_condition.phases,
+                                                         key=lambda phase: phase[1])],
+            'ready': _relative(run_condition.ready_at, started_at),
+            'dispatched': _relative(run_condition.dispatched_at, started_at),
+            'finished': _relative(run_condition.finished_at, started_at),
+            'queue_wait': run_condition.queue_wait,
+            'gated_by': gated_by.name if gated_by is not None else None,
+        }
+    return {'wall_time': ended_at - started_at, 'services': services}
+
+
+def write_report(path, report):
+    with open(path, 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    logger.info("Wrote timings of the run to %s", path)
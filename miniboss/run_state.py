@@ -0,0 +1,63 @@
+import json
+import os
+import pathlib
+import logging
+
+from miniboss.containers import LABEL_FINGERPRINT
+from miniboss.types import RunCondition
+
+logger = logging.getLogger(__name__)
+
+
+class RunState:
+    """State, container and fingerprint of each service in the last start"""
+    filename = ".miniboss-run-state"
+
+    def __init__(self, services=None):
+        self.services = services or {}
+
+    @classmethod
+    def load_from(cls, directory):
+        path = pathlib.Path(directory) / cls.filename
+        try:
+            with open(path, 'r', encoding='utf-8') as state_file:
+                return cls(json.load(state_file))
+        except FileNotFoundError:
+            logger.info("No miniboss run state file in %s", directory)
+        except ValueError:
+            logger.warning("Could not parse miniboss run state file in %s, ignoring it",
+                           directory)
+        return cls()
+
+    def save_to(self, directory):
+        # Written to a temporary file first, so that an interrupted write does
+        # not leave a truncated file behind
+        path = pathlib.Path(directory) / self.filename
+        temporary = path.with_name("{:s}.{:d}.tmp".format(self.filename, os.getpid()))
+        with open(temporary, 'w', encoding='utf-8') as state_file:
+            state_file.write(json.dumps(self.services))
+        os.replace(temporary, path)
+
+    @classmethod
+    def remove_file(cls, directory):
+        path = pathlib.Path(directory) / cls.filename
+        if path.exists():
+            path.unlink()
+
+    def record(self, service_name, run_condition: RunCondition, container_name, fingerprint):
+        self.services[service_name] = {'state': run_condition.state,
+                                       'container': container_name,
+                                       'fingerprint': fingerprint}
+
+    def confirmed(self, service_name, containers):
+        """Whether the service is still running in the container of the last start"""
+        recorded = self.services.get(service_name)
+        if recorded is None or recorded['state'] != RunCondition.RUNNING:
+            return False
+        for container in containers:
+            if container.name != recorded['container'] or container.status != 'running':
+                continue
+            if recorded['fingerprint'] is None:
+                return True
+            return container.labels.get(LABEL_FINGERPRINT) == recorded['fingerprint']
+        return False
@@ -1,17 +1,39 @@
+import itertools
+import logging
+import queue
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from miniboss.service_agent import (ServiceAgent,
-                                    Options)
+                                    Options,
+                                    builds_image)
+from miniboss.executors import get_executor
+from miniboss.graph import ServiceGraph
+
+logger = logging.getLogger(__name__)
 
 class RunningContext:
 
-    def __init__(self, services_by_name, options: Options):
+    def __init__(self, services_by_name, options: Options, priorities=None):
         super().__init__()
-        self.agent_set = {service: ServiceAgent(service, options, self)
+        self.options = options
+        self.executor = get_executor(options)
+        # Pools of the stages that run ahead of the dependency order
+        self.stage_pools = []
+        self.agent_set = {service: ServiceAgent(service, options, self, self.executor)
                           for name, service in services_by_name.items()}
+        self.agents = dict(self.agent_set)
+        self.graph = ServiceGraph(self.agent_set.keys())
         self.failed_services = []
         self.processed_services = []
         self.service_pop_lock = threading.Lock()
+        # Agents that became ready because a dependency (or dependant, when
+        # stopping) finished are put on this queue, the ones with the highest
+        # priority first; None is used to wake up the dispatching thread when
+        # the context is done or failed.
+        self.priorities = priorities or {}
+        self.ready_queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
 
     @property
     def done(self):
@@ -21,6 +43,10 @@ class RunningContext:
     def context_failed(self):
         return self.failed_services != []
 
+    @property
+    def finished(self):
+        return self.done or self.context_failed
+
     @property
     def ready_to_start(self):
         return [x for x in self.agent_set.values() if x.can_start]
@@ -29,26 +55,114 @@ class RunningContext:
     def ready_to_stop(self):
         return [x for x in self.agent_set.values() if x.can_stop]
 
+    def _stage_pool(self, size, name):
+        pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix=name)
+        self.stage_pools.append(pool)
+        return pool
+
+    def schedule_builds(self):
+        """Start building the images of the services that are built instead of
+        pulled right away, on a pool of their own, instead of when the
+        dependencies of the services are running"""
+        agents = [agent for agent in self.agents.values()
+                  if builds_image(agent.service, self.options) and not agent.resumed]
+        if not agents:
+            return
+        pool = self._stage_pool(self.options.build_parallelism or len(agents), "miniboss-build")
+        for agent in agents:
+            agent.image_build = pool.submit(agent.build_image)
+
+    def schedule_precreation(self):
+        """Create the containers of the services that do not depend on the context
+        right away, so that they only have to be started once the dependencies
+        are running"""
+        agents = [agent for agent in self.agents.values() if agent.can_precreate]
+        if not agents:
+            return
+        pool = self._stage_pool(self.options.container_parallelism or len(agents),
+                                "miniboss-create")
+        for agent in agents:
+            agent.precreation = pool.submit(agent.precreate)
+
+    def finish_stages(self):
+        """Wait for the running builds and container creations, cancelling the ones
+        not started yet, and remove the containers that were not used"""
+        for pool in self.stage_pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+        for agent in self.agents.values():
+            try:
+                agent.remove_precreated()
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Error removing container of service %s", agent.service.name)
+
+    def queue_ready(self, agents):
+        for agent in agents:
+            self._put(agent)
+
+    def next_ready(self):
+        """Block until an agent is ready to be dispatched, or the context is finished,
+        in which case None is returned."""
+        while not self.finished:
+            _, _, agent = self.ready_queue.get()
+            if agent is not None and not self.finished:
+                return agent
+        return None
+
+    def _put(self, agent):
+        agent.run_condition.ready()
+        priority = -self.priorities.get(agent.service, 0)
+        self.ready_queue.put((priority, next(self._sequence), agent))
+
+    def _wake_up(self):
+        self.ready_queue.put((float('-inf'), next(self._sequence), None))
+
     def service_failed(self, failed_service):
+        """Register a service as failed, together with all the services that depend
+        on it directly or indirectly and are not finished yet."""
         with self.service_pop_lock:
+            if failed_service not in self.agent_set:
+                # Registered as failed already together with a dependency
+                return
             self.agent_set.pop(failed_service)
             self.failed_services.append(failed_service)
-        services_left = list(self.agent_set.keys())
-        for service in services_left:
-            if failed_service in service.dependencies:
-                self.service_failed(service)
+            for service in self.graph.transitive_dependants(failed_service):
+                if service in self.agent_set:
+                    self.agent_set.pop(service)
+                    self.failed_services.append(service)
+        self._wake_up()
+
+    def service_progressed(self, service, stage):
+        """Register a service that got to a stage before finishing post_start, and
+        queue the dependants that were waiting only for that"""
+        with self.service_pop_lock:
+            for dependant in self.graph.dependants[service]:
+                agent = self.agent_set.get(dependant)
+                if agent and agent.process_service_progressed(service, stage):
+                    self._put(agent)
 
     def service_started(self, started_service):
         with self.service_pop_lock:
+            if started_service not in self.agent_set:
+                # Registered as failed already, because a dependency failed
+                # after the service was started
+                return
             self.agent_set.pop(started_service)
             self.processed_services.append(started_service)
-            for agent in self.agent_set.values():
-                agent.process_service_started(started_service)
+            for service in self.graph.dependants[started_service]:
+                agent = self.agent_set.get(service)
+                if agent and agent.process_service_started(started_service):
+                    self._put(agent)
+            if self.done:
+                self._wake_up()
 
 
     def service_stopped(self, stopped_service):
         with self.service_pop_lock:
             self.agent_set.pop(stopped_service)
             self.processed_services.append(stopped_service)
-            for agent in self.agent_set.values():
-                agent.process_service_stopped(stopped_service)
+            for service in self.graph.dependencies[stopped_service]:
+                agent = self.agent_set.get(service)
+                if agent and agent.process_service_stopped(stopped_service):
+                    self._put(agent)
+            if self.done:
+                self._wake_up()
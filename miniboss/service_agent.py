@@ -1,18 +1,27 @@
+import asyncio
+import functools
 import os
-import threading
 import time
-from datetime import datetime
 import logging
 
 from miniboss import types
-from miniboss.docker_client import DockerClient
+from miniboss.api_ledger import attributed
+from miniboss.build_context import context_digest, TAG_DIGEST_LENGTH
+from miniboss.containers import LABEL_FINGERPRINT
+from miniboss.docker_client import DockerClient, definition_fingerprint
 from miniboss.context import Context
-from miniboss.types import AgentStatus, RunCondition, Actions, Options
-from miniboss.exceptions import ServiceAgentException
+from miniboss.executors import ThreadPerAgentExecutor
+from miniboss.probes import ProbeLoop
+from miniboss.snapshots import load_snapshot, restore_volumes, save_snapshot, snapshot_key
+from miniboss.types import AgentStatus, RunCondition, Actions, Options, WaitFor
+from miniboss.exceptions import ContainerStartException, ServiceAgentException
 
 logger = logging.getLogger(__name__)
 
 def container_env(container):
+    if 'Env' not in container.attrs['Config']:
+        # Containers looked up in a listing snapshot contain only a summary
+        container.reload()
     env = container.attrs['Config']['Env']
     retval = {}
     for env_line in env:
@@ -30,19 +39,52 @@ def differing_keys(specified, existing):
     return [key for key,value in specified.items() if str(value) != existing.get(key)]
 
 
-class ServiceAgent(threading.Thread):
+def call_hook(hook):
+    """Call a lifecycle hook of a service, which can be either a plain method or a
+    coroutine function; the latter is run on an event loop of its own."""
+    if asyncio.iscoroutinefunction(hook):
+        return asyncio.run(hook())
+    return hook()
 
-    def __init__(self, service, options: Options, context):
+
+def builds_image(service, options):
+    """Whether the image of the service is built instead of pulled when starting it"""
+    return (service.name in options.build
+            or bool(service.build_from and service.image.endswith(':latest')))
+
+
+# Statuses of containers that can be started
+STOPPED_STATES = ('exited', 'created')
+
+
+class ServiceAgent:
+    # pylint: disable=too-many-public-methods
+
+    def __init__(self, service, options: Options, context, executor=None):
         # service: Service
         # context: RunningContext
-        super().__init__()
+        # executor: executors.AgentExecutor
         self.service = service
         self.options = options
         self.context = context
+        self.executor = executor or ThreadPerAgentExecutor()
         self.open_dependencies = service.dependencies[:]
         self.open_dependants = service.dependants[:]
         self.run_condition = RunCondition()
         self.status = AgentStatus.NULL
+        self.container_name = None
+        self.fingerprint = None
+        # Future of the image build, if it was scheduled before the agent started
+        self.image_build = None
+        # Future of the id and name of the container created before the
+        # dependencies were running
+        self.precreation = None
+        self.precreated = None
+        # Whether the context values were filled into the environment, which
+        # must happen only once, as it also unescapes braces
+        self.env_extrapolated = False
+        # Set if the service is running since the last start, which is resumed
+        self.resumed = False
         self._action = None
 
     def __repr__(self):
@@ -70,128 +112,432 @@ class ServiceAgent(threading.Thread):
     def container_name_prefix(self):
         return "{:s}-{:s}".format(self.service.name, types.group_name)
 
+    def dependency_stage(self, dependency):
+        """How far the dependency has to get before this service can be started"""
+        return self.service.wait_for.get(dependency.name, WaitFor.POST_STARTED)
+
+    @property
+    def waits_for_context(self):
+        """Whether the environment refers to context keys which dependencies that
+        are not waited for until the end of their post_start might still set"""
+        return (any(self.dependency_stage(dependency) != WaitFor.POST_STARTED
+                    for dependency in self.service.dependencies)
+                and bool(Context.keys_used(self.service.env)))
+
+    def process_service_progressed(self, service, stage):
+        """Register a dependency that got to a stage before post_start finished,
+        returning True if the agent waited only for this and can now be
+        started."""
+        if service in self.open_dependencies and self.dependency_stage(service) == stage:
+            self.open_dependencies.remove(service)
+            return self.can_start
+        return False
+
     def process_service_started(self, service):
+        """Register a started dependency, returning True if this was the last open
+        dependency and the agent can now be started."""
         if service in self.open_dependencies:
             self.open_dependencies.remove(service)
+            return self.can_start
+        return False
 
     def process_service_stopped(self, service):
+        """Register a stopped dependant, returning True if this was the last open
+        dependant and the agent can now be stopped."""
         if service in self.open_dependants:
             self.open_dependants.remove(service)
+            return self.can_stop
+        return False
 
+    @attributed
     def build_image(self):
         client = DockerClient.get_client()
-        time_tag = datetime.now().strftime("%Y-%m-%d-%H%M")
-        image_tag = "{:s}-{:s}".format(self.service.name, time_tag)
         build_dir = os.path.join(self.options.run_dir, self.service.build_from)
-        logger.info("Building image with tag %s for service %s from directory %s",
-                    image_tag, self.service.name, build_dir)
-        client.build_image(build_dir, self.service.dockerfile, image_tag)
+        with self.executor.image_slot, self.run_condition.timed(RunCondition.BUILD_IMAGE):
+            # Images are tagged with the hash of their sources, so that a build can
+            # be skipped if nothing changed
+            digest = context_digest(build_dir, self.service.dockerfile)
+            image_tag = "{:s}:{:s}".format(self.service.name, digest[:TAG_DIGEST_LENGTH])
+            if client.image_exists(image_tag):
+                logger.info("Image %s for service %s is up to date, not building",
+                            image_tag, self.service.name)
+                return image_tag
+            logger.info("Building image with tag %s for service %s from directory %s",
+                        image_tag, self.service.name, build_dir)
+            client.build_image(build_dir, self.service.dockerfile, image_tag,
+                               spool=self.service.spool_build_context)
         self.run_condition.build_image()
         return image_tag
 
-    def _start_existing(self, existings):
-        # pylint: disable=fixme
-        # TODO fix this; it should be able to deal with multiple existing
-        # containers
-        existing = existings[0]
+    def built_image(self):
+        """Tag of the built image, waiting for the build if it was scheduled already"""
+        if self.image_build is None:
+            return self.build_image()
+        return self.image_build.result()
+
+    def _set_fingerprint(self, image_id):
+        self.fingerprint = definition_fingerprint(self.service, image_id)
+        return self.fingerprint
+
+    def check_image(self):
+        """Make sure the image of the service exists, and return the fingerprint of
+        the service definition. This is done only once per agent, because the
+        fingerprint is needed both for deciding on reuse and as a label of a new
+        container."""
+        if self.fingerprint is None:
+            client = DockerClient.get_client()
+            with self.executor.image_slot, self.run_condition.timed(RunCondition.PULL):
+                image_id = client.check_image(self.service.image)
+            self._set_fingerprint(image_id)
+        return self.fingerprint
+
+    def _matches_definition(self, existing, fingerprint):
+        labels = existing.labels
+        if LABEL_FINGERPRINT in labels:
+            if labels[LABEL_FINGERPRINT] != fingerprint:
+                logger.info("Definition of service %s changed since container %s was created",
+                            self.service.name, existing.name)
+                return False
+            return True
+        # Containers created before fingerprints were added to the labels
+        existing_env = container_env(existing)
+        diff_keys = differing_keys(self.service.env, existing_env)
+        if diff_keys:
+            logger.info("Differing env key(s) in existing container for service %s: %s",
+                        self.service.name, ",".join(diff_keys))
+        return self.service.image in existing.image.tags and not diff_keys
+
+    def _reusable_existing(self, existings):
+        """Return the existing container that can be used instead of creating a new
+        one, or None if a new container has to be created. Exited containers of
+        the service that are not used are removed."""
+        reusable = next((x for x in existings if x.status == 'running'), None)
+        if reusable is None and not self.service.always_start_new:
+            fingerprint = self.check_image()
+            reusable = next((x for x in existings if x.status in STOPPED_STATES
+                             and self._matches_definition(x, fingerprint)),
+                            None)
+        stale = [x for x in existings if x is not reusable and x.status in STOPPED_STATES]
+        for existing in stale:
+            existing.remove()
+            logger.info("Removed stale container %s of service %s",
+                        existing.name, self.service.name)
+        if stale:
+            DockerClient.get_client().invalidate_containers(self.service.name)
+        return reusable
+
+    def _existing_to_start(self, existings):
+        """Decide what to do with the existing containers of the service, returning
+        the container that should be started, or None if there is none or one is
+        already running."""
+        existing = self._reusable_existing(existings)
+        if existing is None:
+            return None
         if existing.status == 'running':
             logger.info("Found running container for %s, not starting a new one",
                         self.service.name)
             self.run_condition.already_running()
+            self.container_name = existing.name
+            return None
+        logger.info("There is an existing container for %s, not creating a new one",
+                    self.service.name)
+        self.run_condition.started()
+        self.container_name = existing.name
+        return existing
+
+    def _hook_defined(self, hook_name):
+        # pylint: disable=import-outside-toplevel, cyclic-import
+        from miniboss.services import Service
+        return getattr(self.service, hook_name).__func__ is not getattr(Service, hook_name)
+
+    def _hook_ran(self, hook_name):
+        if self._hook_defined(hook_name):
+            logger.info("%s for service %s ran", hook_name, self.service.name)
+
+    @property
+    def can_precreate(self):
+        """Whether the container of the service can be created before its
+        dependencies are running. This is not possible if the environment uses
+        context values, which the dependencies can set, if a pre_start hook can
+        change the definition, if the image is built, or if the container might
+        be restored from a snapshot."""
+        return not (any(Context.uses_context(value) for value in self.service.env.values())
+                    or self._hook_defined('pre_start')
+                    or builds_image(self.service, self.options)
+                    or self.service.snapshot
+                    or self.resumed)
+
+    def extrapolate_env(self):
+        """Fill the context values into the environment of the service, unless
+        this was already done"""
+        if not self.env_extrapolated:
+            self.service.env = Context.extrapolate_values(self.service.env)
+            self.env_extrapolated = True
+
+    @attributed
+    def precreate(self):
+        """Create the container of the service, unless there are existing ones that
+        are handled when the service is started. Returns the container id and
+        name, or None."""
+        client = DockerClient.get_client()
+        # The environment does not use the context, but can contain escaped
+        # braces, so that it has to be extrapolated like on a normal start
+        self.extrapolate_env()
+        if client.service_containers(self.service.name, self.options.network):
+            return None
+        fingerprint = self.check_image()
+        with self.executor.container_slot, self.run_condition.timed(RunCondition.CREATE):
+            return client.create_service_container(self.container_name_prefix, self.service,
+                                                   self.options.network, fingerprint)
+
+    def _wait_for_precreation(self):
+        try:
+            self.precreated = self.precreation.result()
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not create container of service %s in advance",
+                             self.service.name)
+
+    @attributed
+    def remove_precreated(self):
+        """Remove the container created in advance if the service was not started
+        with it. Called once the run is finished."""
+        if (self.precreation is None or self.precreation.cancelled()
+                or self.precreation.exception() is not None
+                or self.precreation.result() is None
+                or RunCondition.START in self.run_condition.actions):
+            return
+        container_id, container_name = self.precreation.result()
+        DockerClient.get_client().remove_container(container_id)
+        logger.info("Removed unused container %s of service %s",
+                    container_name, self.service.name)
+
+    def _run_new_container(self, client, fingerprint, snapshot=None):
+        if snapshot is not None:
+            container_id, container_name = client.create_service_container(
+                self.container_name_prefix, self.service, self.options.network, fingerprint,
+                image=snapshot.image)
+            restore_volumes(client, self.options.run_dir, snapshot, container_id)
+            # Restore the context values that the hooks would set
+            Context.update(snapshot.context)
+        elif self.precreated is not None:
+            container_id, container_name = self.precreated
+            logger.info("Starting container %s created in advance for service %s",
+                        container_name, self.service.name)
+        else:
+            return client.run_service_on_network(self.container_name_prefix,
+                                                 self.service,
+                                                 self.options.network,
+                                                 fingerprint)
+        client.run_container(container_id)
+        return container_name
+
+    def _load_snapshot(self):
+        """The snapshot from which the container of the service can be restored
+        instead of running the hooks, if the service opted in and there is one
+        for its current definition"""
+        if not self.service.snapshot:
+            return None
+        key = snapshot_key(self.service, self.check_image())
+        snapshot = load_snapshot(DockerClient.get_client(), self.options.run_dir, key)
+        if snapshot is not None:
+            logger.info("Restoring service %s from snapshot %s, not running the hooks",
+                        self.service.name, snapshot.image)
+        return snapshot
+
+    def _save_snapshot(self, hook_keys):
+        """Snapshot the container after the post_start hook ran, together with the
+        context values that the hooks of the service set"""
+        if not self.service.snapshot:
+            return
+        context_values = {key: Context[key] for key in hook_keys if key in Context}
+        try:
+            with self.run_condition.timed(RunCondition.SNAPSHOT):
+                snapshot = save_snapshot(DockerClient.get_client(), self.options.run_dir,
+                                         snapshot_key(self.service, self.fingerprint),
+                                         self.container_name, context_values)
+            logger.info("Saved snapshot %s of service %s", snapshot.image, self.service.name)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not save snapshot of service %s", self.service.name)
+
+    def _start_existing(self, existings):
+        existing = self._existing_to_start(existings)
+        if existing is None:
             return
         client = DockerClient.get_client()
-        if existing.status == 'exited':
-            existing_env = container_env(existing)
-            diff_keys = differing_keys(self.service.env, existing_env)
-            if diff_keys:
-                logger.info("Differing env key(s) in existing container for service %s: %s",
-                            self.service.name, ",".join(diff_keys))
-            start_new = (self.service.always_start_new or
-                         self.service.image not in existing.image.tags or
-                         bool(diff_keys))
-            if not start_new:
-                logger.info("There is an existing container for %s, not creating a new one",
-                            self.service.name)
-                self.run_condition.started()
-                client.run_container(existing.id)
-                if not self.ping():
-                    self._fail()
+        with self.executor.container_slot, self.run_condition.timed(RunCondition.START):
+            client.run_container(existing.id, existing.labels)
+        client.invalidate_containers(self.service.name)
+        self.context.service_progressed(self.service, WaitFor.STARTED)
+        if not self.ping():
+            self._fail()
+            return
+        self.context.service_progressed(self.service, WaitFor.PINGED)
+
+    def dependencies_finished(self):
+        """Whether all dependencies finished their post_start, or skipped it, so
+        that the context values they set are final"""
+        return all(dependency in self.context.processed_services
+                   for dependency in self.service.dependencies)
+
+    def _wait_for_context(self):
+        """Wait until the context keys the environment refers to are set in this
+        run, if dependencies that can set them are still running their hooks.
+        Values from an earlier run are used once the dependencies are finished."""
+        if not self.waits_for_context:
+            return
+        keys = Context.keys_used(self.service.env)
+        if not (Context.wait_for_keys(keys, self.options.timeout,
+                                      abort=lambda: (self.context.context_failed
+                                                     or self.dependencies_finished()))
+                or self.dependencies_finished()):
+            logger.error("Context keys for service %s were not set with timeout of %d",
+                         self.service.name, self.options.timeout)
 
 
     def run_image(self): # returns RunCondition
-        # pylint: disable=import-outside-toplevel, cyclic-import
-        from miniboss.services import Service
         client = DockerClient.get_client()
-        self.service.env = Context.extrapolate_values(self.service.env)
+        self._wait_for_context()
+        if self.precreation is not None:
+            self._wait_for_precreation()
+        self.extrapolate_env()
         # If there are any running with the name prefix, connected to the same
         # network, skip creating
-        existings = client.existing_on_network(self.container_name_prefix,
-                                               self.options.network)
+        existings = []
+        if self.precreated is None:
+            existings = client.service_containers(self.service.name, self.options.network)
         if existings:
             self._start_existing(existings)
             if self.run_condition.state in [RunCondition.STARTED, RunCondition.RUNNING]:
                 return
         logger.info("Creating new container for service %s", self.service.name)
-        self.service.pre_start()
-        if self.service.pre_start.__func__ is not Service.pre_start:
-            logger.info("pre_start for service %s ran", self.service.name)
-        self.run_condition.pre_started()
-        client.run_service_on_network(self.container_name_prefix,
-                                      self.service,
-                                      self.options.network)
+        snapshot = self._load_snapshot()
+        hook_keys = set()
+        if snapshot is None:
+            with self.run_condition.timed(RunCondition.PRE_START), Context.recording(hook_keys):
+                call_hook(self.service.pre_start)
+            self._hook_ran('pre_start')
+            self.run_condition.pre_started()
+        fingerprint = self.check_image()
+        with self.executor.container_slot, self.run_condition.timed(RunCondition.CREATE):
+            self.container_name = self._run_new_container(client, fingerprint, snapshot)
 
         self.run_condition.started()
+        self.context.service_progressed(self.service, WaitFor.STARTED)
         if not self.ping():
             self._fail()
             return
-        self.service.post_start()
-        self.run_condition.post_started()
-        if self.service.post_start.__func__ is not Service.post_start:
-            logger.info("post_start for service %s ran", self.service.name)
+        self.context.service_progressed(self.service, WaitFor.PINGED)
+        if snapshot is None:
+            with self.run_condition.timed(RunCondition.POST_START), Context.recording(hook_keys):
+                call_hook(self.service.post_start)
+            self.run_condition.post_started()
+            self._hook_ran('post_start')
+            self._save_snapshot(hook_keys)
+
+    def wait_until_healthy(self):
+        client = DockerClient.get_client()
+        if client.wait_until_healthy(self.container_name, self.options.timeout):
+            logger.info("Service %s is healthy", self.service.name)
+            self.run_condition.pinged()
+            return True
+        self._raise_if_exited(client)
+        logger.error("Service %s did not become healthy with timeout of %d",
+                     self.service.name, self.options.timeout)
+        return False
+
+    def _raise_if_exited(self, client):
+        """If the container of the service exited, raise an exception with its logs"""
+        logs = client.exit_logs(self.container_name)
+        if logs is not None:
+            raise ContainerStartException(logs, self.container_name)
+
+    def _log_ping_failure(self, message):
+        self._raise_if_exited(DockerClient.get_client())
+        logger.error("%s with timeout of %d", message, self.options.timeout)
 
     def ping(self):
-        start = time.monotonic()
-        while time.monotonic() - start < self.options.timeout:
-            if self.service.ping():
-                logger.info("Service %s pinged successfully", self.service.name)
-                self.run_condition.pinged()
-                return True
-            time.sleep(0.1)
+        with self.run_condition.timed(RunCondition.PING):
+            if self.service.wait_for_healthy:
+                return self.wait_until_healthy()
+            client = DockerClient.get_client()
+            if self.service.readiness is not None:
+                # Abort the probe right away if the container exits
+                on_submit = functools.partial(client.on_container_exit, self.container_name)
+                if ProbeLoop.get().check(self.service.readiness, self.service,
+                                         self.container_name, self.options.timeout,
+                                         on_submit=on_submit):
+                    logger.info("Readiness probe of service %s succeeded", self.service.name)
+                    self.run_condition.pinged()
+                    return True
+                self._log_ping_failure("Readiness probe failed")
+                return False
+            start = time.monotonic()
+            while time.monotonic() - start < self.options.timeout:
+                with self.run_condition.timed(RunCondition.PING_ATTEMPT, nested=True):
+                    pinged = call_hook(self.service.ping)
+                if pinged:
+                    logger.info("Service %s pinged successfully", self.service.name)
+                    self.run_condition.pinged()
+                    return True
+                self._raise_if_exited(client)
+                time.sleep(0.1)
         logger.error("Could not ping service with timeout of %d", self.options.timeout)
         return False
 
     def start_service(self):
         self.action = Actions.START
-        self.start()
+        self.executor.submit(self.run)
 
     def stop_service(self):
         self.action = Actions.STOP
-        self.start()
+        self.executor.submit(self.run)
 
+    @attributed
     def run(self):
-        if self.action is None:
-            self.status = AgentStatus.FAILED
-            self.context.service_failed(self.service)
-            raise ServiceAgentException("Agent cannot be started without an action set")
-        self.status = AgentStatus.IN_PROGRESS
-        if self.action == Actions.START:
-            self.start_container()
-        elif self.action == Actions.STOP:
-            self.stop_container()
+        self.run_condition.dispatched()
+        try:
+            if self.action is None:
+                self.status = AgentStatus.FAILED
+                self.context.service_failed(self.service)
+                raise ServiceAgentException("Agent cannot be started without an action set")
+            self.status = AgentStatus.IN_PROGRESS
+            if self.action == Actions.START:
+                self.start_container()
+            elif self.action == Actions.STOP:
+                self.stop_container()
+        finally:
+            self.run_condition.finished()
 
     def _fail(self):
         self.status = AgentStatus.FAILED
         self.run_condition.fail()
         self.context.service_failed(self.service)
         if RunCondition.START in self.run_condition.actions:
+            self._remove_failed_container()
+
+    def _remove_failed_container(self):
+        try:
             self._stop_container(remove=True)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Could not remove the container of failed service %s",
+                             self.service.name)
+
+    def resume(self):
+        """Register the service as started without going through its lifecycle,
+        because it is still running since the last start"""
+        logger.info("Service %s is running since the last start, not starting it",
+                    self.service.name)
+        self.run_condition.already_running()
+        self.status = AgentStatus.STARTED
+        self.context.service_started(self.service)
 
     def start_container(self):
-        if (self.service.name in self.options.build
-            or (self.service.build_from and self.service.image.endswith(':latest'))):
-            tag = self.build_image()
-            self.service.image = tag
+        if self.resumed:
+            self.resume()
+            return
         try:
+            if builds_image(self.service, self.options):
+                self.service.image = self.built_image()
             self.run_image()
         except Exception: # pylint: disable=broad-except
             logger.exception("Error starting service")
@@ -203,16 +549,17 @@ class ServiceAgent(threading.Thread):
 
     def _stop_container(self, remove):
         client = DockerClient.get_client()
-        existings = client.existing_on_network(self.container_name_prefix,
-                                               self.options.network)
+        existings = client.service_containers(self.service.name, self.options.network)
         if not existings:
             logging.info("No containers to stop for %s", self.service.name)
         for existing in existings:
             if existing.status == 'running':
-                existing.stop(timeout=self.options.timeout)
+                with self.run_condition.timed(RunCondition.STOP):
+                    existing.stop(timeout=self.options.timeout)
                 logging.info("Stopped container %s", existing.name)
             if remove:
-                existing.remove()
+                with self.run_condition.timed(RunCondition.REMOVE):
+                    existing.remove()
                 logging.info("Removed container %s", existing.name)
 
     def stop_container(self):
@@ -1,12 +1,24 @@
-import time
+import asyncio
+import contextlib
 import logging
-from collections import Counter, deque
+import time
+from collections import Counter
 from collections.abc import Mapping
 
 from miniboss import types
+from miniboss.api_ledger import ApiLedger
 from miniboss.docker_client import DockerClient
-from miniboss.types import Options, Network
+from miniboss.types import Options, Network, Engine, WaitFor
 from miniboss.running_context import RunningContext
+from miniboss.async_engine import AsyncRunningContext
+from miniboss.service_agent import builds_image
+from miniboss.history import StartHistory
+from miniboss.run_state import RunState
+from miniboss.report import run_report, write_report
+from miniboss.trace import TraceFormat, write_trace
+from miniboss.plan import Plan, gating_path
+from miniboss.graph import ServiceGraph
+from miniboss.probes import Probe
 from miniboss.context import Context
 from miniboss.exceptions import MinibossException, ServiceLoadError, ServiceDefinitionError
 
@@ -20,9 +32,10 @@ logger = logging.getLogger(__name__)
 KEYCLOAK_PORT = 8090
 OSTKREUZ_PORT = 8080
 ALLOWED_STOP_SIGNALS = ["SIGINT", "SIGTERM", "SIGKILL", "SIGQUIT"]
+ALLOWED_HEALTHCHECK_KEYS = ["test", "interval", "timeout", "retries", "start_period"]
 
 class ServiceMeta(type):
-    # pylint: disable=too-many-branches
+    # pylint: disable=too-many-branches, too-many-statements
     def __new__(cls, name, bases, attrdict):
         if not bases:
             return super().__new__(cls, name, bases, attrdict)
@@ -53,6 +66,14 @@ class ServiceMeta(type):
                 raise ServiceDefinitionError(
                     "Field 'dockerfile' of service class {:s} must be a non-empty string"
                     .format(name))
+        if "snapshot" in attrdict and not isinstance(attrdict["snapshot"], bool):
+            raise ServiceDefinitionError(
+                "Field 'snapshot' of service class {:s} must be a boolean".format(name))
+        if "spool_build_context" in attrdict and not isinstance(
+                attrdict["spool_build_context"], bool):
+            raise ServiceDefinitionError(
+                "Field 'spool_build_context' of service class {:s} must be a boolean".format(
+                    name))
         if "stop_signal" in attrdict:
             signal_name = attrdict["stop_signal"]
             if signal_name not in ALLOWED_STOP_SIGNALS:
@@ -73,6 +94,34 @@ class ServiceMeta(type):
                     if not isinstance(volume.get('bind'), str):
                         raise ServiceDefinitionError(
                             "Volume definitions have to specify 'bind' key")
+        if "wait_for_healthy" in attrdict and not isinstance(attrdict["wait_for_healthy"], bool):
+            raise ServiceDefinitionError(
+                "Field 'wait_for_healthy' of service class {:s} must be a boolean".format(name))
+        if attrdict.get("healthcheck") is not None:
+            healthcheck = attrdict["healthcheck"]
+            if not isinstance(healthcheck, Mapping):
+                raise ServiceDefinitionError(
+                    "Field 'healthcheck' of service class {:s} must be a mapping".format(name))
+            invalid_keys = [key for key in healthcheck if key not in ALLOWED_HEALTHCHECK_KEYS]
+            if invalid_keys:
+                raise ServiceDefinitionError(
+                    "Invalid healthcheck key(s) in service class {:s}: {:s}".format(
+                        name, ",".join(invalid_keys)))
+        if "wait_for" in attrdict:
+            wait_for = attrdict["wait_for"]
+            if not isinstance(wait_for, Mapping):
+                raise ServiceDefinitionError(
+                    "Field 'wait_for' of service class {:s} must be a mapping".format(name))
+            invalid = [value for value in wait_for.values() if value not in WaitFor.ALL]
+            if invalid:
+                raise ServiceDefinitionError(
+                    "Invalid value(s) in field 'wait_for' of service class {:s}: {}".format(
+                        name, ",".join(str(value) for value in invalid)))
+        if "readiness" in attrdict:
+            readiness = attrdict["readiness"]
+            if readiness is not None and not isinstance(readiness, Probe):
+                raise ServiceDefinitionError(
+                    "Field 'readiness' of service class {:s} must be a probe".format(name))
         return super().__new__(cls, name, bases, attrdict)
 
 
@@ -80,13 +129,19 @@ class Service(metaclass=ServiceMeta):
     name = None
     image = ""
     dependencies = []
+    wait_for = {}
     ports = {}
     env = {}
     always_start_new = False
     stop_signal = "SIGTERM"
     build_from = None
     dockerfile = "Dockerfile"
+    spool_build_context = False
     volumes = {}
+    readiness = None
+    wait_for_healthy = False
+    healthcheck = None
+    snapshot = False
 
     # pylint: disable=no-self-use
     def ping(self):
@@ -128,8 +183,12 @@ def connect_services(services):
                     "Dependency {:s} of service {:s} not among services".format(
                         service.name, dependency))
         service.dependencies = [all_by_name[dependency] for dependency in dependencies]
+    dependants = {service.name: [] for service in services}
+    for service in services:
+        for dependency in service.dependencies:
+            dependants[dependency.name].append(service)
     for service in services:
-        service.dependants = [x for x in services if service in x.dependencies]
+        service.dependants = dependants[service.name]
     return all_by_name
 
 class ServiceCollection:
@@ -139,6 +198,14 @@ class ServiceCollection:
         self._base_class = Service
         self.running_context = None
         self.excluded = []
+        # StartHistory used to start the services on the critical path first
+        self.history = None
+        # RunState in which the outcome of a start is recorded, and which is
+        # used for resuming the last start
+        self.run_state = None
+        # Monotonic start and end times of the last run
+        self.run_started = None
+        self.run_ended = None
 
     def load_definitions(self):
         services = self._base_class.__subclasses__()
@@ -146,6 +213,7 @@ class ServiceCollection:
             raise ServiceLoadError("No services defined")
         self.all_by_name = connect_services(list(service() for service in services))
         self.check_circular_dependencies()
+        self.check_wait_for()
 
     def exclude_for_start(self, exclude):
         self.excluded = exclude
@@ -177,21 +245,16 @@ class ServiceCollection:
 
 
     def check_circular_dependencies(self):
-        with_dependencies = [x for x in self.all_by_name.values() if x.dependencies != []]
-        # pylint: disable=cell-var-from-loop
-        for service in with_dependencies:
-            start = service.name
-            count = 0
-            def go_up_dependencies(checked):
-                nonlocal count
-                count += 1
-                for dependency in checked.dependencies:
-                    if dependency.name == start:
-                        raise ServiceLoadError("Circular dependency detected")
-                    if count == len(self.all_by_name):
-                        return
-                    go_up_dependencies(dependency)
-            go_up_dependencies(service)
+        ServiceGraph(self.all_by_name.values()).check_acyclic()
+
+    def check_wait_for(self):
+        for service in self.all_by_name.values():
+            dependencies = [dependency.name for dependency in service.dependencies]
+            not_dependencies = [name for name in service.wait_for if name not in dependencies]
+            if not_dependencies:
+                raise ServiceLoadError(
+                    "Service {:s} waits for {:s}, which is not a dependency".format(
+                        service.name, ",".join(not_dependencies)))
 
     def __len__(self):
         return len(self.all_by_name)
@@ -205,15 +268,115 @@ class ServiceCollection:
             msg = "Service {:s} cannot be built: No build directory specified".format(service.name)
             raise ServiceDefinitionError(msg)
 
+    def _dispatch(self, run_agent):
+        executor = self.running_context.executor
+        while True:
+            executor.reserve()
+            agent = self.running_context.next_ready()
+            if agent is None:
+                executor.release()
+                break
+            run_agent(agent)
+        executor.shutdown()
+
+    def resumable(self, docker, options: Options):
+        """The services that can be skipped when resuming the last start, because
+        they were running at its end and their containers are still running.
+        The containers are looked up in the container index, i.e. checked with a
+        single list call. Services that depend on a service that has to be
+        started again are started again as well."""
+        if not options.resume or self.run_state is None:
+            return []
+        services = list(self.all_by_name.values())
+        confirmed = [service for service in services
+                     if self.run_state.confirmed(
+                         service.name, docker.service_containers(service.name, options.network))]
+        graph = ServiceGraph(services)
+        restarted = set(graph.transitive_dependants(
+            *[service for service in services if service not in confirmed]))
+        return [service for service in confirmed if service not in restarted]
+
+    def _record_run_state(self):
+        if self.run_state is None or self.running_context is None:
+            return
+        for service, agent in self.running_context.agents.items():
+            # The records of resumed services are still valid
+            if not agent.resumed:
+                self.run_state.record(service.name, agent.run_condition,
+                                      agent.container_name, agent.fingerprint)
+
+    @staticmethod
+    def _running(docker, service, options: Options):
+        """Whether a container of the service is running, according to the
+        container index"""
+        return any(container.status == 'running'
+                   for container in docker.service_containers(service.name, options.network))
+
+    def _mark_resumed(self, resumed):
+        for service in resumed:
+            self.running_context.agents[service].resumed = True
+
+    @property
+    def agents(self):
+        """The agents of the last run"""
+        if self.running_context is None:
+            return []
+        return list(self.running_context.agents.values())
+
+    def run_report(self):
+        """Timings of the last run; see `report.run_report`"""
+        return run_report(self.running_context.agents, self.run_started, self.run_ended)
+
     def start_all(self, options: Options):
+        self.run_started = time.monotonic()
         docker = DockerClient.get_client()
         network = docker.create_network(options.network.name)
         options.network.id = network.id
-        self.running_context = RunningContext(self.all_by_name, options)
-        while not (self.running_context.done or self.running_context.failed_services):
-            for agent in self.running_context.ready_to_start:
-                agent.start_service()
-            time.sleep(0.01)
+        try:
+            docker.watch_events(types.group_name)
+            docker.index_containers(options.network)
+            resumed = self.resumable(docker, options)
+            if options.resume:
+                logger.info("Resuming the last start, skipping services: %s",
+                            ", ".join(service.name for service in resumed) or "none")
+            # Images that are not built are pulled while the services that come
+            # before them in the dependency order are started. Running containers
+            # are kept without checking their image, so their images are not needed.
+            docker.prefetch_images([service.image for service in self.all_by_name.values()
+                                    if not builds_image(service, options)
+                                    and service not in resumed
+                                    and not self._running(docker, service, options)],
+                                   options.image_parallelism)
+            if options.engine == Engine.ASYNCIO:
+                self.running_context = AsyncRunningContext(self.all_by_name, options)
+                self._mark_resumed(resumed)
+                asyncio.run(self.running_context.start_all())
+            else:
+                priorities = None
+                if self.history is not None:
+                    priorities = self.history.critical_paths(self.all_by_name.values())
+                self.running_context = RunningContext(self.all_by_name, options, priorities)
+                self._mark_resumed(resumed)
+                self.running_context.schedule_builds()
+                self.running_context.schedule_precreation()
+                self.running_context.queue_ready(self.running_context.ready_to_start)
+                try:
+                    self._dispatch(lambda agent: agent.start_service())
+                finally:
+                    self.running_context.finish_stages()
+        finally:
+            docker.stop_prefetching()
+            docker.stop_watching()
+            docker.forget_containers()
+            self._record_run_state()
+            self.run_ended = time.monotonic()
+        if self.history is not None:
+            for service, agent in self.running_context.agents.items():
+                self.history.record(service.name, agent.run_condition)
+        path = gating_path(self.running_context.agents)
+        if len(path) > 1:
+            logger.info("Dependencies that gated the start: %s",
+                        " -> ".join(service.name for service in path))
         failed = []
         if self.running_context.failed_services:
             failed = [x.name for x in self.running_context.failed_services]
@@ -223,11 +386,17 @@ class ServiceCollection:
 
     def stop_all(self, options: Options):
         docker = DockerClient.get_client()
-        self.running_context = RunningContext(self.all_by_name, options)
-        while not (self.running_context.done or self.running_context.failed_services):
-            for agent in self.running_context.ready_to_stop:
-                agent.stop_service()
-            time.sleep(0.01)
+        docker.index_containers(options.network)
+        try:
+            if options.engine == Engine.ASYNCIO:
+                self.running_context = AsyncRunningContext(self.all_by_name, options)
+                asyncio.run(self.running_context.stop_all())
+            else:
+                self.running_context = RunningContext(self.all_by_name, options)
+                self.running_context.queue_ready(self.running_context.ready_to_stop)
+                self._dispatch(lambda agent: agent.stop_service())
+        finally:
+            docker.forget_containers()
         if options.remove and not self.excluded:
             docker.remove_network(options.network.name)
 
@@ -235,24 +404,45 @@ class ServiceCollection:
     def update_for_base_service(self, service_name):
         if service_name not in self.all_by_name:
             raise ServiceLoadError("No such service: {:s}".format(service_name))
-        queue = deque()
-        queue.append(self.all_by_name[service_name])
-        required = []
-        while queue:
-            service = queue.popleft()
-            required.append(service)
-            for dependant in service.dependants:
-                if dependant not in queue and dependant not in required:
-                    queue.append(dependant)
+        base_service = self.all_by_name[service_name]
+        graph = ServiceGraph(self.all_by_name.values())
+        required = [base_service] + graph.transitive_dependants(base_service)
+        # The services that are left running still need the network
+        self.excluded = [name for name, service in self.all_by_name.items()
+                         if service not in required]
         self.all_by_name = {service.name: service for service in required}
 
-def start_services(maindir, exclude, network_name, timeout):
+@contextlib.contextmanager
+def api_stats_logged(enabled):
+    """Record the Docker API calls made within the block, and log a summary of
+    them at its end, also if it failed"""
+    if not enabled:
+        yield None
+        return
+    docker = DockerClient.get_client()
+    ledger = ApiLedger()
+    docker.attach_ledger(ledger)
+    try:
+        yield ledger
+    finally:
+        docker.detach_ledger(ledger)
+        for line in ledger.summary():
+            logger.info(line)
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+def start_services(maindir, exclude, network_name, timeout,
+                   parallelism=None, image_parallelism=None, container_parallelism=None,
+                   build_parallelism=None, engine=Engine.THREADS, resume=False, report=None,
+                   trace=None, trace_format=TraceFormat.CHROME, api_stats=False):
     if types.group_name is None:
         raise MinibossException(
             "Group name is not set; set it with miniboss.group_name in the main script"
         )
-    Context.load_from(maindir)
+    history = StartHistory.load_from(maindir)
     collection = ServiceCollection()
+    collection.history = history
+    collection.run_state = RunState.load_from(maindir)
     collection.load_definitions()
     collection.exclude_for_start(exclude)
     network_name = network_name or "miniboss-{}".format(types.group_name)
@@ -260,13 +450,45 @@ def start_services(maindir, exclude, network_name, timeout):
                       timeout=timeout,
                       remove=False,
                       run_dir=maindir,
-                      build=[])
-    service_names = collection.start_all(options)
+                      build=[],
+                      parallelism=parallelism,
+                      image_parallelism=image_parallelism,
+                      container_parallelism=container_parallelism,
+                      build_parallelism=build_parallelism,
+                      engine=engine,
+                      resume=resume)
+    # Context values are persisted as soon as they are set, and the run state
+    # is saved even if the start is interrupted
+    try:
+        with api_stats_logged(api_stats), Context.attached(maindir):
+            service_names = collection.start_all(options)
+    finally:
+        collection.run_state.save_to(maindir)
     logger.info("Started services: %s", ", ".join(service_names))
+    if report is not None:
+        write_report(report, collection.run_report())
+    if trace is not None:
+        write_trace(trace, collection.agents, trace_format)
     Context.save_to(maindir)
+    history.save_to(maindir)
 
 
-def stop_services(maindir, exclude, network_name, remove, timeout):
+def plan_services(maindir, exclude, parallelism=None):
+    """Lines describing the waves in which the services are started, and the
+    expected critical path if start timings were recorded. Docker is not used."""
+    history = StartHistory.load_from(maindir)
+    collection = ServiceCollection()
+    collection.load_definitions()
+    collection.exclude_for_start(exclude)
+    services = list(collection.all_by_name.values())
+    plan = Plan(services, {service: history.duration(service.name) for service in services})
+    return plan.describe(parallelism, timed=bool(history.durations))
+
+
+# pylint: disable=too-many-arguments
+def stop_services(maindir, exclude, network_name, remove, timeout,
+                  parallelism=None, engine=Engine.THREADS,
+                  trace=None, trace_format=TraceFormat.CHROME, api_stats=False):
     if types.group_name is None:
         raise MinibossException(
             "Group name is not set; set it with miniboss.group_name in the main script"
@@ -277,16 +499,25 @@ def stop_services(maindir, exclude, network_name, remove, timeout):
                       timeout=timeout,
                       remove=remove,
                       run_dir=maindir,
-                      build=[])
+                      build=[],
+                      parallelism=parallelism,
+                      engine=engine)
     collection = ServiceCollection()
     collection.load_definitions()
     collection.exclude_for_stop(exclude)
-    collection.stop_all(options)
+    with api_stats_logged(api_stats):
+        collection.stop_all(options)
+    if trace is not None:
+        write_trace(trace, collection.agents, trace_format)
     if remove:
         Context.remove_file(maindir)
+        RunState.remove_file(maindir)
 
-# pylint: disable=too-many-arguments
-def reload_service(maindir, service, network_name, remove, timeout):
+# pylint: disable=too-many-arguments, too-many-locals
+def reload_service(maindir, service, network_name, remove, timeout,
+                   parallelism=None, image_parallelism=None, container_parallelism=None,
+                   build_parallelism=None, engine=Engine.THREADS,
+                   trace=None, trace_format=TraceFormat.CHROME, api_stats=False):
     if types.group_name is None:
         raise MinibossException(
             "Group name is not set; set it with miniboss.group_name in the main script"
@@ -296,16 +527,31 @@ def reload_service(maindir, service, network_name, remove, timeout):
                       timeout=timeout,
                       remove=remove,
                       run_dir=maindir,
-                      build=[service])
+                      build=[service],
+                      parallelism=parallelism,
+                      image_parallelism=image_parallelism,
+                      container_parallelism=container_parallelism,
+                      build_parallelism=build_parallelism,
+                      engine=engine)
     stop_collection = ServiceCollection()
     stop_collection.load_definitions()
     stop_collection.check_can_be_built(service)
     stop_collection.update_for_base_service(service)
-    stop_collection.stop_all(options)
-    # We don't need to do this earlier, as the context is not used by the stop
-    # functionality
-    Context.load_from(maindir)
-    start_collection = ServiceCollection()
-    start_collection.load_definitions()
-    start_collection.start_all(options)
+    with api_stats_logged(api_stats):
+        stop_collection.stop_all(options)
+        # We don't need to do this earlier, as the context is not used by the stop
+        # functionality
+        history = StartHistory.load_from(maindir)
+        start_collection = ServiceCollection()
+        start_collection.history = history
+        start_collection.run_state = RunState.load_from(maindir)
+        start_collection.load_definitions()
+        try:
+            with Context.attached(maindir):
+                start_collection.start_all(options)
+        finally:
+            start_collection.run_state.save_to(maindir)
     Context.save_to(maindir)
+    history.save_to(maindir)
+    if trace is not None:
+        write_trace(trace, stop_collection.agents + start_collection.agents, trace_format)
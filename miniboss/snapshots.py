@@ -0,0 +1,104 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pathlib
+import shutil
+
+import attr
+from attr.validators import instance_of, deep_iterable
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = ".miniboss-snapshots"
+SNAPSHOT_REPOSITORY = "miniboss-snapshot"
+METADATA_FILE = "snapshot.json"
+# Number of hex digits of the snapshot key used in the image tag
+SNAPSHOT_TAG_LENGTH = 32
+
+
+def _hook_source(hook):
+    try:
+        return inspect.getsource(hook)
+    except (OSError, TypeError):
+        # Hooks defined in an interactive session have no source
+        return repr(hook.__code__.co_code)
+
+
+def snapshot_key(service, fingerprint):
+    """Hash of the service fingerprint and the source of its hooks"""
+    parts = [service.name, fingerprint]
+    parts += [_hook_source(getattr(type(service), hook)) for hook in ('pre_start', 'post_start')]
+    return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+
+@attr.s(kw_only=True)
+class Snapshot:
+    """Committed image, volume contents and context values of a started service"""
+    key = attr.ib(validator=instance_of(str))
+    image = attr.ib(validator=instance_of(str))
+    volumes = attr.ib(validator=deep_iterable(member_validator=instance_of(str)))
+    context = attr.ib(validator=instance_of(dict))
+
+    @staticmethod
+    def directory(run_dir, key):
+        return pathlib.Path(run_dir) / SNAPSHOT_DIR / key
+
+    @staticmethod
+    def volume_file(directory, index):
+        return directory / "volume-{:d}.tar".format(index)
+
+
+def load_snapshot(client, run_dir, key):
+    """The snapshot with the key, or None if there is no complete one"""
+    path = Snapshot.directory(run_dir, key) / METADATA_FILE
+    try:
+        with open(path, 'r', encoding='utf-8') as metadata_file:
+            snapshot = Snapshot(key=key, **json.load(metadata_file))
+    except FileNotFoundError:
+        return None
+    if not client.image_exists(snapshot.image):
+        logger.info("Image %s of snapshot %s does not exist anymore", snapshot.image, key)
+        return None
+    return snapshot
+
+
+def save_snapshot(client, run_dir, key, container_name, context_values):
+    """Export the volumes of the paused container and commit it to an image"""
+    directory = Snapshot.directory(run_dir, key)
+    # Written to a temporary directory first, so that a failure does not leave
+    # an incomplete snapshot behind
+    partial = directory.with_name(key + ".partial")
+    shutil.rmtree(partial, ignore_errors=True)
+    partial.mkdir(parents=True)
+    try:
+        volumes = client.volume_paths(container_name)
+        client.pause_container(container_name)
+        try:
+            for index, path in enumerate(volumes):
+                with open(Snapshot.volume_file(partial, index), 'wb') as outfile:
+                    client.export_path(container_name, path, outfile)
+        finally:
+            client.unpause_container(container_name)
+        image = client.commit_container(container_name, SNAPSHOT_REPOSITORY,
+                                        key[:SNAPSHOT_TAG_LENGTH])
+        snapshot = Snapshot(key=key, image=image, volumes=volumes, context=context_values)
+        with open(partial / METADATA_FILE, 'w', encoding='utf-8') as metadata_file:
+            json.dump({'image': snapshot.image,
+                       'volumes': snapshot.volumes,
+                       'context': snapshot.context}, metadata_file)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(partial, directory)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return snapshot
+
+
+def restore_volumes(client, run_dir, snapshot, container_id):
+    """Copy the volume contents of the snapshot into a created container"""
+    directory = Snapshot.directory(run_dir, snapshot.key)
+    for index, path in enumerate(snapshot.volumes):
+        with open(Snapshot.volume_file(directory, index), 'rb') as infile:
+            client.import_path(container_id, path, infile)
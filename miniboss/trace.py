@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import time
+
+from miniboss import types
+from miniboss.types import Actions, RunCondition
+
+logger = logging.getLogger(__name__)
+
+PROCESS_ID = 1
+# Span kind INTERNAL in OTLP
+SPAN_KIND_INTERNAL = 1
+
+
+class TraceFormat:
+    CHROME = 'chrome'
+    OTLP = 'otlp'
+    ALL = [CHROME, OTLP]
+
+
+class _Span:
+
+    def __init__(self, name, service_name, start, end, parent=None):
+        self.name = name
+        self.service_name = service_name
+        self.start = start
+        self.end = end
+        self.parent = parent
+        self.span_id = os.urandom(8).hex()
+
+    def contains(self, start, end):
+        return self.start <= start and end <= self.end
+
+
+def _agent_spans(agent):
+    """The spans of the lifecycle of an agent. The span of the whole action
+    encloses the phases that ran while the agent was dispatched; ping attempts
+    are enclosed by the ping phase. Returns the span of the action (or None if
+    the agent was not dispatched) and all spans."""
+    run_condition = agent.run_condition
+    name = agent.service.name
+    spans = []
+    action = None
+    if run_condition.dispatched_at is not None and run_condition.finished_at is not None:
+        action = _Span("{:s} {:s}".format(agent.action or Actions.START, name), name,
+                       run_condition.dispatched_at, run_condition.finished_at)
+        spans.append(action)
+        if run_condition.ready_at < run_condition.dispatched_at:
+            spans.append(_Span("queued", name, run_condition.ready_at,
+                               run_condition.dispatched_at))
+    phases = sorted(run_condition.phases, key=lambda phase: phase[1])
+    pings = []
+    for phase, start, end in phases:
+        if phase == RunCondition.PING_ATTEMPT:
+            continue
+        parent = action if action is not None and action.contains(start, end) else None
+        span = _Span(phase, name, start, end, parent)
+        spans.append(span)
+        if phase == RunCondition.PING:
+            pings.append(span)
+    for phase, start, end in phases:
+        if phase == RunCondition.PING_ATTEMPT:
+            parent = next((ping for ping in pings if ping.contains(start, end)), None)
+            spans.append(_Span(phase, name, start, end, parent))
+    return action, spans
+
+
+def _collect(agents):
+    """All spans of the agents, and the pairs of action spans where the first one
+    had to finish before the second one could be processed: dependencies
+    before dependants when starting, and the other way round when stopping"""
+    agents = list(agents)
+    actions = {}
+    spans = []
+    for agent in agents:
+        action, agent_spans = _agent_spans(agent)
+        actions[agent.action, agent.service.name] = action
+        spans.extend(agent_spans)
+    edges = []
+    for agent in agents:
+        action = actions[agent.action, agent.service.name]
+        if agent.action == Actions.STOP:
+            others = agent.service.dependants
+        else:
+            others = agent.service.dependencies
+        for other in others:
+            other_action = actions.get((agent.action, other.name))
+            if action is not None and other_action is not None:
+                edges.append((other_action, action))
+    return spans, edges
+
+
+def _microseconds(seconds):
+    return round(seconds * 1000000, 3)
+
+
+def chrome_trace(agents):
+    """The lifecycles of the agents in the Trace Event Format, which can be loaded
+    in chrome://tracing or Perfetto. Every service is shown on a track of its
+    own, and the dependencies that gated a service are shown as flow events."""
+    spans, edges = _collect(agents)
+    origin = min((span.start for span in spans), default=0)
+    tracks = {}
+    events = [{'ph': 'M', 'pid': PROCESS_ID, 'name': 'process_name',
+               'args': {'name': "miniboss {}".format(types.group_name)}}]
+    for span in spans:
+        if span.service_name not in tracks:
+            tracks[span.service_name] = len(tracks) + 1
+            events.append({'ph': 'M', 'pid': PROCESS_ID, 'tid': tracks[span.service_name],
+                           'name': 'thread_name', 'args': {'name': span.service_name}})
+    for span in spans:
+        events.append({'ph': 'X', 'cat': 'miniboss', 'name': span.name,
+                       'pid': PROCESS_ID, 'tid': tracks[span.service_name],
+                       'ts': _microseconds(span.start - origin),
+                       'dur': _microseconds(span.end - span.start),
+                       'args': {'service': span.service_name}})
+    for flow_id, (before, after) in enumerate(edges, start=1):
+        # The flow starts where the first span ends, or where the second one
+        # starts if that is earlier, e.g. with dependants that waited only for
+        # part of the lifecycle
+        start = min(before.end, after.start)
+        events.append({'ph': 's', 'cat': 'dependency', 'name': 'dependency', 'id': flow_id,
+                       'pid': PROCESS_ID, 'tid': tracks[before.service_name],
+                       'ts': _microseconds(start - origin)})
+        events.append({'ph': 'f', 'bp': 'e', 'cat': 'dependency', 'name': 'dependency',
+                       'id': flow_id, 'pid': PROCESS_ID, 'tid': tracks[after.service_name],
+                       'ts': _microseconds(after.start - origin)})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _attribute(key, value):
+    return {'key': key, 'value': {'stringValue': value}}
+
+
+def otlp_trace(agents):
+    """The lifecycles of the agents as an OTLP JSON export request with a single
+    trace. The spans of the actions are children of a root span for the whole
+    run, and are linked to the spans of the dependencies that gated them."""
+    spans, edges = _collect(agents)
+    trace_id = os.urandom(16).hex()
+    # Monotonic times are converted to wall clock times
+    offset = time.time() - time.monotonic()
+    def nanoseconds(timestamp):
+        return str(int((timestamp + offset) * 1000000000))
+    root = _Span("miniboss {}".format(types.group_name), None,
+                 min((span.start for span in spans), default=time.monotonic()),
+                 max((span.end for span in spans), default=time.monotonic()))
+    links = {}
+    for before, after in edges:
+        links.setdefault(after, []).append({'traceId': trace_id, 'spanId': before.span_id})
+    otlp_spans = [{'traceId': trace_id, 'spanId': root.span_id, 'name': root.name,
+                   'kind': SPAN_KIND_INTERNAL,
+                   'startTimeUnixNano': nanoseconds(root.start),
+                   'endTimeUnixNano': nanoseconds(root.end)}]
+    for span in spans:
+        otlp_spans.append({'traceId': trace_id,
+                           'spanId': span.span_id,
+                           'parentSpanId': (span.parent or root).span_id,
+                           'name': span.name,
+                           'kind': SPAN_KIND_INTERNAL,
+                           'startTimeUnixNano': nanoseconds(span.start),
+                           'endTimeUnixNano': nanoseconds(span.end),
+                           'attributes': [_attribute('miniboss.service', span.service_name)],
+                           'links': links.get(span, [])})
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', 'miniboss')]},
+        'scopeSpans': [{'scope': {'name': 'miniboss'}, 'spans': otlp_spans}]}]}
+
+
+def write_trace(path, agents, trace_format=TraceFormat.CHROME):
+    if trace_format == TraceFormat.OTLP:
+        trace = otlp_trace(agents)
+    else:
+        trace = chrome_trace(agents)
+    with open(path, 'w', encoding='utf-8') as trace_file:
+        json.dump(trace, trace_file)
+    logger.info("Wrote trace of the run to %s", path)
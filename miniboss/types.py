@@ -1,11 +1,24 @@
+import contextlib
+import time
+
 import attr
-from attr.validators import instance_of, deep_iterable
+from attr.validators import instance_of, deep_iterable, optional, in_
 
 @attr.s(kw_only=True)
 class Network:
     name = attr.ib(validator=instance_of(str))
     id = attr.ib(validator=instance_of(str))
 
+class Engine:
+    THREADS = 'threads'
+    ASYNCIO = 'asyncio'
+    ALL = [THREADS, ASYNCIO]
+
+def _positive(instance, attribute, value):
+    # pylint: disable=unused-argument
+    if value is not None and value < 1:
+        raise ValueError("{:s} has to be at least 1, not {}".format(attribute.name, value))
+
 @attr.s(kw_only=True)
 class Options:
     network = attr.ib(validator=instance_of(Network))
@@ -13,6 +26,19 @@ class Options:
     remove = attr.ib(validator=instance_of(bool))
     run_dir = attr.ib(validator=instance_of(str))
     build = attr.ib(validator=deep_iterable(member_validator=instance_of(str)))
+    parallelism = attr.ib(default=None, validator=[optional(instance_of(int)), _positive])
+    image_parallelism = attr.ib(default=None, validator=[optional(instance_of(int)), _positive])
+    container_parallelism = attr.ib(default=None, validator=[optional(instance_of(int)), _positive])
+    build_parallelism = attr.ib(default=None, validator=[optional(instance_of(int)), _positive])
+    engine = attr.ib(default=Engine.THREADS, validator=in_(Engine.ALL))
+    resume = attr.ib(default=False, validator=instance_of(bool))
+
+class WaitFor:
+    """How far a dependency has to get before a dependant is started"""
+    STARTED = 'started'
+    PINGED = 'pinged'
+    POST_STARTED = 'post_started'
+    ALL = [STARTED, PINGED, POST_STARTED]
 
 class AgentStatus:
     NULL = 'null'
@@ -23,11 +49,16 @@ class AgentStatus:
 
 class RunCondition:
     # Actions
+    PULL = 'pull'
     CREATE = 'create'
     START = 'start'
     PRE_START = 'pre-start'
     POST_START = 'post-start'
     PING = 'ping'
+    PING_ATTEMPT = 'ping-attempt'
+    SNAPSHOT = 'snapshot'
+    STOP = 'stop'
+    REMOVE = 'remove'
     # States
     NULL = 'null'
     BUILD_IMAGE = 'build-image'
@@ -38,6 +69,51 @@ class RunCondition:
     def __init__(self):
         self.actions = []
         self.state = self.NULL
+        # Seconds spent in each phase, by action name
+        self.durations = {}
+        # Phases as tuples of the action name and the monotonic start and end
+        # times, in the order they ended
+        self.phases = []
+        # Monotonic times at which the service could be processed because its
+        # dependencies were done, at which it was taken up by a worker, and at
+        # which it was finished
+        self.ready_at = None
+        self.dispatched_at = None
+        self.finished_at = None
+
+    @contextlib.contextmanager
+    def timed(self, phase, nested=False):
+        """Record the time spent in the block as a phase. Nested phases, which are
+        part of another phase, are not counted in the durations."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            if not nested:
+                self.durations[phase] = self.durations.get(phase, 0) + end - start
+            self.phases.append((phase, start, end))
+
+    def ready(self):
+        if self.ready_at is None:
+            self.ready_at = time.monotonic()
+
+    def dispatched(self):
+        self.dispatched_at = time.monotonic()
+        # Agents that were not queued, e.g. ones started directly, did not wait
+        if self.ready_at is None:
+            self.ready_at = self.dispatched_at
+
+    def finished(self):
+        self.finished_at = time.monotonic()
+
+    @property
+    def queue_wait(self):
+        """Seconds the service was ready, but not taken up because of the
+        parallelism limit"""
+        if self.dispatched_at is None:
+            return None
+        return self.dispatched_at - self.ready_at
 
     def already_running(self):
         self.state = self.RUNNING
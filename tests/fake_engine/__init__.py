@@ -0,0 +1 @@
+from .engine import FakeEngine
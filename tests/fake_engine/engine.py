@@ -0,0 +1,620 @@
+"""A stand-in for the Docker Engine that serves the part of its HTTP API that
+miniboss uses over a unix socket, keeping networks, containers and images in
+memory. Requests can be delayed and made to fail, and are counted by endpoint,
+so that full runs can be timed and their API round trips checked without a
+daemon. Point docker-py at it with `FakeEngine.client()`."""
+import collections
+import hashlib
+import io
+import itertools
+import json
+import os
+import queue
+import re
+import select
+import shutil
+import socket
+import socketserver
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import docker
+
+API_VERSION = "1.41"
+# Seconds after which an idle events stream checks whether the client went
+# away, and the server whether it is stopped
+EVENT_POLL_INTERVAL = 0.1
+
+ROUTES = [
+    ('GET', '/_ping', 'ping'),
+    ('GET', '/version', 'version'),
+    ('GET', '/events', 'events'),
+    ('GET', '/networks', 'list_networks'),
+    ('POST', '/networks/create', 'create_network'),
+    ('GET', '/networks/{id}', 'inspect_network'),
+    ('DELETE', '/networks/{id}', 'remove_network'),
+    ('GET', '/containers/json', 'list_containers'),
+    ('POST', '/containers/create', 'create_container'),
+    ('GET', '/containers/{id}/json', 'inspect_container'),
+    ('POST', '/containers/{id}/start', 'start_container'),
+    ('POST', '/containers/{id}/stop', 'stop_container'),
+    ('GET', '/containers/{id}/logs', 'container_logs'),
+    ('DELETE', '/containers/{id}', 'remove_container'),
+    ('GET', '/images/{name}/json', 'inspect_image'),
+    ('POST', '/images/create', 'pull_image'),
+    ('POST', '/build', 'build_image'),
+]
+
+
+def _route_pattern(template):
+    # Image names can contain slashes, ids and names of other objects cannot
+    pattern = re.escape(template).replace(r'\{id\}', '(?P<id>[^/]+)')
+    return re.compile(pattern.replace(r'\{name\}', '(?P<name>.+)') + '$')
+
+_ROUTES = [(method, template, _route_pattern(template), handler)
+           for method, template, handler in ROUTES]
+
+
+def _full_tag(tag):
+    if ':' not in tag.rsplit('/', 1)[-1]:
+        return tag + ':latest'
+    return tag
+
+
+def _matches_labels(labels, wanted):
+    for label in wanted:
+        key, _, value = label.partition('=')
+        if key not in labels or (value and labels[key] != value):
+            return False
+    return True
+
+
+class _Request:
+
+    def __init__(self, method, path, query, body):
+        self.method = method
+        # The API version prefix is ignored
+        self.path = re.sub(r'^/v[\d.]+', '', path)
+        self.query = query
+        self.body = body
+
+    def param(self, name, default=None):
+        return self.query.get(name, [default])[0]
+
+    def json(self):
+        return json.loads(self.body or b'{}')
+
+    def filters(self):
+        return json.loads(self.param('filters') or '{}')
+
+
+class _Response:
+
+    def __init__(self, status, body=None, content=None, stream=None):
+        self.status = status
+        self.body = body
+        self._content = content
+        # Iterable of JSON objects sent with chunked encoding; None items are
+        # skipped, and used to check whether the client is still there
+        self.stream = stream
+
+    def content(self):
+        if self._content is not None:
+            return self._content
+        if self.body is None:
+            return b''
+        return json.dumps(self.body).encode('utf-8')
+
+
+def _error(status, message):
+    return _Response(status, {'message': message})
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _disconnected(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.connection.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def _send(self, response):
+        content = response.content()
+        self.send_response(response.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_stream(self, response):
+        self.send_response(response.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        stream = iter(response.stream)
+        try:
+            for item in stream:
+                if item is None:
+                    if self._disconnected():
+                        self.close_connection = True
+                        return
+                    continue
+                data = json.dumps(item).encode('utf-8') + b'\r\n'
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+
+    def _handle(self):
+        split = urlsplit(self.path)
+        request = _Request(self.command, split.path, parse_qs(split.query), self._read_body())
+        response = self.server.engine.handle(request)
+        if response.stream is None:
+            self._send(response)
+        else:
+            self._send_stream(response)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Connecting to a unix socket fails right away if the backlog is full
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, path, engine):
+        self.engine = engine
+        super().__init__(path, _Handler)
+
+
+class FakeEngine:
+    """Docker Engine stand-in. `latency` is the time every request takes, which
+    can be set per endpoint in `latencies`; endpoints are written as in
+    ROUTES, e.g. 'POST /containers/{id}/start', and requests are counted in
+    `calls` with the same keys."""
+    # pylint: disable=too-many-instance-attributes, too-many-public-methods, unused-argument
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.latencies = {}
+        self.calls = collections.Counter()
+        # Seconds from the start of a container with a health check until it
+        # is healthy
+        self.health_delay = 0
+        self.networks = {}
+        self.containers = {}
+        self.images = {}
+        self._names = {}
+        self._logs = {}
+        self._exiting_images = {}
+        self._failures = {}
+        self._subscribers = []
+        self._lock = threading.RLock()
+        self._sequence = itertools.count(1)
+        self._stopped = threading.Event()
+        self._directory = None
+        self._server = None
+        self.socket_path = None
+
+    def start(self):
+        self._directory = tempfile.mkdtemp(prefix="miniboss-engine-")
+        self.socket_path = os.path.join(self._directory, "docker.sock")
+        self._server = _Server(self.socket_path, self)
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  kwargs={'poll_interval': EVENT_POLL_INTERVAL},
+                                  name="fake-docker-engine", daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def base_url(self):
+        return "unix://{:s}".format(self.socket_path)
+
+    def client(self):
+        """A docker-py client connected to the engine"""
+        return docker.DockerClient(base_url=self.base_url, version=API_VERSION)
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def add_image(self, tag):
+        with self._lock:
+            return self._add_image(tag)
+
+    def exit_on_start(self, image, logs=""):
+        """Make the containers of an image exit right after they are started,
+        with `logs` as their output"""
+        self._exiting_images[_full_tag(image)] = logs
+
+    def fail(self, endpoint, status=500, message="Injected failure", count=1):
+        """Make the next `count` requests to an endpoint fail with an API error;
+        all of them if `count` is None"""
+        with self._lock:
+            self._failures[endpoint] = [status, message, count]
+
+    def handle(self, request):
+        for method, template, pattern, handler in _ROUTES:
+            match = pattern.match(request.path)
+            if method == request.method and match:
+                endpoint = "{:s} {:s}".format(method, template)
+                break
+        else:
+            endpoint, handler, match = "{:s} {:s}".format(request.method, request.path), None, None
+        with self._lock:
+            self.calls[endpoint] += 1
+            failure = self._failures.get(endpoint)
+            if failure is not None:
+                if failure[2] is not None:
+                    failure[2] -= 1
+                    if failure[2] == 0:
+                        del self._failures[endpoint]
+        delay = self.latencies.get(endpoint, self.latency)
+        if delay:
+            time.sleep(delay)
+        if failure is not None:
+            return _error(failure[0], failure[1])
+        if handler is None:
+            return _error(404, "page not found")
+        args = {key: unquote(value) for key, value in match.groupdict().items()}
+        with self._lock:
+            return getattr(self, '_' + handler)(request, **args)
+
+    def _new_id(self, kind):
+        return hashlib.sha256("{:s}-{:d}".format(kind, next(self._sequence))
+                              .encode('utf-8')).hexdigest()
+
+    # Images
+
+    def _add_image(self, tag):
+        image_id = "sha256:" + self._new_id('image')
+        self.images[_full_tag(tag)] = image_id
+        return image_id
+
+    def _image_id(self, reference):
+        if _full_tag(reference) in self.images:
+            return self.images[_full_tag(reference)]
+        digest = reference.split(':', 1)[-1] if reference.startswith('sha256:') else reference
+        for image_id in self.images.values():
+            if len(digest) >= 12 and image_id[len('sha256:'):].startswith(digest):
+                return image_id
+        return None
+
+    def _inspect_image(self, request, name):
+        image_id = self._image_id(name)
+        if image_id is None:
+            return _error(404, "No such image: {:s}".format(name))
+        tags = [tag for tag, other in self.images.items() if other == image_id]
+        return _Response(200, {'Id': image_id, 'RepoTags': tags, 'Config': {}})
+
+    def _pull_image(self, request):
+        tag = "{:s}:{:s}".format(request.param('fromImage'), request.param('tag') or 'latest')
+        self._add_image(tag)
+        return _Response(200, stream=[
+            {'status': "Pulling from {:s}".format(request.param('fromImage'))},
+            {'status': "Status: Downloaded newer image for {:s}".format(tag)}])
+
+    def _build_image(self, request):
+        dockerfile = request.param('dockerfile') or 'Dockerfile'
+        with tarfile.open(fileobj=io.BytesIO(request.body)) as context:
+            names = context.getnames()
+        if dockerfile not in names:
+            message = "Cannot locate specified Dockerfile: {:s}".format(dockerfile)
+            return _Response(200, stream=[{'errorDetail': {'message': message},
+                                           'error': message}])
+        tag = request.param('t')
+        image_id = self._add_image(tag) if tag else "sha256:" + self._new_id('image')
+        short_id = image_id[len('sha256:'):][:12]
+        return _Response(200, stream=[
+            {'stream': "Sending build context with {:d} files\n".format(len(names))},
+            {'aux': {'ID': image_id}},
+            {'stream': "Successfully built {:s}\n".format(short_id)},
+            {'stream': "Successfully tagged {:s}\n".format(tag)}])
+
+    # Networks
+
+    def _network(self, reference):
+        for network in self.networks.values():
+            if reference in (network['Id'], network['Name']):
+                return network
+        return None
+
+    def _list_networks(self, request):
+        # Networks are filtered by a part of their name, as by the daemon
+        names = request.filters().get('name')
+        return _Response(200, [network for network in self.networks.values()
+                               if names is None
+                               or any(name in network['Name'] for name in names)])
+
+    def _create_network(self, request):
+        body = request.json()
+        if self._network(body['Name']) is not None:
+            return _error(409, "network with name {:s} already exists".format(body['Name']))
+        network_id = self._new_id('network')
+        self.networks[network_id] = {'Name': body['Name'], 'Id': network_id,
+                                     'Driver': body.get('Driver') or 'bridge',
+                                     'Scope': 'local', 'Containers': {},
+                                     'Labels': body.get('Labels') or {}}
+        return _Response(201, {'Id': network_id, 'Warning': ''})
+
+    def _inspect_network(self, request, id): # pylint: disable=redefined-builtin
+        network = self._network(id)
+        if network is None:
+            return _error(404, "network {:s} not found".format(id))
+        return _Response(200, network)
+
+    def _remove_network(self, request, id): # pylint: disable=redefined-builtin
+        network = self._network(id)
+        if network is None:
+            return _error(404, "network {:s} not found".format(id))
+        if any(container['State']['Running'] and network['Name'] in self._networks_of(container)
+               for container in self.containers.values()):
+            return _error(403, "error while removing network: network {:s} id {:s} has "
+                          "active endpoints".format(network['Name'], network['Id']))
+        del self.networks[network['Id']]
+        return _Response(204)
+
+    # Containers
+
+    def _container(self, reference):
+        container_id = self._names.get(reference, reference)
+        if container_id in self.containers:
+            return self.containers[container_id]
+        for other_id, container in self.containers.items():
+            if other_id.startswith(reference):
+                return container
+        return None
+
+    @staticmethod
+    def _networks_of(container):
+        return container['NetworkSettings']['Networks']
+
+    def _summary(self, container):
+        state = container['State']
+        return {'Id': container['Id'],
+                'Names': [container['Name']],
+                'Image': container['Config']['Image'],
+                'ImageID': container['Image'],
+                'Labels': container['Config']['Labels'],
+                'State': state['Status'],
+                'Status': "Up" if state['Running'] else "Exited ({:d})".format(state['ExitCode']),
+                'NetworkSettings': container['NetworkSettings']}
+
+    def _listed(self, container, filters, include_stopped):
+        if not include_stopped and not container['State']['Running']:
+            return False
+        networks = self._networks_of(container)
+        checks = {
+            'id': container['Id'].startswith,
+            'name': lambda value: re.search(value, container['Name']) is not None,
+            'status': lambda value: container['State']['Status'] == value,
+            'network': lambda value: any(value in (name, network['NetworkID'])
+                                         for name, network in networks.items()),
+        }
+        for key, values in filters.items():
+            if key == 'label':
+                if not _matches_labels(container['Config']['Labels'], values):
+                    return False
+            elif key in checks and not any(checks[key](value) for value in values):
+                return False
+        return True
+
+    def _list_containers(self, request):
+        include_stopped = request.param('all') in ('1', 'True', 'true')
+        filters = request.filters()
+        return _Response(200, [self._summary(container)
+                               for container in self.containers.values()
+                               if self._listed(container, filters, include_stopped)])
+
+    def _create_container(self, request):
+        body = request.json()
+        name = request.param('name') or self._new_id('name')[:12]
+        image_id = self._image_id(body['Image'])
+        if image_id is None:
+            return _error(404, "No such image: {:s}".format(body['Image']))
+        if name in self._names:
+            return _error(409, 'Conflict. The container name "/{:s}" is already in use'
+                          .format(name))
+        endpoints = (body.get('NetworkingConfig') or {}).get('EndpointsConfig') or {}
+        networks = {}
+        for network_name, endpoint in endpoints.items():
+            network = self._network(network_name)
+            if network is None:
+                return _error(404, "network {:s} not found".format(network_name))
+            networks[network['Name']] = {'NetworkID': network['Id'],
+                                         'Aliases': (endpoint or {}).get('Aliases')}
+        container_id = self._new_id('container')
+        self.containers[container_id] = {
+            'Id': container_id,
+            'Name': "/{:s}".format(name),
+            'Image': image_id,
+            'Config': {'Image': body['Image'],
+                       'Env': body.get('Env') or [],
+                       'Labels': body.get('Labels') or {},
+                       'Healthcheck': body.get('Healthcheck'),
+                       'Tty': False},
+            'State': {'Status': 'created', 'Running': False, 'Paused': False, 'ExitCode': 0},
+            'HostConfig': body.get('HostConfig') or {},
+            'NetworkSettings': {'Networks': networks},
+            'Mounts': []}
+        self._names[name] = container_id
+        self._emit(self.containers[container_id], 'create')
+        return _Response(201, {'Id': container_id, 'Warnings': []})
+
+    def _inspect_container(self, request, id): # pylint: disable=redefined-builtin
+        container = self._container(id)
+        if container is None:
+            return _error(404, "No such container: {:s}".format(id))
+        return _Response(200, container)
+
+    def _exit(self, container, exit_code):
+        container['State'].update(Status='exited', Running=False, ExitCode=exit_code)
+        self._emit(container, 'die', exitCode=str(exit_code))
+
+    def _health_changed(self, container, status):
+        container['State']['Health'] = {'Status': status, 'FailingStreak': 0, 'Log': []}
+        self._emit(container, "health_status: {:s}".format(status))
+
+    def _become_healthy(self, container):
+        with self._lock:
+            if container['State']['Running']:
+                self._health_changed(container, 'healthy')
+
+    def _start_container(self, request, id): # pylint: disable=redefined-builtin
+        container = self._container(id)
+        if container is None:
+            return _error(404, "No such container: {:s}".format(id))
+        if container['State']['Running']:
+            return _Response(304)
+        container['State'].update(Status='running', Running=True, ExitCode=0)
+        container['State'].pop('Health', None)
+        self._emit(container, 'start')
+        image = _full_tag(container['Config']['Image'])
+        if image in self._exiting_images:
+            self._logs[container['Id']] = self._exiting_images[image]
+            self._exit(container, 1)
+        elif container['Config']['Healthcheck']:
+            if self.health_delay:
+                container['State']['Health'] = {'Status': 'starting', 'FailingStreak': 0,
+                                                'Log': []}
+                timer = threading.Timer(self.health_delay, self._become_healthy, [container])
+                timer.daemon = True
+                timer.start()
+            else:
+                self._health_changed(container, 'healthy')
+        return _Response(204)
+
+    def _stop_container(self, request, id): # pylint: disable=redefined-builtin
+        container = self._container(id)
+        if container is None:
+            return _error(404, "No such container: {:s}".format(id))
+        if not container['State']['Running']:
+            return _Response(304)
+        self._exit(container, 0)
+        self._emit(container, 'stop')
+        return _Response(204)
+
+    def _container_logs(self, request, id): # pylint: disable=redefined-builtin
+        container = self._container(id)
+        if container is None:
+            return _error(404, "No such container: {:s}".format(id))
+        # Containers without a tty have their output multiplexed into frames
+        # with a header giving the stream and the length
+        data = self._logs.get(container['Id'], "").encode('utf-8')
+        frame = struct.pack('>BxxxL', 1, len(data)) + data if data else b''
+        return _Response(200, content=frame)
+
+    def _remove_container(self, request, id): # pylint: disable=redefined-builtin
+        container = self._container(id)
+        if container is None:
+            return _error(404, "No such container: {:s}".format(id))
+        if container['State']['Running'] and request.param('force') not in ('1', 'True', 'true'):
+            return _error(409, "You cannot remove a running container {:s}. Stop the "
+                          "container before attempting removal or force remove"
+                          .format(container['Id']))
+        del self.containers[container['Id']]
+        del self._names[container['Name'][1:]]
+        self._logs.pop(container['Id'], None)
+        self._emit(container, 'destroy')
+        return _Response(204)
+
+    # System
+
+    def _ping(self, request):
+        return _Response(200, content=b'OK')
+
+    def _version(self, request):
+        return _Response(200, {'ApiVersion': API_VERSION, 'MinAPIVersion': '1.12',
+                               'Version': 'fake', 'Os': 'linux', 'Arch': 'amd64'})
+
+    def _emit(self, container, action, **attributes):
+        now = time.time()
+        image = container['Config']['Image']
+        event = {'Type': 'container', 'Action': action, 'status': action,
+                 'id': container['Id'], 'from': image, 'scope': 'local',
+                 'Actor': {'ID': container['Id'],
+                           'Attributes': dict(container['Config']['Labels'],
+                                              name=container['Name'][1:], image=image,
+                                              **attributes)},
+                 'time': int(now), 'timeNano': int(now * 1000000000)}
+        for subscriber, filters in self._subscribers:
+            if self._delivered(event, filters):
+                subscriber.put(event)
+
+    @staticmethod
+    def _delivered(event, filters):
+        attributes = event['Actor']['Attributes']
+        checks = {
+            'type': lambda value: event['Type'] == value,
+            'container': lambda value: value in (event['id'], attributes['name']),
+            'event': lambda value: (event['Action'] == value
+                                    or event['Action'].startswith(value + ':')),
+        }
+        for key, values in filters.items():
+            if key == 'label':
+                if not _matches_labels(attributes, values):
+                    return False
+            elif key in checks and not any(checks[key](value) for value in values):
+                return False
+        return True
+
+    def _events(self, request):
+        subscriber = queue.Queue()
+        entry = (subscriber, request.filters())
+        self._subscribers.append(entry)
+        def stream():
+            try:
+                while not self._stopped.is_set():
+                    try:
+                        yield subscriber.get(timeout=EVENT_POLL_INTERVAL)
+                    except queue.Empty:
+                        yield None
+            finally:
+                with self._lock:
+                    self._subscribers.remove(entry)
+        return _Response(200, stream=stream())
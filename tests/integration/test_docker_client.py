@@ -75,6 +75,7 @@ class DockerClientTests(unittest.TestCase):
             image = 'nginx'
             ports = {80: 8085}
         service = TestService()
+        client.check_image(service.image)
         container_name = client.run_service_on_network('miniboss-test-service',
                                                        service,
                                                        Network(name='miniboss-test-network', id=""))
@@ -89,6 +90,31 @@ class DockerClientTests(unittest.TestCase):
         assert network.containers[0].name == container_name
 
 
+    def test_service_containers(self):
+        miniboss.group_name('testing')
+        client = DockerClient.get_client()
+        network = client.create_network('miniboss-test-network')
+        self.network_cleanup.append('miniboss-test-network')
+        class TestService(miniboss.Service):
+            name = 'test-service'
+            image = 'nginx'
+        service = TestService()
+        client.check_image(service.image)
+        network = Network(name='miniboss-test-network', id=network.id)
+        container_name = client.run_service_on_network('test-service-testing',
+                                                       service,
+                                                       network)
+        self.container_cleanup.append(container_name)
+        client.index_containers(network)
+        try:
+            containers = client.service_containers('test-service', network)
+            assert [c.name for c in containers] == [container_name]
+            assert containers[0].labels['miniboss.service'] == 'test-service'
+            assert client.service_containers('test', network) == []
+        finally:
+            client.forget_containers()
+
+
     def test_run_service_volume_mount(self):
         client = DockerClient.get_client()
         client.create_network('miniboss-test-network')
@@ -185,6 +211,7 @@ COPY index.html /usr/share/nginx/html""")
             image = 'nginx'
             ports = {80: 8085}
         service = TestService()
+        client.check_image(service.image)
         container_name = client.run_service_on_network('miniboss-test-service',
                                                        service,
                                                        Network(name='miniboss-test-network', id=""))
@@ -244,3 +271,39 @@ COPY index.html /usr/share/nginx/html""")
         client.build_image(context, 'Dockerfile', 'temporary-tag')
         images = lib_client.images.list(name="temporary-tag")
         assert len(images) == 1
+
+
+    def test_wait_until_healthy(self):
+        client = DockerClient.get_client()
+        client.create_network('miniboss-test-network')
+        self.network_cleanup.append('miniboss-test-network')
+        class TestService(miniboss.Service):
+            name = 'test-service'
+            image = 'nginx'
+            healthcheck = {'test': ['CMD-SHELL', 'exit 0'], 'interval': 0.5}
+            wait_for_healthy = True
+        service = TestService()
+        client.check_image(service.image)
+        container_name = client.run_service_on_network('miniboss-test-service',
+                                                       service,
+                                                       Network(name='miniboss-test-network', id=""))
+        self.container_cleanup.append(container_name)
+        assert client.wait_until_healthy(container_name, 10)
+
+
+    def test_wait_until_unhealthy(self):
+        client = DockerClient.get_client()
+        client.create_network('miniboss-test-network')
+        self.network_cleanup.append('miniboss-test-network')
+        class TestService(miniboss.Service):
+            name = 'test-service'
+            image = 'nginx'
+            healthcheck = {'test': ['CMD-SHELL', 'exit 1'], 'interval': 0.5, 'retries': 1}
+            wait_for_healthy = True
+        service = TestService()
+        client.check_image(service.image)
+        container_name = client.run_service_on_network('miniboss-test-service',
+                                                       service,
+                                                       Network(name='miniboss-test-network', id=""))
+        self.container_cleanup.append(container_name)
+        assert not client.wait_until_healthy(container_name, 10)
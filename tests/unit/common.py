@@ -2,6 +2,7 @@ import uuid
 import time
 from types import SimpleNamespace as Bunch
 
+from miniboss.docker_client import definition_fingerprint
 from miniboss.types import Options, Network
 
 DEFAULT_OPTIONS = Options(network=Network(name='the-network', id='the-network-id'),
@@ -16,6 +17,7 @@ class FakeRunningContext:
         self.started_services = []
         self.stopped_services = []
         self.failed_services = []
+        self.progressed_services = []
 
     def service_started(self, service):
         self.started_services.append(service)
@@ -26,14 +28,29 @@ class FakeRunningContext:
     def service_failed(self, failed_service):
         self.failed_services.append(failed_service)
 
+    def service_progressed(self, service, stage):
+        self.progressed_services.append((service, stage))
+
+    @property
+    def context_failed(self):
+        return self.failed_services != []
+
 class FakeService:
     image = 'not/used'
     dependants = []
+    wait_for = {}
     ports = {}
     env = {}
     always_start_new = False
     build_from = None
     dockerfile = 'Dockerfile'
+    spool_build_context = False
+    snapshot = False
+    readiness = None
+    wait_for_healthy = False
+    healthcheck = None
+    volumes = {}
+    stop_signal = "SIGTERM"
 
     def __init__(self, name='service1', dependencies=None, fail_ping=False, exception_at_init=None):
         self.name = name
@@ -70,6 +87,7 @@ class FakeContainer(Bunch):
         self.stopped = False
         self.removed_at = None
         self.timeout = None
+        self.labels = {}
         super().__init__(**kwargs)
 
     def stop(self, timeout):
@@ -94,9 +112,27 @@ class FakeDocker:
         self._networks_removed = []
         self._services_started = []
         self._existing_queried = []
+        self._indexed = []
+        self._invalidated = []
+        self._fingerprints = []
         self._containers_ran = []
+        self._containers_created = {}
+        self._containers_removed = []
+        self._volume_paths = ['/data']
+        self._committed = []
+        self._created_images = []
+        self._imported = []
+        self._paused = []
         self._images_built = []
+        self._images_available = []
+        self._images_checked = []
+        self._prefetched = []
+        self._health_waited = []
+        self.healthy = True
         self._existing_containers = []
+        self._watching = []
+        self._ledgers = []
+        self.exited_containers = {}
         self.network_name_id_mapping = network_name_id_mapping or {}
 
     def create_network(self, network_name):
@@ -106,19 +142,104 @@ class FakeDocker:
     def remove_network(self, network_name):
         self._networks_removed.append(network_name)
 
-    def existing_on_network(self, name, network):
-        self._existing_queried.append((name, network))
-        for container in self._existing_containers:
-            if (container.name.startswith(name) and
-                self.network_name_id_mapping[container.network] == network.id):
-                return [container]
-        return []
+    def attach_ledger(self, ledger):
+        self._ledgers.append(ledger)
+
+    def detach_ledger(self, ledger):
+        self._ledgers.remove(ledger)
+
+    def watch_events(self, group_name):
+        self._watching.append(group_name)
+
+    def stop_watching(self):
+        self._watching.pop()
+
+    def exit_logs(self, container):
+        return self.exited_containers.get(container)
+
+    def on_container_exit(self, container, callback):
+        if container in self.exited_containers:
+            callback()
 
-    def run_service_on_network(self, name_prefix, service, network):
+    def index_containers(self, network):
+        self._indexed.append(network)
+
+    def forget_containers(self):
+        pass
+
+    def invalidate_containers(self, service_name):
+        self._invalidated.append(service_name)
+
+    def service_containers(self, service_name, network):
+        self._existing_queried.append((service_name, network))
+        return [container for container in self._existing_containers
+                if (container.name.rsplit('-', 2)[0] == service_name and
+                    self.network_name_id_mapping[container.network] == network.id)]
+
+    def fingerprint(self, service):
+        return definition_fingerprint(service, 'the-image-id')
+
+    def run_service_on_network(self, name_prefix, service, network, fingerprint=None):
         self._services_started.append((name_prefix, service, network))
+        self._fingerprints.append(fingerprint)
+        return "{:s}-1234".format(name_prefix)
+
+    def create_service_container(self, name_prefix, service, network, fingerprint=None,
+                                 image=None):
+        container_id = "{:s}-id".format(name_prefix)
+        self._containers_created[container_id] = (name_prefix, service, network)
+        self._created_images.append(image or service.image)
+        self._fingerprints.append(fingerprint)
+        return container_id, "{:s}-1234".format(name_prefix)
 
-    def run_container(self, container_id):
+    def remove_container(self, container_id):
+        self._containers_removed.append(container_id)
+
+    def volume_paths(self, container_name):
+        return self._volume_paths
+
+    def pause_container(self, container_name):
+        self._paused.append(container_name)
+
+    def unpause_container(self, container_name):
+        self._paused.remove(container_name)
+
+    def export_path(self, container_name, path, outfile):
+        assert container_name in self._paused
+        outfile.write("contents of {:s}".format(path).encode('utf-8'))
+
+    def import_path(self, container_id, path, infile):
+        self._imported.append((container_id, path, infile.read()))
+
+    def commit_container(self, container_name, repository, tag):
+        image = "{:s}:{:s}".format(repository, tag)
+        self._committed.append((container_name, image))
+        self._images_available.append(image)
+        return image
+
+    def wait_until_healthy(self, container_id, timeout):
+        self._health_waited.append((container_id, timeout))
+        return self.healthy
+
+    def prefetch_images(self, tags, parallelism=None):
+        self._prefetched.append((sorted(set(tags)), parallelism))
+
+    def stop_prefetching(self):
+        pass
+
+    def check_image(self, tag):
+        self._images_checked.append(tag)
+        return 'the-image-id'
+
+    def run_container(self, container_id, labels=None):
         self._containers_ran.append(container_id)
+        if container_id in self._containers_created:
+            # Containers created in advance count as started services when run
+            self._services_started.append(self._containers_created[container_id])
 
-    def build_image(self, build_dir, dockerfile, image_tag):
+    def build_image(self, build_dir, dockerfile, image_tag, spool=False):
         self._images_built.append((build_dir, dockerfile, image_tag))
+        self._images_available.append(image_tag)
+
+    def image_exists(self, tag):
+        return tag in self._images_available
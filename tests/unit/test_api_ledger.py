@@ -0,0 +1,93 @@
+import asyncio
+import datetime
+import threading
+import unittest
+from types import SimpleNamespace as Bunch
+
+from miniboss.api_ledger import (ApiLedger, ApiCall, attributed, attributed_to, endpoint,
+                                 percentile)
+
+
+def response(method, url, seconds, body=None, length=None, status=200):
+    headers = {} if length is None else {'Content-Length': str(length)}
+    return Bunch(request=Bunch(method=method, url=url, body=body),
+                 elapsed=datetime.timedelta(seconds=seconds),
+                 status_code=status,
+                 headers=headers)
+
+
+class EndpointTests(unittest.TestCase):
+
+    def test_endpoint(self):
+        base = "http+docker://localhost/v1.41"
+        assert endpoint('GET', base + "/containers/json?all=1") == 'GET /containers/json'
+        assert endpoint('POST', base + "/containers/create?name=db") == 'POST /containers/create'
+        assert endpoint('POST', base + "/containers/3f4e1a/start") == 'POST /containers/{id}/start'
+        assert endpoint('DELETE', base + "/containers/db-testing-1") == 'DELETE /containers/{id}'
+        assert endpoint('DELETE', base + "/networks/abc") == 'DELETE /networks/{id}'
+        assert endpoint('GET', base + "/images/library/postgres:12/json") == (
+            'GET /images/{name}/json')
+        assert endpoint('POST', base + "/images/create?fromImage=redis") == (
+            'POST /images/create')
+        assert endpoint('GET', "http://localhost:2375/events") == 'GET /events'
+
+    def test_percentile(self):
+        assert percentile([5], 95) == 5
+        assert percentile([4, 1, 3, 2], 50) == 2
+        assert percentile(list(range(1, 101)), 95) == 95
+
+
+class ApiLedgerTests(unittest.TestCase):
+
+    def test_record(self):
+        ledger = ApiLedger()
+        ledger.record(response('POST', "http://localhost/containers/create", 0.01,
+                               body=b'{"Image": "postgres"}', length=88, status=201))
+        ledger.record(response('GET', "http://localhost/events", 0.002))
+        assert ledger.calls == [
+            ApiCall(endpoint='POST /containers/create', latency=0.01, status=201,
+                    sent=21, received=88),
+            ApiCall(endpoint='GET /events', latency=0.002, status=200, sent=0, received=None)]
+
+    def test_attribution(self):
+        ledger = ApiLedger()
+        def call():
+            ledger.record(response('GET', "http://localhost/containers/json", 0.001))
+        with attributed_to('db'):
+            call()
+            # Threads do not inherit the attribution, each agent sets its own
+            thread = threading.Thread(target=call)
+            thread.start()
+            thread.join()
+        agent = Bunch(service=Bunch(name='app'), call=attributed(lambda self: call()))
+        agent.call(agent)
+        async def in_task():
+            with attributed_to('cache'):
+                await asyncio.get_running_loop().run_in_executor(None, call)
+                await asyncio.to_thread(call)
+        asyncio.run(in_task())
+        assert [x.service for x in ledger.calls] == ['db', None, 'app', None, 'cache']
+
+    def test_summary(self):
+        ledger = ApiLedger()
+        with attributed_to('db'):
+            for milliseconds in range(1, 21):
+                ledger.record(response('POST', "http://localhost/containers/abc/start",
+                                       milliseconds / 1000))
+        ledger.record(response('POST', "http://localhost/images/create?fromImage=redis", 1.5,
+                               status=404))
+        assert ledger.summary() == [
+            "Docker API calls: 21, 1.710s in total",
+            "  POST /containers/{id}/start: 20 calls, p50 10.0ms, p95 19.0ms, "
+            "0 bytes sent, 0 received",
+            "  POST /images/create: 1 calls, p50 1500.0ms, p95 1500.0ms, "
+            "0 bytes sent, 0 received",
+            "Slowest calls:",
+            "  1500.0ms POST /images/create (no service), status 404",
+            "  20.0ms POST /containers/{id}/start (db), status 200",
+            "  19.0ms POST /containers/{id}/start (db), status 200",
+            "  18.0ms POST /containers/{id}/start (db), status 200",
+            "  17.0ms POST /containers/{id}/start (db), status 200"]
+
+    def test_empty_summary(self):
+        assert ApiLedger().summary() == ["Docker API calls: 0, 0.000s in total"]
@@ -0,0 +1,136 @@
+import asyncio
+import unittest
+
+import attr
+
+from miniboss import types, async_engine, service_agent
+from miniboss.async_engine import AsyncRunningContext
+from miniboss.services import connect_services
+
+from common import FakeDocker, FakeService, FakeContainer, DEFAULT_OPTIONS
+
+
+class AsyncFakeService(FakeService):
+
+    async def ping(self):
+        self.ping_count += 1
+        await asyncio.sleep(0)
+        return not self.fail_ping
+
+
+class SlowFakeService(FakeService):
+
+    async def ping(self):
+        self.ping_count += 1
+        await asyncio.sleep(0.5)
+        return True
+
+
+class AsyncRunningContextTests(unittest.TestCase):
+
+    def setUp(self):
+        self.docker = FakeDocker.Instance = FakeDocker({'the-network': 'the-network-id'})
+        async_engine.DockerClient = self.docker
+        service_agent.DockerClient = self.docker
+        types.set_group_name('testing')
+
+    def tearDown(self):
+        types._unset_group_name()
+
+    def test_start_all_in_dependency_order(self):
+        services = connect_services([FakeService(name='service1'),
+                                     FakeService(name='service2', dependencies=['service1']),
+                                     FakeService(name='service3', dependencies=['service2'])])
+        context = AsyncRunningContext(services, DEFAULT_OPTIONS)
+        asyncio.run(context.start_all())
+        assert context.done
+        assert not context.context_failed
+        started = [service.name for _, service, _ in self.docker._services_started]
+        assert started == ['service1', 'service2', 'service3']
+        assert [x.name for x in context.processed_services] == started
+        assert all(service.init_called for service in services.values())
+
+
+    def test_async_hooks(self):
+        services = connect_services([AsyncFakeService(name='service1')])
+        context = AsyncRunningContext(services, DEFAULT_OPTIONS)
+        asyncio.run(context.start_all())
+        assert services['service1'].ping_count == 1
+        assert services['service1'].pre_start_called
+        assert services['service1'].init_called
+
+
+    def test_no_hang_on_failure_with_waiting_agents(self):
+        services = connect_services([FakeService(name='a', fail_ping=True),
+                                     SlowFakeService(name='x'),
+                                     FakeService(name='b', dependencies=['x']),
+                                     FakeService(name='c', dependencies=['b'])])
+        options = attr.evolve(DEFAULT_OPTIONS, timeout=0.2)
+        context = AsyncRunningContext(services, options)
+        async def start():
+            await asyncio.wait_for(context.start_all(), 5)
+        asyncio.run(start())
+        assert context.done
+        assert [x.name for x in context.failed_services] == ['a']
+        started = [service.name for _, service, _ in self.docker._services_started]
+        assert 'b' not in started and 'c' not in started
+
+
+    def test_parallelism_limits_agents(self):
+        services = connect_services([SlowFakeService(name='service{}'.format(index))
+                                     for index in range(4)])
+        options = attr.evolve(DEFAULT_OPTIONS, parallelism=2)
+        context = AsyncRunningContext(services, options)
+        running = 0
+        most_running = 0
+        original = async_engine.AsyncServiceAgent.run_async
+        async def counting_run(agent):
+            nonlocal running, most_running
+            running += 1
+            most_running = max(most_running, running)
+            await original(agent)
+            running -= 1
+        async_engine.AsyncServiceAgent.run_async = counting_run
+        try:
+            asyncio.run(context.start_all())
+        finally:
+            async_engine.AsyncServiceAgent.run_async = original
+        assert context.done
+        assert most_running == 2
+
+
+    def test_service_failed_twice(self):
+        services = connect_services([FakeService(name='service1'),
+                                     FakeService(name='service2', dependencies=['service1'])])
+        context = AsyncRunningContext(services, DEFAULT_OPTIONS)
+        context._create_events()
+        context.service_failed(services['service1'])
+        context.service_failed(services['service1'])
+        assert context.done
+        assert [x.name for x in context.failed_services] == ['service1', 'service2']
+
+
+    def test_failure_fails_dependants(self):
+        services = connect_services([FakeService(name='service1', fail_ping=True),
+                                     FakeService(name='service2', dependencies=['service1']),
+                                     FakeService(name='service3')])
+        options = attr.evolve(DEFAULT_OPTIONS, timeout=0.05)
+        context = AsyncRunningContext(services, options)
+        asyncio.run(context.start_all())
+        failed = {x.name for x in context.failed_services}
+        assert {'service1', 'service2'} <= failed
+        assert not services['service2'].pre_start_called
+
+
+    def test_stop_all_in_reverse_order(self):
+        containers = [FakeContainer(name='service{}-testing-1234'.format(index),
+                                    network='the-network',
+                                    status='running')
+                      for index in (1, 2)]
+        self.docker._existing_containers = containers
+        services = connect_services([FakeService(name='service1'),
+                                     FakeService(name='service2', dependencies=['service1'])])
+        context = AsyncRunningContext(services, DEFAULT_OPTIONS)
+        asyncio.run(context.stop_all())
+        assert [x.name for x in context.processed_services] == ['service2', 'service1']
+        assert all(container.stopped for container in containers)
@@ -0,0 +1,120 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import pytest
+
+from miniboss.build_context import (context_digest,
+                                    context_dockerfile,
+                                    context_paths,
+                                    context_stream,
+                                    read_dockerignore,
+                                    spooled_context)
+from miniboss.exceptions import DockerException
+
+
+class BuildContextTests(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        self.write('Dockerfile', "FROM scratch\n")
+        self.write('app.py', "print('hello')\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir)
+
+    def write(self, path, contents):
+        full = os.path.join(self.build_dir, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'w', encoding='utf-8') as outfile:
+            outfile.write(contents)
+
+    def test_read_dockerignore(self):
+        assert read_dockerignore(self.build_dir) == []
+        self.write('.dockerignore', "# comment\n\nnode_modules\n*.log\n")
+        assert read_dockerignore(self.build_dir) == ['node_modules', '*.log']
+
+
+    def test_dockerignore_respected(self):
+        self.write('.dockerignore', "node_modules\n*.log\nDockerfile\n")
+        self.write('node_modules/lib.js', "x")
+        self.write('src/main.py', "pass")
+        paths = set(context_paths(self.build_dir, 'Dockerfile'))
+        assert paths == {'.dockerignore', 'Dockerfile', 'app.py', 'src', 'src/main.py'}
+        digest = context_digest(self.build_dir, 'Dockerfile')
+        self.write('node_modules/lib.js', "y")
+        self.write('debug.log', "y")
+        assert context_digest(self.build_dir, 'Dockerfile') == digest
+
+
+    def test_digest_changes(self):
+        digest = context_digest(self.build_dir, 'Dockerfile')
+        assert context_digest(self.build_dir, 'Dockerfile') == digest
+        self.write('app.py', "print('bye')\n")
+        changed = context_digest(self.build_dir, 'Dockerfile')
+        assert changed != digest
+        os.chmod(os.path.join(self.build_dir, 'app.py'), 0o755)
+        assert context_digest(self.build_dir, 'Dockerfile') != changed
+        os.rename(os.path.join(self.build_dir, 'app.py'), os.path.join(self.build_dir, 'run.py'))
+        assert context_digest(self.build_dir, 'Dockerfile') not in (digest, changed)
+
+
+    def test_missing_directory(self):
+        with pytest.raises(DockerException):
+            context_digest(os.path.join(self.build_dir, 'nope'), 'Dockerfile')
+
+
+    def read_tar(self, fileobj):
+        with tarfile.open(fileobj=fileobj) as tar:
+            return {member.name: (tar.extractfile(member).read() if member.isreg() else None)
+                    for member in tar.getmembers()}
+
+
+    def test_context_stream(self):
+        self.write('.dockerignore', "*.log\n")
+        self.write('debug.log', "x")
+        self.write('src/main.py', "pass")
+        os.symlink('main.py', os.path.join(self.build_dir, 'src', 'link.py'))
+        self.write('large.bin', "a" * 5000)
+        chunks = list(context_stream(self.build_dir, 'Dockerfile', chunk_size=1024))
+        assert len(chunks) > 1
+        members = self.read_tar(io.BytesIO(b''.join(chunks)))
+        assert set(members) == {'.dockerignore', 'Dockerfile', 'app.py', 'src', 'src/main.py',
+                                'src/link.py', 'large.bin'}
+        assert members['large.bin'] == b"a" * 5000
+        assert members['src/main.py'] == b"pass"
+
+
+    def test_spooled_context(self):
+        spool = spooled_context(self.build_dir, 'Dockerfile')
+        try:
+            members = self.read_tar(spool)
+        finally:
+            spool.close()
+        assert members['app.py'] == b"print('hello')\n"
+
+
+    def test_dockerfile_outside_context(self):
+        other_dir = tempfile.mkdtemp()
+        try:
+            dockerfile = os.path.join(other_dir, 'Dockerfile.dev')
+            with open(dockerfile, 'w', encoding='utf-8') as outfile:
+                outfile.write("FROM alpine\n")
+            relative = os.path.relpath(dockerfile, self.build_dir)
+            name, external = context_dockerfile(self.build_dir, relative)
+            assert name.startswith('.dockerfile.')
+            assert external == os.path.join(self.build_dir, relative)
+            assert context_dockerfile(self.build_dir, 'Dockerfile') == ('Dockerfile', None)
+            members = self.read_tar(io.BytesIO(b''.join(
+                context_stream(self.build_dir, relative))))
+            assert members[name] == b"FROM alpine\n"
+        finally:
+            shutil.rmtree(other_dir)
+
+
+    def test_stream_missing_directory(self):
+        with pytest.raises(DockerException):
+            context_stream(os.path.join(self.build_dir, 'nope'), 'Dockerfile')
@@ -0,0 +1,107 @@
+import unittest
+from types import SimpleNamespace as Bunch
+
+from miniboss.containers import (ContainerIndex,
+                                 service_of,
+                                 LABEL_GROUP,
+                                 LABEL_SERVICE)
+from miniboss.docker_client import definition_fingerprint
+from miniboss.types import Network
+
+
+def summary(name, service=None, group='testing'):
+    labels = {}
+    if service is not None:
+        labels = {LABEL_GROUP: group, LABEL_SERVICE: service}
+    return {'Id': name + '-id', 'Names': ['/' + name], 'State': 'running', 'Labels': labels}
+
+
+class FakeLibClient:
+
+    def __init__(self, summaries):
+        self.summaries = summaries
+        self.list_calls = []
+        self.api = Bunch(containers=self.containers)
+
+    def containers(self, all, filters): # pylint: disable=redefined-builtin
+        self.list_calls.append(filters)
+        if 'name' in filters:
+            return [x for x in self.summaries if filters['name'][0] in x['Names'][0]]
+        return self.summaries
+
+    def prepare_model(self, attrs):
+        return Bunch(id=attrs['Id'], name=attrs['Name'].lstrip('/'), attrs=attrs)
+
+
+class ServiceOfTests(unittest.TestCase):
+
+    def test_labels(self):
+        assert service_of(summary('db-testing-1234', 'db'), 'testing') == 'db'
+        assert service_of(summary('db-other-1234', 'db', 'other'), 'testing') is None
+
+
+    def test_unlabelled_exact_name(self):
+        assert service_of(summary('db-testing-1234'), 'testing') == 'db'
+        assert service_of(summary('db-replica-testing-1234'), 'testing') == 'db-replica'
+        assert service_of(summary('db-testing-12345'), 'testing') is None
+        assert service_of(summary('random-name'), 'testing') is None
+
+
+class ContainerIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib_client = FakeLibClient([summary('db-testing-1234', 'db'),
+                                         summary('db-replica-testing-5678', 'db-replica'),
+                                         summary('db-testing-9999', 'db', 'other')])
+        self.lib_client.containers = self.lib_client
+        self.index = ContainerIndex(self.lib_client, 'testing',
+                                    Network(name='the-network', id='the-network-id'))
+
+    def test_single_list_call(self):
+        self.index.refresh()
+        assert [x.name for x in self.index.lookup('db')] == ['db-testing-1234']
+        assert [x.name for x in self.index.lookup('db-replica')] == ['db-replica-testing-5678']
+        assert self.index.lookup('appserver') == []
+        assert self.lib_client.list_calls == [{'network': ['the-network-id']}]
+        container = self.index.lookup('db')[0]
+        assert container.attrs['Config']['Labels'][LABEL_SERVICE] == 'db'
+
+
+    def test_refresh_invalidated(self):
+        self.index.refresh()
+        self.lib_client.summaries.append(summary('db-testing-4321', 'db'))
+        assert len(self.index.lookup('db')) == 1
+        self.index.invalidate('db')
+        assert len(self.index.lookup('db')) == 2
+        assert self.lib_client.list_calls[1] == {'network': ['the-network-id'],
+                                                 'name': ['db-testing-']}
+        assert len(self.lib_client.list_calls) == 2
+        assert len(self.index.lookup('db')) == 2
+        assert len(self.lib_client.list_calls) == 2
+
+
+class FingerprintTests(unittest.TestCase):
+
+    def service(self, **kwargs):
+        fields = dict(image='postgres:12', env={'PORT': 5432}, ports={5432: 5433},
+                      volumes={}, stop_signal='SIGTERM', healthcheck=None)
+        fields.update(kwargs)
+        return Bunch(**fields)
+
+    def test_canonical(self):
+        fingerprint = definition_fingerprint(self.service(), 'image-id')
+        assert fingerprint == definition_fingerprint(self.service(env={'PORT': '5432'}),
+                                                     'image-id')
+        assert fingerprint == definition_fingerprint(self.service(ports={'5432': 5433}),
+                                                     'image-id')
+
+
+    def test_drift(self):
+        fingerprint = definition_fingerprint(self.service(), 'image-id')
+        assert fingerprint != definition_fingerprint(self.service(), 'other-image-id')
+        assert fingerprint != definition_fingerprint(self.service(ports={5432: 5434}),
+                                                     'image-id')
+        assert fingerprint != definition_fingerprint(
+            self.service(volumes={'/tmp': {'bind': '/data', 'mode': 'rw'}}), 'image-id')
+        assert fingerprint != definition_fingerprint(self.service(stop_signal='SIGINT'),
+                                                     'image-id')
@@ -1,7 +1,9 @@
 import os
 import json
+import shutil
 import unittest
 import tempfile
+import threading
 
 import pytest
 
@@ -45,6 +47,15 @@ class ContextTests(unittest.TestCase):
                           'key2': 'And this is hello',
                           'key3': 456}
 
+    def test_uses_context(self):
+        assert _Context.uses_context("{port}")
+        assert _Context.uses_context("postgres://{host}:5432")
+        assert _Context.uses_context("{unclosed")
+        assert not _Context.uses_context("no fields")
+        assert not _Context.uses_context("{{escaped}}")
+        assert not _Context.uses_context(5432)
+
+
     def test_save_to_load_from(self):
         directory = tempfile.mkdtemp()
         context = _Context(blah=123, yada="hello")
@@ -75,3 +86,131 @@ class ContextTests(unittest.TestCase):
     def test_remove_file_missing(self):
         context = _Context()
         context.remove_file("/not/existing/directory/blahakshdakusdhau")
+
+
+class ObservableContextTests(unittest.TestCase):
+
+    def test_placeholders(self):
+        context = _Context()
+        assert context.placeholders("{host}:{port:d}/{config.path}{{literal}}") == {
+            'host', 'port', 'config'}
+        assert context.placeholders(5432) == set()
+        assert context.keys_used({'URL': "{host}/{db[name]}", 'PORT': 5432}) == {'host', 'db'}
+        assert context.keys_used({}) == set()
+
+
+    def test_listeners(self):
+        context = _Context()
+        keys = []
+        context.add_listener(keys.append)
+        context['blah'] = 123
+        context.update(yada='hello')
+        context.remove_listener(keys.append)
+        context['other'] = 1
+        assert keys == ['blah', 'yada']
+
+
+    def test_wait_for_keys(self):
+        context = _Context(blah=123)
+        assert context.wait_for_keys(['blah'], 0)
+        assert not context.wait_for_keys(['blah', 'yada'], 0.05)
+        timer = threading.Timer(0.05, context.__setitem__, ('yada', 'hello'))
+        timer.start()
+        assert context.wait_for_keys(['blah', 'yada'], 5)
+        timer.join()
+
+
+    def test_wait_for_keys_abort(self):
+        context = _Context()
+        aborted = threading.Event()
+        threading.Timer(0.05, aborted.set).start()
+        assert not context.wait_for_keys(['blah'], 60, abort=aborted.is_set)
+
+
+class ContextStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persisted_when_set(self):
+        context = _Context()
+        with context.attached(self.directory):
+            context['blah'] = 123
+            context.update(yada="hello")
+            # Not saved yet, but a new process would see the values
+            new_context = _Context()
+            new_context.load_from(self.directory)
+            assert new_context == {'blah': 123, 'yada': 'hello'}
+            context.pop('blah')
+        context['not_persisted'] = True
+        new_context = _Context()
+        new_context.load_from(self.directory)
+        assert new_context == {'yada': 'hello'}
+
+
+    def test_incomplete_journal_entry(self):
+        context = _Context()
+        with context.attached(self.directory):
+            context['blah'] = 123
+        with open(os.path.join(self.directory, ".miniboss-context.journal"), 'a') as journal:
+            journal.write('{"set": "yada", "val')
+        new_context = _Context()
+        new_context.load_from(self.directory)
+        assert new_context == {'blah': 123}
+
+
+    def test_compaction(self):
+        context = _Context()
+        context.compact_after = 3
+        with context.attached(self.directory):
+            for index in range(4):
+                context['key{:d}'.format(index)] = index
+        with open(os.path.join(self.directory, ".miniboss-context"), 'r') as context_file:
+            assert json.load(context_file) == {'key0': 0, 'key1': 1, 'key2': 2}
+        new_context = _Context()
+        new_context.load_from(self.directory)
+        assert new_context == {'key0': 0, 'key1': 1, 'key2': 2, 'key3': 3}
+        context.save_to(self.directory)
+        assert sorted(os.listdir(self.directory)) == ['.miniboss-context',
+                                                      '.miniboss-context.lock']
+
+
+    def test_processes_do_not_overwrite(self):
+        first = _Context()
+        second = _Context()
+        with first.attached(self.directory), second.attached(self.directory):
+            first['first'] = 1
+            second['second'] = 2
+            first['shared'] = 'first'
+            second['shared'] = 'second'
+        first.save_to(self.directory)
+        second.save_to(self.directory)
+        new_context = _Context()
+        new_context.load_from(self.directory)
+        assert new_context == {'first': 1, 'second': 2, 'shared': 'second'}
+        # The values of the other process are visible after saving
+        assert first['second'] == 2
+
+
+    def test_remove_journal(self):
+        context = _Context()
+        with context.attached(self.directory):
+            context['blah'] = 123
+        context.remove_file(self.directory)
+        new_context = _Context()
+        new_context.load_from(self.directory)
+        assert new_context == {}
+        # The lock file is kept for processes that wait for it
+        assert os.listdir(self.directory) == ['.miniboss-context.lock']
+
+
+    def test_value_not_serializable(self):
+        context = _Context()
+        with context.attached(self.directory):
+            with pytest.raises(ContextError, match="'blah' cannot be saved as JSON"):
+                context['blah'] = object()
+        assert 'blah' not in context
+
@@ -0,0 +1,108 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace as Bunch
+
+import docker.errors
+import pytest
+
+from miniboss.docker_client import DockerClient
+from miniboss.exceptions import DockerException
+
+
+class FakeImages:
+
+    def __init__(self, local=()):
+        self.local = set(local)
+        self.pulled = []
+        self.lock = threading.Lock()
+        self.pulling = 0
+        self.max_pulling = 0
+        self.release = threading.Event()
+        self.fail = set()
+
+    def get(self, tag):
+        if tag not in self.local:
+            raise docker.errors.ImageNotFound("No such image")
+        return Bunch(id=tag + '-id')
+
+    def pull(self, tag, stream, decode):
+        """Streaming pull of the low-level API, which sends progress messages
+        until the pull is released"""
+        with self.lock:
+            self.pulled.append(tag)
+            self.pulling += 1
+            self.max_pulling = max(self.max_pulling, self.pulling)
+        if tag in self.fail:
+            self.fail.discard(tag)
+            with self.lock:
+                self.pulling -= 1
+            raise docker.errors.APIError("Pull failed", explanation="Pull failed")
+        return self._progress(tag)
+
+    def _progress(self, tag):
+        try:
+            deadline = time.monotonic() + 5
+            while not self.release.wait(0.01) and time.monotonic() < deadline:
+                yield {'status': 'Downloading'}
+            self.local.add(tag)
+        finally:
+            with self.lock:
+                self.pulling -= 1
+
+
+class PrefetchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.images = FakeImages(local=['postgres:12'])
+        self.client = DockerClient(Bunch(images=self.images,
+                                         api=Bunch(pull=self.images.pull)))
+
+    def tearDown(self):
+        self.images.release.set()
+        self.client.stop_prefetching()
+
+    def test_pulls_missing_concurrently(self):
+        self.client.prefetch_images(['postgres:12', 'redis:6', 'nginx:1', 'redis:6'],
+                                    parallelism=2)
+        self.images.release.set()
+        assert self.client.check_image('redis:6') == 'redis:6-id'
+        assert self.client.check_image('nginx:1') == 'nginx:1-id'
+        assert self.client.check_image('postgres:12') == 'postgres:12-id'
+        assert sorted(self.images.pulled) == ['nginx:1', 'redis:6']
+
+
+    def test_bounded(self):
+        self.client.prefetch_images(['a:1', 'b:1', 'c:1', 'd:1'], parallelism=2)
+        threading.Timer(0.1, self.images.release.set).start()
+        assert self.client.check_image('d:1') == 'd:1-id'
+        assert self.images.max_pulling == 2
+
+
+    def test_retry_failed_prefetch(self):
+        self.images.fail.add('redis:6')
+        self.images.release.set()
+        self.client.prefetch_images(['redis:6'])
+        assert self.client.check_image('redis:6') == 'redis:6-id'
+        assert self.images.pulled == ['redis:6', 'redis:6']
+        self.images.fail.add('nginx:1')
+        with pytest.raises(DockerException):
+            self.client.check_image('nginx:1')
+
+
+    def test_stop_aborts_running_pulls(self):
+        self.client.prefetch_images(['redis:6', 'nginx:1'], parallelism=1)
+        time.sleep(0.05)
+        start = time.monotonic()
+        self.client.stop_prefetching()
+        # The running pull is aborted and waited for, the queued one cancelled
+        assert time.monotonic() - start < 1
+        assert self.images.pulled == ['nginx:1']
+        assert self.images.pulling == 0
+        assert 'nginx:1' not in self.images.local
+
+
+    def test_not_prefetched(self):
+        self.images.release.set()
+        assert self.client.check_image('redis:6') == 'redis:6-id'
+        assert self.images.pulled == ['redis:6']
@@ -0,0 +1,221 @@
+import threading
+import unittest
+from types import SimpleNamespace as Bunch
+
+import pytest
+
+from miniboss import docker_client
+from miniboss.containers import LABEL_GROUP
+from miniboss.docker_client import DockerClient
+from miniboss.events import ContainerEvents
+from miniboss.exceptions import ContainerStartException
+
+
+def event(action, name, container_id='abcd', group='testing', **attributes):
+    attributes = dict(name=name, **attributes)
+    if group is not None:
+        attributes[LABEL_GROUP] = group
+    return {'Type': 'container',
+            'Action': action,
+            'Actor': {'ID': container_id, 'Attributes': attributes}}
+
+
+class FakeStream:
+
+    def __init__(self):
+        self.events = []
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def push(self, item):
+        with self.condition:
+            self.events.append(item)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.events or self.closed)
+                if self.closed:
+                    return
+                item = self.events.pop(0)
+            yield item
+
+
+class FakeLibClient:
+
+    def __init__(self, logs=b"the logs"):
+        self.stream = FakeStream()
+        self.started = []
+        self.filters = None
+        self.logs = logs
+        self.status = 'running'
+        self.health = {'Status': 'starting'}
+        self.api = Bunch(start=self.start, logs=lambda container: self.logs,
+                         inspect_container=self.inspect_container)
+        self.containers = Bunch(get=lambda container_id: Bunch(
+            id=container_id, name='appserver-testing-1234', status=self.status))
+
+    def events(self, decode, filters):
+        if 'container' in filters:
+            # Stream used for waiting for health without the group subscription
+            stream = FakeStream()
+            stream.close()
+            return stream
+        self.filters = filters
+        return self.stream
+
+    def inspect_container(self, container_id):
+        if self.health is None:
+            return {'State': {}}
+        return {'State': {'Health': self.health}}
+
+    def start(self, container_id):
+        self.started.append(container_id)
+
+
+class ContainerEventsTests(unittest.TestCase):
+
+    def test_ignore_other_groups(self):
+        events = ContainerEvents(None, 'testing')
+        events.process(event('start', 'appserver-other-1234', group='other'))
+        events.process(event('start', 'appserver-testing-1234', group=None))
+        assert events.states == {}
+        events.process(event('start', 'appserver-testing-1234'))
+        assert events.states['abcd'] is events.states['appserver-testing-1234']
+        assert events.states['abcd'].running
+
+
+    def test_die_oom_and_health(self):
+        events = ContainerEvents(None, 'testing')
+        events.process(event('start', 'appserver-testing-1234'))
+        events.process(event('health_status: healthy', 'appserver-testing-1234'))
+        state = events.states['abcd']
+        assert state.health == 'healthy'
+        events.process(event('oom', 'appserver-testing-1234'))
+        events.process(event('die', 'appserver-testing-1234', exitCode='137'))
+        assert not state.running
+        assert state.oom_killed
+        assert state.exit_code == '137'
+        assert events.exited('appserver-testing-1234')
+        assert not events.exited('other-testing-1234')
+
+
+    def test_exit_callbacks(self):
+        events = ContainerEvents(None, 'testing')
+        called = []
+        events.on_exit('appserver-testing-1234', lambda: called.append('by name'))
+        events.on_exit('abcd', lambda: called.append('by id'))
+        events.process(event('start', 'appserver-testing-1234'))
+        assert called == []
+        events.process(event('die', 'appserver-testing-1234'))
+        assert sorted(called) == ['by id', 'by name']
+        # Callbacks are called only once, and right away if already exited
+        events.process(event('die', 'appserver-testing-1234'))
+        assert len(called) == 2
+        events.on_exit('abcd', lambda: called.append('late'))
+        assert called[-1] == 'late'
+
+
+    def test_wait(self):
+        lib_client = FakeLibClient()
+        events = ContainerEvents(lib_client, 'testing')
+        events.start()
+        assert lib_client.filters == {'type': 'container',
+                                      'label': ['miniboss.group=testing']}
+        assert events.wait('abcd', lambda state: state.running, 0.01) is None
+        lib_client.stream.push(event('start', 'appserver-testing-1234'))
+        state = events.wait('abcd', lambda state: state.running, 1)
+        assert state.name == 'appserver-testing-1234'
+        events.stop()
+        # A closed stream does not block waiters
+        assert events.wait('other', lambda state: state.running, 5) is None
+
+
+class DockerClientEventsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib_client = FakeLibClient()
+        self.client = DockerClient(self.lib_client)
+        self.client.watch_events('testing')
+
+    def tearDown(self):
+        self.client.stop_watching()
+
+    def test_run_container_waits_for_start(self):
+        self.lib_client.stream.push(event('start', 'appserver-testing-1234'))
+        self.client.run_container('abcd')
+        assert self.lib_client.started == ['abcd']
+        assert self.client.exit_logs('appserver-testing-1234') is None
+
+
+    def test_run_container_exits(self):
+        self.lib_client.stream.push(event('die', 'appserver-testing-1234'))
+        with pytest.raises(ContainerStartException) as exc_info:
+            self.client.run_container('abcd')
+        assert exc_info.value.container_name == 'appserver-testing-1234'
+        assert exc_info.value.logs == 'the logs'
+        assert self.client.exit_logs('appserver-testing-1234') == 'the logs'
+
+
+    def test_run_container_no_event(self):
+        # Unlabelled containers and lost events fall back to inspecting
+        docker_client.START_EVENT_TIMEOUT, timeout = 0, docker_client.START_EVENT_TIMEOUT
+        try:
+            self.client.run_container('abcd')
+            self.lib_client.status = 'exited'
+            with pytest.raises(ContainerStartException) as exc_info:
+                self.client.run_container('abcd')
+            assert exc_info.value.logs == 'the logs'
+        finally:
+            docker_client.START_EVENT_TIMEOUT = timeout
+
+
+    def test_run_container_without_group_label(self):
+        # Containers created by older versions are inspected without waiting
+        # for an event, which is never emitted for them
+        docker_client.START_EVENT_TIMEOUT, timeout = 60, docker_client.START_EVENT_TIMEOUT
+        try:
+            self.client.run_container('abcd', labels={})
+            assert self.lib_client.started == ['abcd']
+            self.lib_client.status = 'exited'
+            with pytest.raises(ContainerStartException):
+                self.client.run_container('abcd', labels={})
+        finally:
+            docker_client.START_EVENT_TIMEOUT = timeout
+
+
+    def test_run_container_stream_closed(self):
+        self.lib_client.stream.close()
+        self.client.run_container('abcd')
+        assert self.lib_client.started == ['abcd']
+
+
+    def test_wait_until_healthy(self):
+        self.lib_client.stream.push(event('start', 'appserver-testing-1234'))
+        self.lib_client.stream.push(event('health_status: unhealthy', 'appserver-testing-1234'))
+        assert not self.client.wait_until_healthy('appserver-testing-1234', 1)
+        self.lib_client.stream.push(event('health_status: healthy', 'appserver-testing-1234'))
+        self.lib_client.stream.push(event('start', 'db-testing-1234', container_id='efgh'))
+        self.lib_client.stream.push(event('health_status: healthy', 'db-testing-1234',
+                                          container_id='efgh'))
+        assert self.client.wait_until_healthy('efgh', 1)
+
+
+    def test_wait_until_healthy_inspects(self):
+        self.lib_client.health = {'Status': 'healthy'}
+        assert self.client.wait_until_healthy('appserver-testing-1234', 1)
+        self.lib_client.health = None
+        with pytest.raises(docker_client.DockerException) as exc_info:
+            self.client.wait_until_healthy('appserver-testing-1234', 60)
+        assert "does not have a health check" in str(exc_info.value)
+
+
+    def test_wait_until_healthy_stream_closed(self):
+        self.lib_client.stream.close()
+        assert not self.client.wait_until_healthy('appserver-testing-1234', 1)
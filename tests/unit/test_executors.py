@@ -0,0 +1,96 @@
+import time
+import threading
+import unittest
+
+import attr
+import pytest
+
+from miniboss.executors import (AgentExecutor,
+                                ThreadPerAgentExecutor,
+                                PoolExecutor,
+                                get_executor)
+
+from common import DEFAULT_OPTIONS
+
+class ExecutorTests(unittest.TestCase):
+
+    def test_get_executor(self):
+        executor = get_executor(DEFAULT_OPTIONS)
+        assert isinstance(executor, ThreadPerAgentExecutor)
+        executor = get_executor(attr.evolve(DEFAULT_OPTIONS, parallelism=3))
+        assert isinstance(executor, PoolExecutor)
+        assert executor.pool._max_workers == 3
+
+
+    def test_thread_per_agent_runs_all_at_once(self):
+        executor = ThreadPerAgentExecutor()
+        barrier = threading.Barrier(5, timeout=1)
+        for _ in range(5):
+            executor.submit(barrier.wait)
+        executor.shutdown()
+        assert not barrier.broken
+
+
+    def test_pool_executor_bounded(self):
+        executor = PoolExecutor(2)
+        lock = threading.Lock()
+        running = 0
+        max_running = 0
+        def work():
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(running, max_running)
+            time.sleep(0.02)
+            with lock:
+                running -= 1
+        for _ in range(6):
+            executor.submit(work)
+        executor.shutdown()
+        assert max_running == 2
+
+
+    def test_slot_limits(self):
+        executor = ThreadPerAgentExecutor(image_parallelism=1)
+        lock = threading.Lock()
+        running = 0
+        max_running = 0
+        def work():
+            nonlocal running, max_running
+            with executor.image_slot:
+                with lock:
+                    running += 1
+                    max_running = max(running, max_running)
+                time.sleep(0.02)
+                with lock:
+                    running -= 1
+        for _ in range(4):
+            executor.submit(work)
+        executor.shutdown()
+        assert max_running == 1
+        # Container starts are not limited
+        with executor.container_slot:
+            with executor.container_slot:
+                pass
+
+
+    def test_pool_executor_logs_errors(self):
+        executor = PoolExecutor(1)
+        def crash():
+            raise ValueError("Crashed")
+        executor.reserve()
+        with self.assertLogs('miniboss.executors', level='ERROR') as logs:
+            executor.submit(crash)
+            executor.shutdown()
+        assert "Error running service agent" in logs.output[0]
+        # The capacity was released despite the error
+        assert executor.capacity.acquire(blocking=False)
+
+
+    def test_parallelism_at_least_one(self):
+        with pytest.raises(ValueError):
+            attr.evolve(DEFAULT_OPTIONS, parallelism=0)
+        with pytest.raises(ValueError):
+            attr.evolve(DEFAULT_OPTIONS, image_parallelism=-1)
+        with pytest.raises(TypeError):
+            AgentExecutor()
@@ -0,0 +1,223 @@
+import os
+import tempfile
+import time
+import unittest
+from collections import Counter
+from types import SimpleNamespace as Bunch
+
+import pytest
+
+from miniboss import services, service_agent, async_engine, types
+from miniboss.api_ledger import ApiLedger
+from miniboss.docker_client import DockerClient
+from miniboss.exceptions import ContainerStartException, DockerException
+from miniboss.services import Service, ServiceCollection
+from miniboss.types import Options, Network, Engine
+
+from tests.fake_engine import FakeEngine
+
+
+def _service(**kwargs):
+    fields = {'name': 'db', 'image': 'postgres:12', 'env': {}, 'ports': {}, 'volumes': [],
+              'stop_signal': 'SIGTERM', 'healthcheck': None}
+    fields.update(kwargs)
+    return Bunch(volume_def_to_binds=lambda: [], **fields)
+
+
+class FakeEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeEngine().start()
+        self.lib_client = self.engine.client()
+        self.client = DockerClient(self.lib_client)
+        types.set_group_name('testing')
+        network = self.client.create_network('the-network')
+        self.network = Network(name='the-network', id=network.id)
+        self.client.watch_events('testing')
+        self.client.index_containers(self.network)
+
+    def tearDown(self):
+        self.client.stop_watching()
+        self.lib_client.close()
+        self.engine.stop()
+        types._unset_group_name()
+
+    def test_run_and_stop_container(self):
+        self.client.check_image('postgres:12')
+        container_name = self.client.run_service_on_network('db-testing', _service(),
+                                                            self.network)
+        containers = self.client.service_containers('db', self.network)
+        assert [container.name for container in containers] == [container_name]
+        assert containers[0].status == 'running'
+        containers[0].stop(timeout=1)
+        containers[0].remove()
+        assert self.engine.containers == {}
+        self.client.remove_network('the-network')
+        assert self.engine.networks == {}
+
+
+    def test_pull_only_missing_images(self):
+        self.engine.add_image('redis:6')
+        self.client.check_image('redis:6')
+        self.client.check_image('postgres:12')
+        assert self.engine.calls['POST /images/create'] == 1
+        assert self.client.image_exists('postgres:12')
+
+
+    def test_container_exits(self):
+        self.engine.exit_on_start('postgres:12', logs="Could not bind port")
+        self.client.check_image('postgres:12')
+        with pytest.raises(ContainerStartException, match="Could not bind port"):
+            self.client.run_service_on_network('db-testing', _service(), self.network)
+
+
+    def test_wait_until_healthy(self):
+        self.engine.health_delay = 0.2
+        self.client.check_image('postgres:12')
+        container_name = self.client.run_service_on_network(
+            'db-testing', _service(healthcheck={'test': ['CMD', 'true']}), self.network)
+        assert self.client.wait_until_healthy(container_name, 2)
+
+
+    def test_build_image(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'Dockerfile'), 'w', encoding='utf-8') as dockerfile:
+            dockerfile.write("FROM scratch")
+        self.client.build_image(directory, 'Dockerfile', 'built:1')
+        self.client.build_image(directory, 'Dockerfile', 'built:2', spool=True)
+        assert self.client.image_exists('built:1') and self.client.image_exists('built:2')
+        with pytest.raises(DockerException, match="Cannot locate specified Dockerfile"):
+            self.client.build_image(directory, 'Other.dockerfile', 'built:3')
+
+
+    def test_injected_failure(self):
+        self.engine.fail('POST /containers/create', status=500, message="No space left")
+        self.client.check_image('postgres:12')
+        with pytest.raises(Exception, match="No space left"):
+            self.client.run_service_on_network('db-testing', _service(), self.network)
+        self.client.run_service_on_network('db-testing', _service(), self.network)
+
+
+    def test_latency(self):
+        self.engine.latencies['GET /images/{name}/json'] = 0.2
+        start = time.monotonic()
+        self.client.image_exists('postgres:12')
+        assert time.monotonic() - start >= 0.2
+
+
+class RoundTripTests(unittest.TestCase):
+    """Full runs against the fake engine, checking the number of API calls, so
+    that redundant ones are noticed"""
+
+    def setUp(self):
+        self.engine = FakeEngine().start()
+        self.lib_client = self.engine.client()
+        self.client = client = DockerClient(self.lib_client)
+        self.holder = Bunch(get_client=lambda: client)
+        services.DockerClient = self.holder
+        service_agent.DockerClient = self.holder
+        async_engine.DockerClient = self.holder
+        types.set_group_name('testing')
+
+    def tearDown(self):
+        self.lib_client.close()
+        self.engine.stop()
+        types._unset_group_name()
+
+    def _collection(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class Database(NewServiceBase):
+            name = "database"
+            image = "postgres:12"
+        class Cache(NewServiceBase):
+            name = "cache"
+            image = "redis:6"
+        class App(NewServiceBase):
+            name = "app"
+            image = "app:1"
+            dependencies = ["database", "cache"]
+        collection.load_definitions()
+        return collection
+
+    def _options(self, engine=Engine.THREADS, remove=False):
+        return Options(network=Network(name='the-network', id=''), timeout=1, remove=remove,
+                       run_dir='/etc', build=[], engine=engine)
+
+    def _start(self, engine):
+        assert self._collection().start_all(self._options(engine)) == ['database', 'cache',
+                                                                       'app']
+        # The containers are listed once for all services, and not inspected
+        # thanks to the events stream
+        assert self.engine.calls == {'GET /networks': 1,
+                                     'POST /networks/create': 1,
+                                     'GET /networks/{id}': 1,
+                                     'GET /events': 1,
+                                     'GET /containers/json': 1,
+                                     'GET /images/{name}/json': 6,
+                                     'POST /images/create': 3,
+                                     'POST /containers/create': 3,
+                                     'POST /containers/{id}/start': 3}
+        self.engine.reset_calls()
+        # Started again, the running containers are reused, without checking
+        # their images
+        self._collection().start_all(self._options(engine))
+        assert self.engine.calls == {'GET /networks': 1,
+                                     'GET /events': 1,
+                                     'GET /containers/json': 1}
+        self.engine.reset_calls()
+        self._collection().stop_all(self._options(engine, remove=True))
+        assert self.engine.calls == {'GET /containers/json': 1,
+                                     'POST /containers/{id}/stop': 3,
+                                     'DELETE /containers/{id}': 3,
+                                     'GET /networks': 1,
+                                     'DELETE /networks/{id}': 1}
+        assert self.engine.containers == {}
+
+    def test_start_stop_threads(self):
+        self._start(Engine.THREADS)
+
+    def test_start_stop_asyncio(self):
+        self._start(Engine.ASYNCIO)
+
+    def _ledger(self, engine):
+        ledger = ApiLedger()
+        self.client.attach_ledger(ledger)
+        try:
+            self._collection().start_all(self._options(engine))
+            self._collection().stop_all(self._options(engine, remove=True))
+        finally:
+            self.client.detach_ledger(ledger)
+        # Every call the engine received is in the ledger, including the ones
+        # made through the container objects of the library
+        assert Counter(call.endpoint for call in ledger.calls) == self.engine.calls
+        attributed = {(call.endpoint, call.service) for call in ledger.calls
+                      if call.endpoint.startswith(('POST /containers', 'DELETE /containers'))}
+        assert attributed == {(endpoint, service)
+                              for endpoint in ['POST /containers/create',
+                                               'POST /containers/{id}/start',
+                                               'POST /containers/{id}/stop',
+                                               'DELETE /containers/{id}']
+                              for service in ['database', 'cache', 'app']}
+
+    def test_ledger_threads(self):
+        self._ledger(Engine.THREADS)
+
+    def test_ledger_asyncio(self):
+        self._ledger(Engine.ASYNCIO)
+
+
+    def test_failed_start(self):
+        self.engine.exit_on_start('redis:6', logs="Out of memory")
+        collection = self._collection()
+        assert collection.start_all(self._options()) == ['database']
+        assert [service.name for service in collection.running_context.failed_services] == [
+            'cache', 'app']
+        # The container of the app that was created in advance is removed,
+        # together with the one that exited
+        assert [container['Name'] for container in self.engine.containers.values()] == [
+            '/' + collection.running_context.agents[collection.all_by_name['database']]
+            .container_name]
@@ -0,0 +1,90 @@
+import unittest
+
+import pytest
+
+from miniboss.graph import ServiceGraph
+from miniboss.services import connect_services
+from miniboss.exceptions import ServiceLoadError
+
+from common import FakeService
+
+
+def names(services):
+    return [service.name for service in services]
+
+
+class ServiceGraphTests(unittest.TestCase):
+
+    def setUp(self):
+        # a diamond: app depends on api and worker, which both depend on db
+        self.services = connect_services([
+            FakeService(name='db'),
+            FakeService(name='api', dependencies=['db']),
+            FakeService(name='worker', dependencies=['db']),
+            FakeService(name='app', dependencies=['api', 'worker']),
+            FakeService(name='cache')])
+        self.graph = ServiceGraph(self.services.values())
+
+    def test_adjacency(self):
+        assert set(names(self.graph.dependencies[self.services['app']])) == {'api', 'worker'}
+        assert set(names(self.graph.dependants[self.services['db']])) == {'api', 'worker'}
+        assert len(self.graph) == 5
+
+    def test_ignore_services_not_in_graph(self):
+        graph = ServiceGraph([self.services['api'], self.services['app']])
+        assert names(graph.dependencies[self.services['api']]) == []
+        assert names(graph.dependencies[self.services['app']]) == ['api']
+
+    def test_transitive_dependants(self):
+        dependants = self.graph.transitive_dependants(self.services['db'])
+        assert names(dependants) == ['api', 'worker', 'app']
+        assert self.graph.transitive_dependants(self.services['app']) == []
+
+    def test_transitive_dependencies(self):
+        dependencies = self.graph.transitive_dependencies(self.services['app'])
+        assert set(names(dependencies)) == {'api', 'worker', 'db'}
+        assert names(dependencies)[-1] == 'db'
+
+    def test_layers(self):
+        layers = [set(names(layer)) for layer in self.graph.layers()]
+        assert layers == [{'db', 'cache'}, {'api', 'worker'}, {'app'}]
+
+    def test_no_cycles(self):
+        assert self.graph.cycles() == []
+        self.graph.check_acyclic()
+
+    def test_long_chain(self):
+        count = 5000
+        services = connect_services(
+            [FakeService(name='service0')] +
+            [FakeService(name='service{}'.format(i), dependencies=['service{}'.format(i - 1)])
+             for i in range(1, count)])
+        graph = ServiceGraph(services.values())
+        graph.check_acyclic()
+        assert len(graph.layers()) == count
+        assert len(graph.transitive_dependants(services['service0'])) == count - 1
+
+
+    def test_report_cycle(self):
+        services = connect_services([
+            FakeService(name='one', dependencies=['three']),
+            FakeService(name='two', dependencies=['one']),
+            FakeService(name='three', dependencies=['two']),
+            FakeService(name='four', dependencies=['one'])])
+        graph = ServiceGraph(services.values())
+        cycles = graph.cycles()
+        assert len(cycles) == 1
+        cycle = names(cycles[0])
+        assert cycle[0] == cycle[-1]
+        assert set(cycle) == {'one', 'two', 'three'}
+        with pytest.raises(ServiceLoadError) as exc_info:
+            graph.check_acyclic()
+        assert "one" in str(exc_info.value)
+        assert "four" not in str(exc_info.value)
+        with pytest.raises(ServiceLoadError):
+            graph.layers()
+
+    def test_report_self_dependency(self):
+        services = connect_services([FakeService(name='one', dependencies=['one'])])
+        graph = ServiceGraph(services.values())
+        assert names(graph.cycles()[0]) == ['one', 'one']
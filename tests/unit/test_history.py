@@ -0,0 +1,77 @@
+import os
+import json
+import unittest
+import tempfile
+
+from miniboss.history import StartHistory, DEFAULT_DURATION
+from miniboss.services import connect_services
+from miniboss.types import RunCondition
+
+from common import FakeService
+
+class StartHistoryTests(unittest.TestCase):
+
+    def test_record(self):
+        history = StartHistory()
+        run_condition = RunCondition()
+        run_condition.durations = {RunCondition.PULL: 2.0, RunCondition.PING: 1.5}
+        run_condition.pinged()
+        history.record('service1', run_condition)
+        assert history.duration('service1') == 3.5
+        assert history.duration('service2') == DEFAULT_DURATION
+
+
+    def test_dont_record_failed_or_already_running(self):
+        history = StartHistory({'service1': {'ping': 5}})
+        failed = RunCondition()
+        failed.durations = {RunCondition.PING: 10}
+        failed.fail()
+        history.record('service1', failed)
+        already_running = RunCondition()
+        already_running.already_running()
+        history.record('service1', already_running)
+        assert history.durations == {'service1': {'ping': 5}}
+
+
+    def test_save_to_load_from(self):
+        directory = tempfile.mkdtemp()
+        StartHistory({'service1': {'ping': 5}}).save_to(directory)
+        with open(os.path.join(directory, ".miniboss-history")) as history_file:
+            assert json.load(history_file) == {'service1': {'ping': 5}}
+        history = StartHistory.load_from(directory)
+        assert history.duration('service1') == 5
+
+
+    def test_load_from_missing_or_invalid(self):
+        assert StartHistory.load_from("/not/existing/directory/blahakshdakusdhau").durations == {}
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, ".miniboss-history"), "w") as history_file:
+            history_file.write("not json")
+        assert StartHistory.load_from(directory).durations == {}
+
+
+    def test_critical_paths(self):
+        services = connect_services([FakeService(name='kafka'),
+                                     FakeService(name='registry', dependencies=['kafka']),
+                                     FakeService(name='app', dependencies=['registry', 'db']),
+                                     FakeService(name='db'),
+                                     FakeService(name='cache')])
+        history = StartHistory({'kafka': {'ping': 30},
+                                'registry': {'ping': 10},
+                                'app': {'post-start': 5},
+                                'db': {'ping': 8},
+                                'cache': {'pull': 12}})
+        paths = history.critical_paths(services.values())
+        assert paths[services['app']] == 5
+        assert paths[services['registry']] == 15
+        assert paths[services['kafka']] == 45
+        assert paths[services['db']] == 13
+        assert paths[services['cache']] == 12
+
+
+    def test_critical_paths_ignore_excluded_dependants(self):
+        services = connect_services([FakeService(name='service1'),
+                                     FakeService(name='service2', dependencies=['service1'])])
+        history = StartHistory({'service1': {'ping': 1}, 'service2': {'ping': 10}})
+        paths = history.critical_paths([services['service1']])
+        assert paths == {services['service1']: 1}
@@ -0,0 +1,76 @@
+import unittest
+from types import SimpleNamespace as Bunch
+
+from miniboss.plan import Plan, gating_path
+from miniboss.services import connect_services
+from miniboss.types import RunCondition
+
+from common import FakeService
+
+
+def names(services):
+    return [service.name for service in services]
+
+
+class PlanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.services = connect_services([
+            FakeService(name='db'),
+            FakeService(name='api', dependencies=['db']),
+            FakeService(name='worker', dependencies=['db']),
+            FakeService(name='app', dependencies=['api', 'worker']),
+            FakeService(name='cache')])
+        durations = {'db': 5, 'api': 3, 'worker': 1, 'app': 2, 'cache': 4}
+        self.plan = Plan(self.services.values(),
+                         {service: durations[service.name]
+                          for service in self.services.values()})
+
+    def test_waves(self):
+        assert [names(wave) for wave in self.plan.waves] == [['db', 'cache'],
+                                                             ['api', 'worker'],
+                                                             ['app']]
+
+
+    def test_critical_path_and_slack(self):
+        assert self.plan.wall_time == 10
+        assert names(self.plan.critical_path()) == ['db', 'api', 'app']
+        assert self.plan.slack(self.services['api']) == 0
+        assert self.plan.slack(self.services['worker']) == 2
+        assert self.plan.slack(self.services['cache']) == 6
+        assert names(self.plan.most_slack()) == ['cache', 'worker']
+
+
+    def test_wall_time_with_parallelism(self):
+        assert self.plan.minimum_wall_time() == 10
+        assert self.plan.minimum_wall_time(1) == 15
+        assert self.plan.scheduled_wall_time() == 10
+        assert self.plan.scheduled_wall_time(1) == 15
+        # db, api and app come first as they are on the critical path; cache
+        # delays app only if it is started before api
+        assert self.plan.scheduled_wall_time(2) == 10
+
+
+    def test_describe(self):
+        lines = self.plan.describe(parallelism=2)
+        assert lines == ["Wave 1: db, cache",
+                         "Wave 2: api, worker",
+                         "Wave 3: app",
+                         "Expected critical path (10.0s): db -> api -> app",
+                         "Most slack: cache (6.0s), worker (2.0s)",
+                         "Minimum wall time with parallelism 2: 10.0s, 10.0s as scheduled"]
+        assert self.plan.describe(timed=False)[3:] == [
+            "No recorded timings; start the services to record them"]
+
+
+    def test_gating_path(self):
+        finished = {'db': 5, 'api': 8, 'worker': 6, 'app': 11, 'cache': 4}
+        ready = {'db': 0, 'api': 5, 'worker': 5, 'app': 8, 'cache': 0}
+        agents = {}
+        for service in self.services.values():
+            run_condition = RunCondition()
+            run_condition.ready_at = ready[service.name]
+            run_condition.finished_at = finished[service.name]
+            agents[service] = Bunch(run_condition=run_condition)
+        assert names(gating_path(agents)) == ['db', 'api', 'app']
+        assert gating_path({}) == []
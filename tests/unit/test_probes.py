@@ -0,0 +1,237 @@
+import socket
+import threading
+import time
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace as Bunch
+
+import pytest
+
+from miniboss import api_ledger, probes
+from miniboss.probes import (ProbeLoop,
+                             TcpProbe,
+                             HttpProbe,
+                             ExecProbe,
+                             Backoff,
+                             published_address)
+from miniboss.services import Service, ServiceDefinitionError
+
+FAST = Backoff(initial=0.01, maximum=0.05)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200 if self.path == '/health' else 503)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class BackoffTests(unittest.TestCase):
+
+    def test_delays(self):
+        delays = Backoff(initial=1, maximum=5, factor=2, jitter=0).delays()
+        assert [next(delays) for _ in range(5)] == [1, 2, 4, 5, 5]
+
+    def test_jitter(self):
+        delays = Backoff(initial=1, maximum=1, jitter=0.5).delays()
+        for _ in range(20):
+            assert 0.5 <= next(delays) <= 1.5
+
+
+class ProbeLoopTests(unittest.TestCase):
+
+    def test_tcp_probe(self):
+        port = free_port()
+        service = Bunch(name='service1', ports={5432: port})
+        listener = socket.socket()
+        listener.bind(('localhost', port))
+        listener.listen()
+        try:
+            assert ProbeLoop.get().check(TcpProbe(5432, backoff=FAST), service, None, 1)
+        finally:
+            listener.close()
+
+    def test_tcp_probe_waits_until_listening(self):
+        port = free_port()
+        service = Bunch(name='service1', ports={})
+        listener = socket.socket()
+        def listen_later():
+            time.sleep(0.1)
+            listener.bind(('localhost', port))
+            listener.listen()
+        thread = threading.Thread(target=listen_later)
+        thread.start()
+        try:
+            start = time.monotonic()
+            assert ProbeLoop.get().check(TcpProbe(port, backoff=FAST), service, None, 2)
+            assert time.monotonic() - start < 1
+        finally:
+            thread.join()
+            listener.close()
+
+    def test_tcp_probe_timeout(self):
+        service = Bunch(name='service1', ports={})
+        start = time.monotonic()
+        assert not ProbeLoop.get().check(TcpProbe(free_port(), backoff=FAST), service, None, 0.2)
+        assert time.monotonic() - start < 1
+
+    def test_tcp_probe_connection_closed(self):
+        # Like docker-proxy when nothing listens in the container, the
+        # connection is accepted and closed right away
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        closing = True
+        def accept_and_close():
+            while closing:
+                try:
+                    connection, _ = listener.accept()
+                except OSError:
+                    return
+                connection.close()
+        thread = threading.Thread(target=accept_and_close)
+        thread.start()
+        service = Bunch(name='service1', ports={})
+        try:
+            assert not ProbeLoop.get().check(TcpProbe(port, backoff=FAST), service, None, 0.5)
+        finally:
+            closing = False
+            listener.shutdown(socket.SHUT_RDWR)
+            listener.close()
+            thread.join()
+
+    def test_unresolvable_host(self):
+        service = Bunch(name='service1', ports={})
+        probe = TcpProbe(5432, host="no-such-host.invalid", backoff=FAST)
+        start = time.monotonic()
+        assert not ProbeLoop.get().check(probe, service, None, 0.2)
+        assert time.monotonic() - start < 1
+        # The loop is still working
+        self.test_tcp_probe()
+
+    def test_error_in_callback(self):
+        service = Bunch(name='service1', ports={})
+        def callback(success):
+            raise ValueError("Bad callback")
+        ProbeLoop.get().submit(TcpProbe(free_port(), backoff=FAST), service, None, 0.1, callback)
+        time.sleep(0.2)
+        self.test_tcp_probe()
+
+    def test_published_address(self):
+        assert published_address("localhost", 80, {}) == ("localhost", 80)
+        assert published_address("localhost", 80, {80: 8080}) == ("localhost", 8080)
+        assert published_address("localhost", 80, {80: ('127.0.0.1', 8080)}) == \
+            ("127.0.0.1", 8080)
+        assert published_address("localhost", 80, {80: ('0.0.0.0', 8080)}) == \
+            ("localhost", 8080)
+        assert published_address("localhost", 80, {80: [8080, 8081]}) == ("localhost", 8080)
+        assert published_address("localhost", 80, {80: ('127.0.0.1',)}) == ("localhost", 80)
+
+    def test_http_probe(self):
+        server = HTTPServer(('localhost', 0), HealthHandler)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        service = Bunch(name='service1', ports={80: port})
+        try:
+            loop = ProbeLoop.get()
+            assert loop.check(HttpProbe("/health", backoff=FAST), service, None, 1)
+            assert not loop.check(HttpProbe("/other", backoff=FAST), service, None, 0.2)
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    def test_many_probes_at_once(self):
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(256)
+        port = listener.getsockname()[1]
+        service = Bunch(name='service1', ports={})
+        results = []
+        finished = threading.Event()
+        def callback(success):
+            results.append(success)
+            if len(results) == 100:
+                finished.set()
+        try:
+            for _ in range(100):
+                ProbeLoop.get().submit(TcpProbe(port, backoff=FAST), service, None, 2, callback)
+            assert finished.wait(3)
+            assert all(results)
+        finally:
+            listener.close()
+
+    def test_exec_probe(self):
+        class FakeClient:
+            calls = []
+            def exec_in_container(self, container_name, command):
+                self.calls.append((container_name, command))
+                return 0 if len(self.calls) > 2 else 1
+        client = FakeClient()
+        probes.DockerClient = Bunch(get_client=lambda: client)
+        service = Bunch(name='service1', ports={})
+        probe = ExecProbe(["pg_isready"], backoff=FAST)
+        assert ProbeLoop.get().check(probe, service, 'service1-testing-1234', 1)
+        assert client.calls[0] == ('service1-testing-1234', ['pg_isready'])
+        assert len(client.calls) == 3
+
+    def test_exec_probe_attributed(self):
+        services = []
+        class FakeClient:
+            def exec_in_container(self, container_name, command):
+                services.append(api_ledger._current_service.get())
+                return 0
+        probes.DockerClient = Bunch(get_client=FakeClient)
+        service = Bunch(name='service1', ports={})
+        probe = ExecProbe(["pg_isready"], backoff=FAST)
+        with api_ledger.attributed_to('service1'):
+            assert ProbeLoop.get().check(probe, service, 'service1-testing-1234', 1)
+        assert services == ['service1']
+
+    def test_exec_probe_blocks(self):
+        unblock = threading.Event()
+        class FakeClient:
+            def exec_in_container(self, container_name, command):
+                unblock.wait(5)
+                return 0
+        probes.DockerClient = Bunch(get_client=FakeClient)
+        service = Bunch(name='service1', ports={})
+        class QuickExecProbe(ExecProbe):
+            attempt_timeout = 0.1
+        probe = QuickExecProbe(["pg_isready"], backoff=FAST)
+        start = time.monotonic()
+        try:
+            assert not ProbeLoop.get().check(probe, service, 'service1-testing-1234', 0.3)
+            assert time.monotonic() - start < 1
+        finally:
+            unblock.set()
+
+
+class ReadinessFieldTests(unittest.TestCase):
+
+    def test_invalid_readiness(self):
+        with pytest.raises(ServiceDefinitionError):
+            class NewService(Service):
+                name = "yes"
+                image = "yes"
+                readiness = "not a probe"
+
+    def test_valid_readiness(self):
+        class NewService(Service):
+            name = "yes"
+            image = "yes"
+            readiness = HttpProbe("/health", port=8080)
+        assert NewService().readiness.port == 8080
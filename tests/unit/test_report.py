@@ -0,0 +1,77 @@
+import os
+import json
+import unittest
+import tempfile
+from types import SimpleNamespace as Bunch
+
+from miniboss.report import run_report, write_report
+from miniboss.types import RunCondition
+
+from miniboss.services import connect_services
+
+from common import FakeService
+
+class RunReportTests(unittest.TestCase):
+
+    def test_phases_and_queue_wait(self):
+        run_condition = RunCondition()
+        with run_condition.timed(RunCondition.PULL):
+            pass
+        with run_condition.timed(RunCondition.PING):
+            pass
+        with run_condition.timed(RunCondition.PING):
+            pass
+        assert [phase for phase, _, _ in run_condition.phases] == ['pull', 'ping', 'ping']
+        assert all(start <= end for _, start, end in run_condition.phases)
+        assert run_condition.queue_wait is None
+        run_condition.ready_at = 10.0
+        run_condition.ready()
+        assert run_condition.ready_at == 10.0
+        run_condition.dispatched_at = 12.5
+        assert run_condition.queue_wait == 2.5
+        not_queued = RunCondition()
+        not_queued.dispatched()
+        assert not_queued.queue_wait == 0
+
+
+    def test_report(self):
+        run_condition = RunCondition()
+        run_condition.pinged()
+        run_condition.durations = {'pull': 2.0, 'ping': 1.0}
+        run_condition.phases = [('pull', 101.0, 103.0), ('ping', 103.0, 104.0)]
+        run_condition.ready_at = 100.5
+        run_condition.dispatched_at = 101.0
+        run_condition.finished_at = 104.0
+        agents = {FakeService(name='service1'): Bunch(run_condition=run_condition),
+                  FakeService(name='service2'): Bunch(run_condition=RunCondition())}
+        report = run_report(agents, 100.0, 105.0)
+        assert report['wall_time'] == 5.0
+        assert report['services']['service1'] == {
+            'state': 'running',
+            'phases': {'pull': 2.0, 'ping': 1.0},
+            'timeline': [{'phase': 'pull', 'start': 1.0, 'end': 3.0},
+                         {'phase': 'ping', 'start': 3.0, 'end': 4.0}],
+            'ready': 0.5,
+            'dispatched': 1.0,
+            'finished': 4.0,
+            'queue_wait': 0.5,
+            'gated_by': None}
+        assert report['services']['service2']['dispatched'] is None
+        assert report['services']['service2']['gated_by'] is None
+
+
+    def test_gated_by(self):
+        services = connect_services([FakeService(name='db'),
+                                     FakeService(name='cache'),
+                                     FakeService(name='app', dependencies=['db', 'cache'])])
+        agents = {service: Bunch(run_condition=RunCondition()) for service in services.values()}
+        agents[services['db']].run_condition.finished_at = 3.0
+        agents[services['cache']].run_condition.finished_at = 5.0
+        agents[services['app']].run_condition.ready_at = 5.0
+        report = run_report(agents, 0.0, 10.0)
+        assert report['services']['app']['gated_by'] == 'cache'
+        assert report['services']['db']['gated_by'] is None
+        path = os.path.join(tempfile.mkdtemp(), 'timings.json')
+        write_report(path, report)
+        with open(path) as report_file:
+            assert json.load(report_file) == report
@@ -0,0 +1,61 @@
+import os
+import json
+import unittest
+import tempfile
+
+from miniboss.containers import LABEL_FINGERPRINT
+from miniboss.run_state import RunState
+from miniboss.types import RunCondition
+
+from common import FakeContainer
+
+def running():
+    run_condition = RunCondition()
+    run_condition.pinged()
+    return run_condition
+
+class RunStateTests(unittest.TestCase):
+
+    def test_save_to_load_from(self):
+        directory = tempfile.mkdtemp()
+        state = RunState()
+        state.record('service1', running(), 'service1-testing-1234', 'abcd')
+        state.save_to(directory)
+        assert os.listdir(directory) == ['.miniboss-run-state']
+        with open(os.path.join(directory, ".miniboss-run-state")) as state_file:
+            assert json.load(state_file) == {'service1': {'state': 'running',
+                                                          'container': 'service1-testing-1234',
+                                                          'fingerprint': 'abcd'}}
+        assert RunState.load_from(directory).services == state.services
+        RunState.remove_file(directory)
+        assert RunState.load_from(directory).services == {}
+
+
+    def test_load_from_invalid(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, ".miniboss-run-state"), "w") as state_file:
+            state_file.write('{"service1": {"state"')
+        assert RunState.load_from(directory).services == {}
+
+
+    def test_confirmed(self):
+        state = RunState()
+        state.record('service1', running(), 'service1-testing-1234', 'abcd')
+        failed = RunCondition()
+        failed.fail()
+        state.record('service2', failed, 'service2-testing-1234', 'abcd')
+        state.record('service3', running(), 'service3-testing-1234', None)
+        container = FakeContainer(name='service1-testing-1234', status='running',
+                                  labels={LABEL_FINGERPRINT: 'abcd'})
+        assert state.confirmed('service1', [container])
+        assert not state.confirmed('service1', [])
+        container.labels = {LABEL_FINGERPRINT: 'efgh'}
+        assert not state.confirmed('service1', [container])
+        container.labels = {LABEL_FINGERPRINT: 'abcd'}
+        container.status = 'exited'
+        assert not state.confirmed('service1', [container])
+        assert not state.confirmed('service2', [FakeContainer(name='service2-testing-1234',
+                                                              status='running')])
+        assert state.confirmed('service3', [FakeContainer(name='service3-testing-1234',
+                                                          status='running')])
+        assert not state.confirmed('service4', [])
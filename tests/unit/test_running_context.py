@@ -23,6 +23,35 @@ class RunningContextTests(unittest.TestCase):
         assert context.agent_set[services['service2']].can_start
 
 
+    def test_service_progressed(self):
+        services = connect_services([FakeService(name='service1', dependencies=[]),
+                                     FakeService(name='service2', dependencies=['service1']),
+                                     FakeService(name='service3', dependencies=['service1'])])
+        services['service2'].wait_for = {'service1': 'pinged'}
+        context = RunningContext(services, DEFAULT_OPTIONS)
+        context.service_progressed(services['service1'], 'started')
+        assert context.ready_queue.empty()
+        context.service_progressed(services['service1'], 'pinged')
+        assert context.next_ready().service is services['service2']
+        assert not context.agent_set[services['service3']].can_start
+        context.service_started(services['service1'])
+        assert context.next_ready().service is services['service3']
+        assert context.ready_queue.empty()
+
+
+    def test_started_after_failed(self):
+        services = connect_services([FakeService(name='service1', dependencies=[]),
+                                     FakeService(name='service2', dependencies=['service1'])])
+        context = RunningContext(services, DEFAULT_OPTIONS)
+        # A dependant started before the dependency finished is registered as
+        # failed if the dependency fails
+        context.service_failed(services['service1'])
+        context.service_started(services['service2'])
+        context.service_failed(services['service2'])
+        assert context.processed_services == []
+        assert [x.name for x in context.failed_services] == ['service1', 'service2']
+
+
     def test_ready_to_start_and_stop(self):
         services = connect_services([FakeService(name='service1', dependencies=[]),
                                      FakeService(name='service2', dependencies=['service1'])])
@@ -101,6 +130,55 @@ class RunningContextTests(unittest.TestCase):
         context = RunningContext(services, DEFAULT_OPTIONS)
         context.service_failed(services['service1'])
         mock_lock = mock_threading.Lock.return_value
-        # This has to be 2 because service1 has a dependency, and it has to be
-        # locked as well
-        assert mock_lock.__enter__.call_count == 2
+        # The dependants of the failed service are registered as failed in the
+        # same critical section
+        assert mock_lock.__enter__.call_count == 1
+        assert len(context.failed_services) == 2
+
+
+    def test_service_started_queues_ready_dependant(self):
+        services = connect_services([FakeService(name='service1', dependencies=[]),
+                                     FakeService(name='service2', dependencies=['service1']),
+                                     FakeService(name='service3', dependencies=['service1',
+                                                                                'service2'])])
+        context = RunningContext(services, DEFAULT_OPTIONS)
+        assert context.ready_queue.empty()
+        context.service_started(services['service1'])
+        agent = context.next_ready()
+        assert agent.service is services['service2']
+        assert context.ready_queue.empty()
+        context.service_started(services['service2'])
+        assert context.next_ready().service is services['service3']
+
+
+    def test_service_stopped_queues_ready_dependency(self):
+        services = connect_services([FakeService(name='service1', dependencies=[]),
+                                     FakeService(name='service2', dependencies=['service1'])])
+        context = RunningContext(services, DEFAULT_OPTIONS)
+        context.service_stopped(services['service2'])
+        assert context.next_ready().service is services['service1']
+
+
+    def test_next_ready_none_when_finished(self):
+        services = connect_services([FakeService(name='service1', dependencies=[]),
+                                     FakeService(name='service2', dependencies=['service1'])])
+        context = RunningContext(services, DEFAULT_OPTIONS)
+        context.service_failed(services['service1'])
+        assert context.next_ready() is None
+        context = RunningContext(services, DEFAULT_OPTIONS)
+        context.service_started(services['service1'])
+        context.service_started(services['service2'])
+        assert context.next_ready() is None
+
+
+    def test_ready_queue_priorities(self):
+        services = connect_services([FakeService(name='service1', dependencies=[]),
+                                     FakeService(name='service2', dependencies=[]),
+                                     FakeService(name='service3', dependencies=[])])
+        priorities = {services['service1']: 1,
+                      services['service2']: 10,
+                      services['service3']: 5}
+        context = RunningContext(services, DEFAULT_OPTIONS, priorities)
+        context.queue_ready(context.ready_to_start)
+        order = [context.next_ready().service.name for _ in range(3)]
+        assert order == ['service2', 'service3', 'service1']
@@ -1,19 +1,27 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
+from concurrent.futures import Future
 from unittest.mock import patch
 from types import SimpleNamespace as Bunch
-from datetime import datetime
 
 import attr
 import pytest
 
 from miniboss import types
 from miniboss import service_agent, context
+from miniboss.build_context import context_digest
+from miniboss.containers import LABEL_FINGERPRINT
 from miniboss.services import connect_services
 from miniboss.service_agent import (ServiceAgent,
                                     AgentStatus,
                                     Actions,
                                     ServiceAgentException)
 from miniboss.types import Options, Network, RunCondition
+from miniboss.probes import TcpProbe, Backoff
 
 from common import FakeDocker, FakeService, FakeRunningContext, FakeContainer, DEFAULT_OPTIONS
 
@@ -24,14 +32,18 @@ class ServiceAgentTests(unittest.TestCase):
         self.docker = FakeDocker.Instance = FakeDocker({'the-network': 'the-network-id'})
         service_agent.DockerClient = self.docker
         types.set_group_name('testing')
+        self.build_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.build_dir, 'Dockerfile'), 'w') as dockerfile:
+            dockerfile.write("FROM scratch\n")
 
     def tearDown(self):
         types._unset_group_name()
+        shutil.rmtree(self.build_dir)
 
     def test_can_start(self):
         services = connect_services([Bunch(name='service1', dependencies=[]),
                                      Bunch(name='service2', dependencies=['service1'])])
-        agent = ServiceAgent(services['service2'], DEFAULT_OPTIONS, None)
+        agent = ServiceAgent(services['service2'], DEFAULT_OPTIONS, FakeRunningContext())
         assert agent.can_start is False
         agent.process_service_started(services['service1'])
         assert agent.can_start is True
@@ -41,7 +53,7 @@ class ServiceAgentTests(unittest.TestCase):
     def test_can_stop(self):
         services = connect_services([Bunch(name='service1', dependencies=[]),
                                      Bunch(name='service2', dependencies=['service1'])])
-        agent = ServiceAgent(services['service1'], DEFAULT_OPTIONS, None)
+        agent = ServiceAgent(services['service1'], DEFAULT_OPTIONS, FakeRunningContext())
         assert agent.can_stop is False
         agent.process_service_stopped(services['service2'])
         assert agent.can_stop is True
@@ -49,7 +61,7 @@ class ServiceAgentTests(unittest.TestCase):
 
     def test_action_property(self):
         service = Bunch(name='service1', dependencies=[], dependants=[])
-        agent = ServiceAgent(service, DEFAULT_OPTIONS, None)
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
         assert agent.action is None
         with pytest.raises(ServiceAgentException):
             agent.action = 'blah'
@@ -66,7 +78,7 @@ class ServiceAgentTests(unittest.TestCase):
         assert fake_context.failed_services[0] is service
 
     def test_run_image(self):
-        agent = ServiceAgent(FakeService(), DEFAULT_OPTIONS, None)
+        agent = ServiceAgent(FakeService(), DEFAULT_OPTIONS, FakeRunningContext())
         agent.run_image()
         assert len(self.docker._services_started) == 1
         prefix, service, network = self.docker._services_started[0]
@@ -81,13 +93,30 @@ class ServiceAgentTests(unittest.TestCase):
         service.env = {'ENV_ONE': 'http://{host}:{port:d}'}
         context.Context['host'] = 'zombo.com'
         context.Context['port'] = 80
-        agent = ServiceAgent(service, DEFAULT_OPTIONS, None)
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
         agent.run_image()
         assert len(self.docker._services_started) == 1
         _, service, _ = self.docker._services_started[0]
         assert service.env['ENV_ONE'] == 'http://zombo.com:80'
 
 
+    def test_precreate_extrapolates_escaped_braces(self):
+        service = FakeService()
+        service.env = {'CONFIG': '{{"debug": true}}'}
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        precreation = Future()
+        precreation.set_result(agent.precreate())
+        agent.precreation = precreation
+        agent.run_image()
+        _, created, _ = self.docker._services_started[0]
+        assert created.env['CONFIG'] == '{"debug": true}'
+        # The fingerprint is the same as that of a container created on start
+        other = FakeService()
+        other.env = {'CONFIG': '{{"debug": true}}'}
+        ServiceAgent(other, DEFAULT_OPTIONS, FakeRunningContext()).run_image()
+        assert self.docker._fingerprints[0] == self.docker._fingerprints[1]
+        assert self.docker._fingerprints[0] == self.docker.fingerprint(created)
+
     def test_agent_status_change_happy_path(self):
         class ServiceAgentTestSubclass(ServiceAgent):
             def ping(self):
@@ -98,7 +127,7 @@ class ServiceAgentTests(unittest.TestCase):
                                          FakeRunningContext())
         assert agent.status == 'null'
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert agent.status == 'started'
 
 
@@ -110,27 +139,100 @@ class ServiceAgentTests(unittest.TestCase):
         agent = ServiceAgentTestSubclass(FakeService(), DEFAULT_OPTIONS, FakeRunningContext())
         assert agent.status == 'null'
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert agent.status == 'failed'
 
 
     def test_skip_if_running_on_same_network(self):
         service = FakeService()
-        agent = ServiceAgent(service, DEFAULT_OPTIONS, None)
-        self.docker._existing_containers = [Bunch(status='running',
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        self.docker._existing_containers = [FakeContainer(status='running',
                                                   name="{}-testing-123".format(service.name),
                                                   network='the-network')]
         agent.run_image()
         assert len(self.docker._services_started) == 0
         assert len(self.docker._existing_queried) == 1
-        assert self.docker._existing_queried[0] == ("service1-testing",
+        assert self.docker._existing_queried[0] == ("service1",
                                                     Network(name="the-network", id="the-network-id"))
 
 
+    def test_snapshot_and_restore(self):
+        class SeedingService(FakeService):
+            snapshot = True
+            def post_start(self):
+                super().post_start()
+                context.Context['seeded_by'] = self.name
+        run_dir = tempfile.mkdtemp()
+        options = attr.evolve(DEFAULT_OPTIONS, run_dir=run_dir)
+        try:
+            fake_service = SeedingService()
+            agent = ServiceAgent(fake_service, options, FakeRunningContext())
+            agent.start_service()
+            agent.executor.shutdown()
+            assert agent.status == AgentStatus.STARTED
+            assert fake_service.init_called
+            assert len(self.docker._committed) == 1
+            snapshot_image = self.docker._committed[0][1]
+            # A new container is restored from the snapshot without running the hooks
+            context.Context.pop('seeded_by')
+            restored_service = SeedingService()
+            agent = ServiceAgent(restored_service, options, FakeRunningContext())
+            agent.start_service()
+            agent.executor.shutdown()
+            assert agent.status == AgentStatus.STARTED
+            assert not restored_service.pre_start_called
+            assert not restored_service.init_called
+            assert context.Context['seeded_by'] == 'service1'
+            assert self.docker._created_images == [snapshot_image]
+            assert self.docker._imported == [('service1-testing-id', '/data',
+                                              b'contents of /data')]
+            assert self.docker._containers_ran == ['service1-testing-id']
+            assert len(self.docker._committed) == 1
+        finally:
+            shutil.rmtree(run_dir)
+
+
+    def test_snapshot_only_own_context_values(self):
+        class SeedingService(FakeService):
+            snapshot = True
+            def post_start(self):
+                super().post_start()
+                context.Context['seeded_by'] = self.name
+                # Set by another service while the hook is running
+                other = threading.Thread(target=context.Context.__setitem__,
+                                         args=('other_key', 'other'))
+                other.start()
+                other.join()
+        run_dir = tempfile.mkdtemp()
+        options = attr.evolve(DEFAULT_OPTIONS, run_dir=run_dir)
+        try:
+            agent = ServiceAgent(SeedingService(), options, FakeRunningContext())
+            agent.start_service()
+            agent.executor.shutdown()
+            context.Context.pop('seeded_by')
+            context.Context.pop('other_key')
+            agent = ServiceAgent(SeedingService(), options, FakeRunningContext())
+            agent.start_service()
+            agent.executor.shutdown()
+            assert context.Context['seeded_by'] == 'service1'
+            assert 'other_key' not in context.Context
+        finally:
+            shutil.rmtree(run_dir)
+
+
+    def test_no_snapshot_by_default(self):
+        fake_service = FakeService()
+        agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, FakeRunningContext())
+        agent.start_service()
+        agent.executor.shutdown()
+        assert fake_service.init_called
+        assert self.docker._committed == []
+
+
     def test_start_old_container_if_exists(self):
         service = FakeService()
-        agent = ServiceAgent(service, DEFAULT_OPTIONS, None)
-        self.docker._existing_containers = [Bunch(status='exited',
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        self.docker._existing_containers = [FakeContainer(status='exited',
                                                   network='the-network',
                                                   id='longass-container-id',
                                                   image=Bunch(tags=[service.image]),
@@ -143,8 +245,8 @@ class ServiceAgentTests(unittest.TestCase):
 
     def test_start_new_container_if_old_has_different_tag(self):
         service = FakeService()
-        agent = ServiceAgent(service, DEFAULT_OPTIONS, None)
-        self.docker._existing_containers = [Bunch(status='exited',
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        self.docker._existing_containers = [FakeContainer(status='exited',
                                                   network='the-network',
                                                   id='longass-container-id',
                                                   image=Bunch(tags=['different-tag']),
@@ -163,8 +265,8 @@ class ServiceAgentTests(unittest.TestCase):
     def test_start_new_container_if_differing_env_value(self):
         service = FakeService()
         service.env = {'KEY': 'some-value'}
-        agent = ServiceAgent(service, DEFAULT_OPTIONS, None)
-        self.docker._existing_containers = [Bunch(status='exited',
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        self.docker._existing_containers = [FakeContainer(status='exited',
                                                   network='the-network',
                                                   id='longass-container-id',
                                                   image=Bunch(tags=[service.image]),
@@ -183,8 +285,8 @@ class ServiceAgentTests(unittest.TestCase):
     def test_start_existing_if_differing_env_value_type_but_not_string(self):
         service = FakeService()
         service.env = {'KEY': 12345}
-        agent = ServiceAgent(service, DEFAULT_OPTIONS, None)
-        self.docker._existing_containers = [Bunch(status='exited',
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        self.docker._existing_containers = [FakeContainer(status='exited',
                                                   network='the-network',
                                                   id='longass-container-id',
                                                   image=Bunch(tags=[service.image]),
@@ -194,6 +296,67 @@ class ServiceAgentTests(unittest.TestCase):
         assert len(self.docker._services_started) == 0
 
 
+    def test_start_existing_with_same_fingerprint(self):
+        service = FakeService()
+        service.env = {'KEY': 12345}
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        fingerprint = self.docker.fingerprint(service)
+        self.docker._existing_containers = [
+            FakeContainer(status='exited',
+                          network='the-network',
+                          id='longass-container-id',
+                          labels={LABEL_FINGERPRINT: fingerprint},
+                          name="{}-testing-123".format(service.name))]
+        agent.run_image()
+        assert len(self.docker._services_started) == 0
+        assert self.docker._containers_ran == ['longass-container-id']
+        assert self.docker._invalidated == ['service1']
+
+
+    def test_start_new_if_fingerprint_differs(self):
+        service = FakeService()
+        old_fingerprint = self.docker.fingerprint(service)
+        service.ports = {80: 8080}
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        container = FakeContainer(status='exited',
+                                  network='the-network',
+                                  id='longass-container-id',
+                                  labels={LABEL_FINGERPRINT: old_fingerprint},
+                                  name="{}-testing-123".format(service.name))
+        self.docker._existing_containers = [container]
+        agent.run_image()
+        assert len(self.docker._services_started) == 1
+        assert self.docker._containers_ran == []
+        assert container.removed_at is not None
+        # The image is checked once, and the fingerprint reused for the new container
+        assert self.docker._images_checked == [service.image]
+        assert self.docker._fingerprints == [self.docker.fingerprint(service)]
+
+
+    def test_remove_stale_duplicates(self):
+        service = FakeService()
+        agent = ServiceAgent(service, DEFAULT_OPTIONS, FakeRunningContext())
+        fingerprint = self.docker.fingerprint(service)
+        stale = FakeContainer(status='exited',
+                              network='the-network',
+                              id='stale-container-id',
+                              labels={LABEL_FINGERPRINT: 'outdated'},
+                              name="{}-testing-123".format(service.name))
+        current = FakeContainer(status='exited',
+                                network='the-network',
+                                id='current-container-id',
+                                labels={LABEL_FINGERPRINT: fingerprint},
+                                name="{}-testing-456".format(service.name))
+        self.docker._existing_containers = [stale, current]
+        agent.run_image()
+        assert len(self.docker._services_started) == 0
+        assert self.docker._containers_ran == ['current-container-id']
+        assert stale.removed_at is not None
+        assert current.removed_at is None
+        # Once for the removal, once for the start
+        assert self.docker._invalidated == ['service1', 'service1']
+
+
     def test_start_new_if_always_start_new(self):
         service = FakeService()
         service.always_start_new = True
@@ -202,12 +365,12 @@ class ServiceAgentTests(unittest.TestCase):
                           remove=True,
                           run_dir='/etc',
                           build=[])
-        agent = ServiceAgent(service, options, None)
+        agent = ServiceAgent(service, options, FakeRunningContext())
         restarted = False
         def start():
             nonlocal restarted
             restarted = True
-        self.docker._existing_containers = [Bunch(status='exited',
+        self.docker._existing_containers = [FakeContainer(status='exited',
                                                   start=start,
                                                   network='the-network',
                                                   attrs={'Config': {'Env': []}},
@@ -219,21 +382,21 @@ class ServiceAgentTests(unittest.TestCase):
     def test_build_on_start(self):
         fake_context = FakeRunningContext()
         fake_service = FakeService()
-        fake_service.build_from = "the/service/dir"
+        fake_service.build_from = self.build_dir
         options = attr.evolve(DEFAULT_OPTIONS, build=[fake_service.name])
         agent = ServiceAgent(fake_service, options, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert len(self.docker._images_built) == 1
 
     def test_if_build_from_and_latest(self):
         fake_context = FakeRunningContext()
         fake_service = FakeService()
         fake_service.image = "service:latest"
-        fake_service.build_from = "the/service/dir"
+        fake_service.build_from = self.build_dir
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert len(self.docker._images_built) == 1
 
 
@@ -243,7 +406,7 @@ class ServiceAgentTests(unittest.TestCase):
         assert not fake_service.pre_start_called
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert fake_service.pre_start_called
 
 
@@ -252,13 +415,74 @@ class ServiceAgentTests(unittest.TestCase):
         fake_service = FakeService()
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert len(fake_context.started_services) == 1
         assert fake_context.started_services[0].name == 'service1'
         assert fake_service.ping_count == 1
         assert fake_service.init_called
 
 
+    def test_async_hooks(self):
+        class AsyncHookService(FakeService):
+            async def ping(self):
+                self.ping_count += 1
+                return True
+            async def post_start(self):
+                self.init_called = True
+        fake_context = FakeRunningContext()
+        fake_service = AsyncHookService()
+        agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
+        agent.start_service()
+        agent.executor.shutdown()
+        assert fake_context.started_services == [fake_service]
+        assert fake_service.ping_count == 1
+        assert fake_service.init_called
+
+
+    def test_readiness_probe_instead_of_ping(self):
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen()
+        fake_context = FakeRunningContext()
+        fake_service = FakeService()
+        fake_service.readiness = TcpProbe(listener.getsockname()[1],
+                                          backoff=Backoff(initial=0.01))
+        agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
+        try:
+            agent.start_service()
+            agent.executor.shutdown()
+        finally:
+            listener.close()
+        assert fake_context.started_services == [fake_service]
+        assert fake_service.ping_count == 0
+        assert RunCondition.PING in agent.run_condition.actions
+
+
+    def test_wait_until_healthy(self):
+        fake_context = FakeRunningContext()
+        fake_service = FakeService()
+        fake_service.wait_for_healthy = True
+        agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
+        agent.start_service()
+        agent.executor.shutdown()
+        assert self.docker._health_waited == [("service1-testing-1234", 1)]
+        assert fake_service.ping_count == 0
+        assert fake_context.started_services == [fake_service]
+
+
+    def test_fail_if_unhealthy(self):
+        fake_context = FakeRunningContext()
+        fake_service = FakeService()
+        fake_service.wait_for_healthy = True
+        self.docker.healthy = False
+        agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
+        agent.start_service()
+        agent.executor.shutdown()
+        assert agent.status == AgentStatus.FAILED
+        assert fake_context.failed_services == [fake_service]
+        assert not fake_service.init_called
+
+
     def test_no_pre_ping_or_init_if_running(self):
         service = FakeService()
         fake_context = FakeRunningContext()
@@ -268,11 +492,11 @@ class ServiceAgentTests(unittest.TestCase):
                           run_dir='/etc',
                           build=[])
         agent = ServiceAgent(service, options, fake_context)
-        self.docker._existing_containers = [Bunch(status='running',
+        self.docker._existing_containers = [FakeContainer(status='running',
                                                   network='the-network',
                                                   name="{}-testing-123".format(service.name))]
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert service.ping_count == 0
         assert not service.init_called
         assert not service.pre_start_called
@@ -282,14 +506,14 @@ class ServiceAgentTests(unittest.TestCase):
         service = FakeService()
         fake_context = FakeRunningContext()
         agent = ServiceAgent(service, DEFAULT_OPTIONS, fake_context)
-        self.docker._existing_containers = [Bunch(status='exited',
+        self.docker._existing_containers = [FakeContainer(status='exited',
                                                   network='the-network',
                                                   id='longass-container-id',
                                                   image=Bunch(tags=[service.image]),
                                                   attrs={'Config': {'Env': []}},
                                                   name="{}-testing-123".format(service.name))]
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert service.ping_count == 1
         assert not service.init_called
         assert self.docker._containers_ran == ['longass-container-id']
@@ -302,7 +526,7 @@ class ServiceAgentTests(unittest.TestCase):
         fake_service = FakeService(fail_ping=True)
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert fake_service.ping_count == 3
         assert mock_time.sleep.call_count == 3
         assert agent.status == AgentStatus.FAILED
@@ -310,6 +534,23 @@ class ServiceAgentTests(unittest.TestCase):
         assert fake_context.failed_services[0] is fake_service
 
 
+    @patch('miniboss.service_agent.time')
+    def test_stop_pinging_when_container_exits(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 0.2, 0.6, 0.8, 1]
+        self.docker.exited_containers['service1-testing-1234'] = "Fatal error"
+        fake_context = FakeRunningContext()
+        fake_service = FakeService(fail_ping=True)
+        agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
+        with self.assertLogs('miniboss.service_agent', level='ERROR') as logs:
+            agent.start_service()
+            agent.executor.shutdown()
+        assert 'ContainerStartException' in logs.output[0]
+        assert 'Fatal error' in logs.output[0]
+        assert fake_service.ping_count == 1
+        assert mock_time.sleep.call_count == 0
+        assert agent.status == AgentStatus.FAILED
+
+
     def test_service_failed_on_failed_ping(self):
         fake_context = FakeRunningContext()
         fake_service = FakeService(fail_ping=True)
@@ -321,7 +562,7 @@ class ServiceAgentTests(unittest.TestCase):
                           build=[])
         agent = ServiceAgent(fake_service, options, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert fake_service.ping_count > 0
         assert fake_context.started_services == []
         assert len(fake_context.failed_services) == 1
@@ -346,7 +587,7 @@ class ServiceAgentTests(unittest.TestCase):
                           build=[])
         agent = ServiceAgent(CrazyFakeService(name=name), options, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert container.stopped
         assert container.removed_at is not None
         # This is 0 because the service wasn't stopped by the user
@@ -358,7 +599,7 @@ class ServiceAgentTests(unittest.TestCase):
         fake_service = FakeService(exception_at_init=ValueError)
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
         agent.start_service()
-        agent.join()
+        agent.executor.shutdown()
         assert fake_service.ping_count > 0
         assert fake_context.started_services == []
         assert len(fake_context.failed_services) == 1
@@ -370,7 +611,7 @@ class ServiceAgentTests(unittest.TestCase):
         fake_service = FakeService(exception_at_init=ValueError)
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
         agent.stop_service()
-        agent.join()
+        agent.executor.shutdown()
         assert agent.status == AgentStatus.STOPPED
 
 
@@ -383,34 +624,46 @@ class ServiceAgentTests(unittest.TestCase):
         self.docker._existing_containers = [container]
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, fake_context)
         agent.stop_service()
-        agent.join()
+        agent.executor.shutdown()
         assert agent.status == AgentStatus.STOPPED
         assert container.stopped
         assert len(fake_context.stopped_services) == 1
         assert fake_context.stopped_services[0] is fake_service
 
 
-    @patch("miniboss.service_agent.datetime")
-    def test_build_image(self, mock_datetime):
-        now = datetime.now()
-        mock_datetime.now.return_value = now
+    def test_build_image(self):
         fake_service = FakeService(name='myservice')
-        fake_service.build_from = "the/service/dir"
+        fake_service.build_from = self.build_dir
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, FakeRunningContext())
         retval = agent.build_image()
         assert len(self.docker._images_built) == 1
         build_dir, dockerfile, image_tag = self.docker._images_built[0]
-        assert build_dir == "/etc/the/service/dir"
+        assert build_dir == self.build_dir
         assert dockerfile == 'Dockerfile'
-        assert image_tag == now.strftime("myservice-%Y-%m-%d-%H%M")
+        digest = context_digest(self.build_dir, 'Dockerfile')
+        assert image_tag == "myservice:" + digest[:16]
         assert retval == image_tag
         assert RunCondition.BUILD_IMAGE in agent.run_condition.actions
 
 
+    def test_skip_build_if_sources_unchanged(self):
+        fake_service = FakeService(name='myservice')
+        fake_service.build_from = self.build_dir
+        first = ServiceAgent(fake_service, DEFAULT_OPTIONS, FakeRunningContext()).build_image()
+        agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, FakeRunningContext())
+        assert agent.build_image() == first
+        assert len(self.docker._images_built) == 1
+        assert RunCondition.BUILD_IMAGE not in agent.run_condition.actions
+        with open(os.path.join(self.build_dir, 'app.py'), 'w') as source:
+            source.write("print('hello')\n")
+        assert agent.build_image() != first
+        assert len(self.docker._images_built) == 2
+
+
     def test_build_image_dockerfile(self):
         fake_service = FakeService(name='myservice')
         fake_service.dockerfile = 'Dockerfile.other'
-        fake_service.build_from = "the/service/dir"
+        fake_service.build_from = self.build_dir
         agent = ServiceAgent(fake_service, DEFAULT_OPTIONS, FakeRunningContext())
         agent.build_image()
         assert len(self.docker._images_built) == 1
@@ -3,7 +3,10 @@ import json
 import unittest
 from unittest.mock import patch
 from types import SimpleNamespace as Bunch
+import shutil
 import tempfile
+import threading
+import time
 import pathlib
 
 import attr
@@ -17,10 +20,13 @@ from miniboss.services import (connect_services,
                                ServiceDefinitionError)
 
 from miniboss.service_agent import ServiceAgent
+from miniboss.history import StartHistory
+from miniboss.run_state import RunState
+from miniboss.trace import chrome_trace
 from miniboss.types import Options, Network
-from miniboss import services, service_agent, Context, exceptions
+from miniboss import services, service_agent, async_engine, Context, exceptions
 
-from common import FakeDocker, FakeContainer, DEFAULT_OPTIONS
+from common import FakeDocker, FakeContainer, FakeService, DEFAULT_OPTIONS
 
 class ServiceDefinitionTests(unittest.TestCase):
 
@@ -73,6 +79,25 @@ class ServiceDefinitionTests(unittest.TestCase):
                 env = {}
                 stop_signal = "HELLO"
 
+    def test_invalid_health_fields(self):
+        with pytest.raises(ServiceDefinitionError):
+            class NewService(Service):
+                name = "yes"
+                image = "yes"
+                wait_for_healthy = "yes"
+
+        with pytest.raises(ServiceDefinitionError):
+            class NewService(Service):
+                name = "yes"
+                image = "yes"
+                healthcheck = ["CMD", "true"]
+
+        with pytest.raises(ServiceDefinitionError):
+            class NewService(Service):
+                name = "yes"
+                image = "yes"
+                healthcheck = {"test": ["CMD", "true"], "frequency": 5}
+
     def test_hashable(self):
         class NewService(Service):
             name = "service_one"
@@ -82,6 +107,19 @@ class ServiceDefinitionTests(unittest.TestCase):
         assert service == NewService()
         assert a_dict[NewService()] == "one"
 
+    def test_invalid_wait_for(self):
+        with pytest.raises(ServiceDefinitionError):
+            class NewService(Service):
+                name = "yes"
+                image = "yes"
+                wait_for = ["db"]
+
+        with pytest.raises(ServiceDefinitionError):
+            class NewService(Service):
+                name = "yes"
+                image = "yes"
+                wait_for = {"db": "healthy"}
+
     def test_invalid_build_from(self):
         with pytest.raises(ServiceDefinitionError):
             class NewService(Service):
@@ -423,6 +461,8 @@ class ServiceCollectionTests(unittest.TestCase):
         collection.load_definitions()
         retval = collection.start_all(DEFAULT_OPTIONS)
         assert set(retval) == {"hello", "goodbye", "howareyou"}
+        assert self.docker._prefetched == [(['goodbye/image', 'hello/image', 'howareyou/image'],
+                                            None)]
         assert len(self.docker._services_started) == 3
         # The one without dependencies should have been started first
         name_prefix, service, network_name = self.docker._services_started[0]
@@ -430,6 +470,123 @@ class ServiceCollectionTests(unittest.TestCase):
         assert name_prefix == "howareyou-testing"
 
 
+    def test_start_all_with_parallelism(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        # Keep references, since subclasses are only weakly referenced by the base class
+        subclasses = [type("Service{}".format(index), (NewServiceBase,),
+                           {"name": "service{}".format(index),
+                            "image": "service/image",
+                            "dependencies": ["service0"] if index else []})
+                      for index in range(6)]
+        collection.load_definitions()
+        options = attr.evolve(DEFAULT_OPTIONS, parallelism=2, image_parallelism=1)
+        retval = collection.start_all(options)
+        assert len(retval) == 6
+        assert len(self.docker._services_started) == 6
+        assert self.docker._services_started[0][1].name == 'service0'
+        assert self.docker._images_checked == ['service/image'] * 6
+
+
+    def test_start_all_report(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class ServiceOne(NewServiceBase):
+            name = "hello"
+            image = "hello/image"
+            def ping(self):
+                time.sleep(0.1)
+                return True
+
+        class ServiceTwo(NewServiceBase):
+            name = "goodbye"
+            image = "goodbye/image"
+            def ping(self):
+                time.sleep(0.1)
+                return True
+        collection.load_definitions()
+        options = attr.evolve(DEFAULT_OPTIONS, parallelism=1)
+        collection.start_all(options)
+        report = collection.run_report()
+        assert report['wall_time'] >= 0.2
+        timings = report['services']
+        assert {timing['state'] for timing in timings.values()} == {'running'}
+        # Only one of the services could be processed at a time
+        assert max(timing['queue_wait'] for timing in timings.values()) >= 0.1
+        for timing in timings.values():
+            phases = [phase['phase'] for phase in timing['timeline']]
+            # The containers are created before the services are dispatched
+            assert phases == ['pull', 'create', 'pre-start', 'create', 'ping', 'ping-attempt',
+                              'post-start']
+            assert timing['phases']['ping'] >= 0.1
+            assert timing['dispatched'] <= timing['timeline'][2]['start']
+            assert timing['finished'] <= report['wall_time']
+        events = chrome_trace(collection.agents)['traceEvents']
+        assert {event['name'] for event in events if event['ph'] == 'X'} >= {
+            'start hello', 'start goodbye', 'ping', 'ping-attempt', 'queued'}
+
+
+    def test_start_all_critical_path_first(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class Short(NewServiceBase):
+            name = "short"
+            image = "short/image"
+
+        class Kafka(NewServiceBase):
+            name = "kafka"
+            image = "kafka/image"
+
+        class Registry(NewServiceBase):
+            name = "registry"
+            image = "registry/image"
+            dependencies = ["kafka"]
+        collection.load_definitions()
+        collection.history = StartHistory({'short': {'ping': 1},
+                                           'kafka': {'ping': 1},
+                                           'registry': {'ping': 10}})
+        options = attr.evolve(DEFAULT_OPTIONS, parallelism=1)
+        collection.start_all(options)
+        started = [service.name for _, service, _ in self.docker._services_started]
+        assert started == ['kafka', 'registry', 'short']
+        assert set(collection.history.durations['short'].keys()) == {
+            'pre-start', 'pull', 'create', 'ping', 'post-start'}
+
+
+    def test_start_all_asyncio_engine(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class ServiceOne(NewServiceBase):
+            name = "hello"
+            image = "hello/image"
+            dependencies = ["howareyou"]
+
+        class ServiceTwo(NewServiceBase):
+            name = "howareyou"
+            image = "howareyou/image"
+            async def ping(self):
+                return True
+        async_engine.DockerClient = self.docker
+        collection.load_definitions()
+        options = attr.evolve(DEFAULT_OPTIONS, engine='asyncio')
+        retval = collection.start_all(options)
+        assert set(retval) == {"hello", "howareyou"}
+        started = [service.name for _, service, _ in self.docker._services_started]
+        assert started == ["howareyou", "hello"]
+
+
     def test_start_all_with_build(self):
         collection = ServiceCollection()
         class NewServiceBase(Service):
@@ -442,16 +599,310 @@ class ServiceCollectionTests(unittest.TestCase):
             build_from = "goodbye/dir"
             dockerfile = "Dockerfile.alt"
         collection.load_definitions()
-        options = attr.evolve(DEFAULT_OPTIONS, build=['goodbye'])
+        run_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(run_dir, "goodbye/dir"))
+        options = attr.evolve(DEFAULT_OPTIONS, build=['goodbye'], run_dir=run_dir)
         retval = collection.start_all(options)
+        shutil.rmtree(run_dir)
+        # Built images are not prefetched
+        assert self.docker._prefetched == [([], None)]
         assert len(self.docker._images_built) == 1
         build_dir, dockerfile, image_tag = self.docker._images_built[0]
-        assert build_dir == "/etc/goodbye/dir"
+        assert build_dir == os.path.join(run_dir, "goodbye/dir")
         assert dockerfile == 'Dockerfile.alt'
-        assert image_tag.startswith("goodbye-")
+        assert image_tag.startswith("goodbye:")
         service = collection.all_by_name['goodbye']
         assert service.image == image_tag
 
+    def _resume(self, engine):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class Database(NewServiceBase):
+            name = "db"
+            image = "db/image"
+
+        class Application(NewServiceBase):
+            name = "app"
+            image = "app/image"
+            dependencies = ["db"]
+
+        class Queue(NewServiceBase):
+            name = "queue"
+            image = "queue/image"
+
+        class Worker(NewServiceBase):
+            name = "worker"
+            image = "worker/image"
+            dependencies = ["queue"]
+        async_engine.DockerClient = self.docker
+        collection.load_definitions()
+        running = types.RunCondition()
+        running.pinged()
+        failed = types.RunCondition()
+        failed.fail()
+        collection.run_state = RunState()
+        for name in ["db", "app", "worker"]:
+            collection.run_state.record(name, running, "{:s}-testing-1234".format(name), None)
+            self.docker._existing_containers.append(
+                FakeContainer(name="{:s}-testing-1234".format(name), network='the-network',
+                              status='running'))
+        collection.run_state.record("queue", failed, None, None)
+        options = attr.evolve(DEFAULT_OPTIONS, engine=engine, resume=True)
+        retval = collection.start_all(options)
+        assert set(retval) == {"db", "app", "queue", "worker"}
+        agents = {service.name: agent
+                  for service, agent in collection.running_context.agents.items()}
+        # The dependant of the failed service is not resumed, but started again
+        assert [name for name, agent in agents.items() if agent.resumed] == ["db", "app"]
+        started = [service.name for _, service, _ in self.docker._services_started]
+        assert started == ["queue"]
+        # The container of worker is running, so its image is not needed
+        assert self.docker._prefetched == [(['queue/image'], None)]
+        assert ("db", options.network) not in self.docker._existing_queried[4:]
+        assert collection.run_state.services["queue"]["state"] == types.RunCondition.RUNNING
+        assert collection.run_state.services["queue"]["container"] == "queue-testing-1234"
+
+    def test_resume(self):
+        self._resume('threads')
+
+    def test_resume_asyncio(self):
+        self._resume('asyncio')
+
+    def _start_before_post_start(self, engine):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        cache_started = threading.Event()
+        class Database(NewServiceBase):
+            name = "db"
+            image = "db/image"
+            def post_start(self):
+                # Blocks until the dependant was started
+                if cache_started.wait(5):
+                    Context['db_url'] = "postgres://db"
+        class Cache(NewServiceBase):
+            name = "cache"
+            image = "cache/image"
+            dependencies = ["db"]
+            wait_for = {"db": "started"}
+            def pre_start(self):
+                cache_started.set()
+        class Application(NewServiceBase):
+            name = "app"
+            image = "app/image"
+            dependencies = ["db"]
+            wait_for = {"db": "pinged"}
+            env = {"DATABASE_URL": "{db_url}"}
+        async_engine.DockerClient = self.docker
+        collection.load_definitions()
+        options = attr.evolve(DEFAULT_OPTIONS, engine=engine, timeout=5)
+        try:
+            retval = collection.start_all(options)
+            assert set(retval) == {"db", "cache", "app"}
+            assert cache_started.is_set()
+            assert collection.all_by_name['app'].env == {"DATABASE_URL": "postgres://db"}
+        finally:
+            Context._reset()
+
+    def _old_context_value(self, engine, sets_value):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class Database(NewServiceBase):
+            name = "db"
+            image = "db/image"
+            def post_start(self):
+                if sets_value:
+                    time.sleep(0.1)
+                    Context['db_url'] = "postgres://new"
+        class Application(NewServiceBase):
+            name = "app"
+            image = "app/image"
+            dependencies = ["db"]
+            wait_for = {"db": "started"}
+            env = {"DATABASE_URL": "{db_url}"}
+        async_engine.DockerClient = self.docker
+        collection.load_definitions()
+        options = attr.evolve(DEFAULT_OPTIONS, engine=engine, timeout=5)
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, ".miniboss-context"), 'w') as context_file:
+            context_file.write('{"db_url": "postgres://old"}')
+        try:
+            with Context.attached(directory):
+                start = time.monotonic()
+                assert set(collection.start_all(options)) == {"db", "app"}
+                assert time.monotonic() - start < 2
+            return collection.all_by_name['app'].env["DATABASE_URL"]
+        finally:
+            Context._reset()
+            shutil.rmtree(directory)
+
+    def test_wait_for_value_of_current_start(self):
+        # The value saved by the last start is not used while the hook that
+        # sets it again is running
+        for engine in ['threads', 'asyncio']:
+            assert self._old_context_value(engine, True) == "postgres://new"
+
+    def test_use_old_value_when_not_set_again(self):
+        for engine in ['threads', 'asyncio']:
+            assert self._old_context_value(engine, False) == "postgres://old"
+
+    def test_start_before_post_start(self):
+        self._start_before_post_start('threads')
+
+    def test_start_before_post_start_async(self):
+        self._start_before_post_start('asyncio')
+
+    def test_wait_for_not_a_dependency(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class Database(NewServiceBase):
+            name = "db"
+            image = "db/image"
+        class Application(NewServiceBase):
+            name = "app"
+            image = "app/image"
+            wait_for = {"db": "started"}
+        with pytest.raises(ServiceLoadError):
+            collection.load_definitions()
+
+    def _build_during_dependency_start(self, engine):
+        collection = ServiceCollection()
+        docker = self.docker
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class ServiceOne(NewServiceBase):
+            name = "hello"
+            image = "hello/image"
+            built_during_ping = False
+            def ping(self):
+                time.sleep(0.2)
+                ServiceOne.built_during_ping = bool(docker._images_built)
+                return True
+        class ServiceTwo(NewServiceBase):
+            name = "goodbye"
+            image = "goodbye/image"
+            build_from = "goodbye/dir"
+            dependencies = ["hello"]
+        async_engine.DockerClient = self.docker
+        collection.load_definitions()
+        run_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(run_dir, "goodbye/dir"))
+        options = attr.evolve(DEFAULT_OPTIONS, build=['goodbye'], run_dir=run_dir,
+                              engine=engine, build_parallelism=1)
+        try:
+            retval = collection.start_all(options)
+        finally:
+            shutil.rmtree(run_dir)
+        assert set(retval) == {"hello", "goodbye"}
+        # The image was built while the dependency was being started
+        assert ServiceOne.built_during_ping
+        started = [service.name for _, service, _ in self.docker._services_started]
+        assert started == ["hello", "goodbye"]
+        assert collection.all_by_name['goodbye'].image.startswith("goodbye:")
+
+    def test_start_all_builds_while_dependencies_start(self):
+        self._build_during_dependency_start('threads')
+
+    def test_start_all_builds_while_dependencies_start_async(self):
+        self._build_during_dependency_start('asyncio')
+
+    def _precreate(self, engine):
+        collection = ServiceCollection()
+        docker = self.docker
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class ServiceOne(NewServiceBase):
+            name = "hello"
+            image = "hello/image"
+            created_during_ping = []
+            def ping(self):
+                time.sleep(0.1)
+                ServiceOne.created_during_ping = list(docker._containers_created)
+                return True
+            def post_start(self):
+                Context['hello_host'] = 'hello'
+        class ServiceTwo(NewServiceBase):
+            name = "goodbye"
+            image = "goodbye/image"
+            env = {"MODE": "static"}
+            dependencies = ["hello"]
+        class ServiceThree(NewServiceBase):
+            name = "howareyou"
+            image = "howareyou/image"
+            env = {"HOST": "{hello_host}"}
+            dependencies = ["hello"]
+        async_engine.DockerClient = self.docker
+        collection.load_definitions()
+        options = attr.evolve(DEFAULT_OPTIONS, engine=engine)
+        retval = collection.start_all(options)
+        assert set(retval) == {"hello", "goodbye", "howareyou"}
+        # The container of goodbye was created while hello was being started,
+        # but not that of howareyou, which uses the context
+        assert "goodbye-testing-id" in ServiceOne.created_during_ping
+        assert "howareyou-testing-id" not in self.docker._containers_created
+        assert "goodbye-testing-id" in self.docker._containers_ran
+        assert self.docker._containers_removed == []
+
+    def test_start_all_precreate(self):
+        self._precreate('threads')
+
+    def test_start_all_precreate_async(self):
+        self._precreate('asyncio')
+
+    def test_remove_unused_precreated(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        collection._base_class = NewServiceBase
+        class ServiceOne(NewServiceBase):
+            name = "hello"
+            image = "hello/image"
+            def ping(self):
+                return False
+        class ServiceTwo(NewServiceBase):
+            name = "goodbye"
+            image = "goodbye/image"
+            dependencies = ["hello"]
+        collection.load_definitions()
+        options = attr.evolve(DEFAULT_OPTIONS, timeout=0.1)
+        retval = collection.start_all(options)
+        assert retval == []
+        assert "goodbye-testing-id" in self.docker._containers_created
+        assert self.docker._containers_removed == ["goodbye-testing-id"]
+
+    def test_stop_watching_if_indexing_fails(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+        class ServiceOne(NewServiceBase):
+            name = "hello"
+            image = "hello/image"
+        collection._base_class = NewServiceBase
+        collection.load_definitions()
+        def index_containers(network):
+            raise exceptions.DockerException("Could not list containers")
+        self.docker.index_containers = index_containers
+        with pytest.raises(exceptions.DockerException):
+            collection.start_all(DEFAULT_OPTIONS)
+        assert self.docker._watching == []
+
     def test_start_all_create_network(self):
         collection = ServiceCollection()
         class NewServiceBase(Service):
@@ -695,6 +1146,30 @@ class ServiceCollectionTests(unittest.TestCase):
         assert container3.stopped
 
 
+    def test_update_for_base_service_keeps_network(self):
+        collection = ServiceCollection()
+        class NewServiceBase(Service):
+            name = "not used"
+            image = "not used"
+
+        class ServiceOne(NewServiceBase):
+            name = "service1"
+            image = "howareyou/image"
+
+        class ServiceTwo(NewServiceBase):
+            name = "service2"
+            image = "howareyou/image"
+            dependencies = ['service1']
+
+        collection._base_class = NewServiceBase
+        collection.load_definitions()
+        collection.update_for_base_service('service2')
+        assert collection.excluded == ['service1']
+        # The service that is left running is still attached to the network
+        collection.stop_all(attr.evolve(DEFAULT_OPTIONS, remove=True))
+        assert self.docker._networks_removed == []
+
+
     def test_check_can_be_built(self):
         collection = ServiceCollection()
         class NewServiceBase(Service):
@@ -723,6 +1198,7 @@ class ServiceCommandTests(unittest.TestCase):
 
     def setUp(self):
         class MockServiceCollection:
+            agents = []
             def load_definitions(self):
                 pass
             def exclude_for_start(self, exclude):
@@ -732,6 +1208,8 @@ class ServiceCommandTests(unittest.TestCase):
             def start_all(self, options):
                 self.options = options
                 return ["one", "two"]
+            def run_report(self):
+                return {'wall_time': 1.0, 'services': {}}
             def stop_all(self, options):
                 self.options = options
                 self.stopped = True
@@ -783,12 +1261,79 @@ class ServiceCommandTests(unittest.TestCase):
         assert options.remove == False
         assert options.run_dir == '/tmp'
         assert options.build == []
+        assert options.parallelism is None
+
+    def test_start_services_parallelism(self):
+        services.start_services('/tmp', [], "miniboss", 50,
+                                parallelism=4, image_parallelism=2, container_parallelism=3,
+                                build_parallelism=5)
+        options = self.collection.options
+        assert options.parallelism == 4
+        assert options.image_parallelism == 2
+        assert options.container_parallelism == 3
+        assert options.build_parallelism == 5
 
     def test_services_network_name_none(self):
         services.start_services('/tmp', [], None, 50)
         options = self.collection.options
         assert options.network.name == 'miniboss-test'
 
+    def test_start_services_save_history(self):
+        directory = tempfile.mkdtemp()
+        services.start_services(directory, [], "miniboss", 50)
+        assert isinstance(self.collection.history, StartHistory)
+        assert os.path.exists(os.path.join(directory, ".miniboss-history"))
+
+    def test_start_services_resume(self):
+        directory = tempfile.mkdtemp()
+        services.start_services(directory, [], "miniboss", 50, resume=True)
+        assert self.collection.options.resume
+        assert isinstance(self.collection.run_state, RunState)
+        assert os.path.exists(os.path.join(directory, ".miniboss-run-state"))
+
+    def test_api_stats(self):
+        docker = FakeDocker()
+        services.DockerClient = Bunch(get_client=lambda: docker)
+        attached = []
+        def stop_all(options):
+            attached.extend(docker._ledgers)
+        self.collection.stop_all = stop_all
+        with self.assertLogs('miniboss.services') as logs:
+            services.stop_services('/tmp', [], "miniboss", False, 50, api_stats=True)
+        assert len(attached) == 1 and docker._ledgers == []
+        assert "Docker API calls: 0, 0.000s in total" in logs.output[-1]
+
+    def test_start_services_report(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "timings.json")
+        services.start_services(directory, [], "miniboss", 50, report=path)
+        with open(path) as report_file:
+            assert json.load(report_file) == {'wall_time': 1.0, 'services': {}}
+
+    def test_start_stop_services_trace(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "trace.json")
+        services.start_services(directory, [], "miniboss", 50, trace=path)
+        with open(path) as trace_file:
+            assert 'traceEvents' in json.load(trace_file)
+        os.remove(path)
+        services.stop_services(directory, [], "miniboss", False, 50, trace=path,
+                               trace_format='otlp')
+        with open(path) as trace_file:
+            assert 'resourceSpans' in json.load(trace_file)
+
+    def test_plan_services(self):
+        directory = tempfile.mkdtemp()
+        self.collection.all_by_name = connect_services([
+            FakeService(name='db'), FakeService(name='app', dependencies=['db'])])
+        lines = services.plan_services(directory, ['other'])
+        assert self.collection.excluded == ['other']
+        assert lines == ["Wave 1: db", "Wave 2: app",
+                         "No recorded timings; start the services to record them"]
+        StartHistory({'db': {'ping': 2.0}, 'app': {'post-start': 1.0}}).save_to(directory)
+        lines = services.plan_services(directory, [], parallelism=1)
+        assert lines[2] == "Expected critical path (3.0s): db -> app"
+
     def test_load_context_on_new(self):
         directory = tempfile.mkdtemp()
         with open(os.path.join(directory, ".miniboss-context"), "w") as context_file:
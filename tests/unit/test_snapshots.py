@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytest
+
+from miniboss.snapshots import (load_snapshot,
+                                restore_volumes,
+                                save_snapshot,
+                                snapshot_key,
+                                SNAPSHOT_DIR)
+
+from common import FakeDocker
+
+
+class SeededService:
+    name = 'appdb'
+
+    def pre_start(self):
+        pass
+
+    def post_start(self):
+        return "seed"
+
+
+class ReseededService(SeededService):
+
+    def post_start(self):
+        return "seed differently"
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        self.docker = FakeDocker()
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_key(self):
+        key = snapshot_key(SeededService(), 'fingerprint')
+        assert key == snapshot_key(SeededService(), 'fingerprint')
+        assert key != snapshot_key(SeededService(), 'other-fingerprint')
+        assert key != snapshot_key(ReseededService(), 'fingerprint')
+
+
+    def test_save_load_restore(self):
+        key = snapshot_key(SeededService(), 'fingerprint')
+        assert load_snapshot(self.docker, self.run_dir, key) is None
+        self.docker._volume_paths = ['/data', '/var/lib/db/']
+        saved = save_snapshot(self.docker, self.run_dir, key, 'appdb-testing-1234',
+                              {'db_seeded': True})
+        assert self.docker._paused == []
+        assert self.docker._committed == [('appdb-testing-1234', saved.image)]
+        snapshot = load_snapshot(self.docker, self.run_dir, key)
+        assert snapshot == saved
+        assert snapshot.context == {'db_seeded': True}
+        restore_volumes(self.docker, self.run_dir, snapshot, 'new-container-id')
+        assert self.docker._imported == [
+            ('new-container-id', '/data', b'contents of /data'),
+            ('new-container-id', '/var/lib/db/', b'contents of /var/lib/db/')]
+        # Snapshots whose image was removed are not used
+        self.docker._images_available.remove(saved.image)
+        assert load_snapshot(self.docker, self.run_dir, key) is None
+
+
+    def test_failed_save(self):
+        def fail(*args):
+            raise ValueError("Export failed")
+        self.docker.export_path = fail
+        with pytest.raises(ValueError):
+            save_snapshot(self.docker, self.run_dir, 'the-key', 'appdb-testing-1234', {})
+        assert self.docker._paused == []
+        assert os.listdir(os.path.join(self.run_dir, SNAPSHOT_DIR)) == []
@@ -0,0 +1,100 @@
+import os
+import json
+import unittest
+import tempfile
+from types import SimpleNamespace as Bunch
+
+from miniboss import types
+from miniboss.services import connect_services
+from miniboss.trace import chrome_trace, otlp_trace, write_trace, TraceFormat
+from miniboss.types import RunCondition, Actions
+
+from common import FakeService
+
+def agent(service, action, ready_at, dispatched_at, finished_at, phases):
+    run_condition = RunCondition()
+    run_condition.ready_at = ready_at
+    run_condition.dispatched_at = dispatched_at
+    run_condition.finished_at = finished_at
+    run_condition.phases = phases
+    return Bunch(service=service, action=action, run_condition=run_condition)
+
+
+class TraceTests(unittest.TestCase):
+
+    def setUp(self):
+        types.set_group_name('testing')
+        services = connect_services([FakeService(name='db'),
+                                     FakeService(name='app', dependencies=['db'])])
+        self.agents = [
+            agent(services['db'], Actions.START, 10.0, 10.0, 13.0,
+                  [('pull', 10.0, 11.0), ('ping-attempt', 11.0, 11.5),
+                   ('ping-attempt', 12.0, 12.5), ('ping', 11.0, 12.5)]),
+            agent(services['app'], Actions.START, 13.0, 13.5, 15.0,
+                  [('build-image', 9.0, 12.0), ('create', 13.5, 14.0)]),
+        ]
+
+    def tearDown(self):
+        types._unset_group_name()
+
+    def test_chrome_trace(self):
+        events = chrome_trace(self.agents)['traceEvents']
+        tracks = {event['args']['name']: event['tid'] for event in events
+                  if event['ph'] == 'M' and event['name'] == 'thread_name'}
+        assert set(tracks) == {'db', 'app'}
+        spans = [(event['name'], event['tid'], event['ts'], event['dur'])
+                 for event in events if event['ph'] == 'X']
+        db, app = tracks['db'], tracks['app']
+        # Times are relative to the earliest span, the build of app
+        assert ('start db', db, 1000000, 3000000) in spans
+        assert ('ping', db, 2000000, 1500000) in spans
+        assert [span for span in spans if span[0] == 'ping-attempt'] == [
+            ('ping-attempt', db, 2000000, 500000), ('ping-attempt', db, 3000000, 500000)]
+        assert ('queued', app, 4000000, 500000) in spans
+        assert ('build-image', app, 0, 3000000) in spans
+        flows = [event for event in events if event['ph'] in 's f']
+        assert [(event['ph'], event['tid'], event['ts']) for event in flows] == [
+            ('s', db, 4000000), ('f', app, 4500000)]
+        assert flows[0]['id'] == flows[1]['id']
+
+
+    def test_otlp_trace(self):
+        scope_spans = otlp_trace(self.agents)['resourceSpans'][0]['scopeSpans']
+        spans = {span['name']: span for span in scope_spans[0]['spans']}
+        assert len({span['traceId'] for span in spans.values()}) == 1
+        root = spans['miniboss testing']
+        assert 'parentSpanId' not in root
+        assert spans['start db']['parentSpanId'] == root['spanId']
+        assert spans['ping']['parentSpanId'] == spans['start db']['spanId']
+        assert spans['ping-attempt']['parentSpanId'] == spans['ping']['spanId']
+        # The build ran before the agent was dispatched
+        assert spans['build-image']['parentSpanId'] == root['spanId']
+        assert spans['start app']['links'] == [{'traceId': root['traceId'],
+                                                'spanId': spans['start db']['spanId']}]
+        duration = (int(spans['start db']['endTimeUnixNano'])
+                    - int(spans['start db']['startTimeUnixNano']))
+        assert abs(duration - 3000000000) < 1000
+
+
+    def test_stop_edges(self):
+        services = connect_services([FakeService(name='db'),
+                                     FakeService(name='app', dependencies=['db'])])
+        agents = [agent(services['db'], Actions.STOP, 12.0, 12.0, 13.0, [('stop', 12.0, 13.0)]),
+                  agent(services['app'], Actions.STOP, 10.0, 10.0, 12.0, [('stop', 10.0, 12.0)])]
+        events = chrome_trace(agents)['traceEvents']
+        tracks = {event['args']['name']: event['tid'] for event in events
+                  if event['ph'] == 'M' and event['name'] == 'thread_name'}
+        flows = [(event['ph'], event['tid']) for event in events if event['ph'] in 's f']
+        assert flows == [('s', tracks['app']), ('f', tracks['db'])]
+
+
+    def test_write_trace(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'trace.json')
+        write_trace(path, self.agents)
+        with open(path) as trace_file:
+            assert 'traceEvents' in json.load(trace_file)
+        write_trace(path, [], TraceFormat.OTLP)
+        with open(path) as trace_file:
+            spans = json.load(trace_file)['resourceSpans'][0]['scopeSpans'][0]['spans']
+        assert [span['name'] for span in spans] == ['miniboss testing']